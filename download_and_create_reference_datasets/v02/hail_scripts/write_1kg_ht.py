@@ -24,7 +24,6 @@ def vcf_to_mt(path, genome_version):
     # Import but do not split multis here.
     mt = import_vcf(path,
                     genome_version=genome_version,
-                    min_partitions=1000,
                     split_multi_alleles=False)
 
     multiallelic_mt = mt.filter_rows(hl.len(mt.alleles) > 2)
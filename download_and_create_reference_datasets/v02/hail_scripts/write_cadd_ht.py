@@ -10,6 +10,7 @@ logger.setLevel(logging.INFO)
 
 import hail as hl
 from hail_scripts.utils.hail_utils import write_ht, import_table
+from hail_scripts.utils.partition_planner import plan_partitions
 
 hl.init()
 
@@ -21,7 +22,8 @@ def import_cadd_table(path: str, genome_version: str) -> hl.Table:
     column_names = {'f0': 'chrom', 'f1': 'pos', 'f2': 'ref', 'f3': 'alt', 'f4': 'RawScore', 'f5': 'PHRED'}
     types = {'f0': hl.tstr, 'f1': hl.tint, 'f4': hl.tfloat32, 'f5': hl.tfloat32}
 
-    cadd_ht = hl.import_table(path, force_bgz=True, comment="#", no_header=True, types=types, min_partitions=10000)
+    cadd_ht = hl.import_table(path, force_bgz=True, comment="#", no_header=True, types=types,
+                              min_partitions=plan_partitions(path).n_partitions)
     cadd_ht = cadd_ht.rename(column_names)
     chrom = hl.format("chr%s", cadd_ht.chrom) if genome_version == "38" else cadd_ht.chrom
     locus = hl.locus(chrom, cadd_ht.pos, reference_genome=hl.get_reference(f"GRCh{genome_version}"))
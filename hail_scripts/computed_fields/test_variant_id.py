@@ -2,7 +2,11 @@ import unittest
 
 import hail as hl
 
-from .variant_id import get_expr_for_xpos
+from .variant_id import (
+    get_expr_for_locus_primitives,
+    get_expr_for_variant_id,
+    get_expr_for_xpos,
+)
 
 
 class TestXpos(unittest.TestCase):
@@ -19,5 +23,22 @@ class TestXpos(unittest.TestCase):
         self.assertEqual(hl.eval(get_expr_for_xpos(locus)), 2166847734)
 
 
+
+class TestLocusPrimitives(unittest.TestCase):
+    def test_locus_primitives(self):
+        row = hl.struct(locus=hl.parse_locus("chrX:18525192", "GRCh38"), alleles=["AC", "A"])
+        primitives = get_expr_for_locus_primitives(row.locus, row.alleles)
+        self.assertEqual(
+            hl.eval(primitives),
+            hl.Struct(contig="X", contig_number=23, ref_length=2, variant_id="X-18525192-AC-A"),
+        )
+        self.assertEqual(
+            hl.eval(get_expr_for_xpos(row.locus, primitives)), hl.eval(get_expr_for_xpos(row.locus))
+        )
+        self.assertEqual(
+            hl.eval(get_expr_for_variant_id(row, 5, primitives)), hl.eval(get_expr_for_variant_id(row, 5))
+        )
+
+
 if __name__ == "__main__":
     unittest.main()
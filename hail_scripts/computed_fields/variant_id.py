@@ -15,13 +15,32 @@ def get_expr_for_contig_number(
     locus: hl.expr.LocusExpression
 ) -> hl.expr.Int32Expression:
     """Convert contig name to contig number"""
+    return hl.bind(_contig_number, get_expr_for_contig(locus))
+
+
+def _contig_number(contig: hl.expr.StringExpression) -> hl.expr.Int32Expression:
+    return (
+        hl.case()
+        .when(contig == "X", 23)
+        .when(contig == "Y", 24)
+        .when(contig[0] == "M", 25)
+        .default(hl.int(contig))
+    )
+
+
+def get_expr_for_locus_primitives(
+    locus: hl.expr.LocusExpression, alleles: hl.expr.ArrayExpression
+) -> hl.expr.StructExpression:
+    """Values derived from the locus and alleles that several fields are built from: the normalized contig, the
+    contig number, the ref allele length and the <chrom>-<pos>-<ref>-<alt> id. Computed once per row, they can
+    be passed to get_expr_for_xpos, get_expr_for_end_pos and get_expr_for_variant_id. Assumes alleles were split.
+    """
     return hl.bind(
-        lambda contig: (
-            hl.case()
-            .when(contig == "X", 23)
-            .when(contig == "Y", 24)
-            .when(contig[0] == "M", 25)
-            .default(hl.int(contig))
+        lambda contig: hl.struct(
+            contig=contig,
+            contig_number=_contig_number(contig),
+            ref_length=hl.len(alleles[0]),
+            variant_id=contig + "-" + hl.str(locus.position) + "-" + alleles[0] + "-" + alleles[1],
         ),
         get_expr_for_contig(locus),
     )
@@ -63,29 +82,37 @@ def get_expr_for_start_pos(table):
     return table.locus.position
 
 
-def get_expr_for_end_pos(table):
-    return table.locus.position + hl.len(get_expr_for_ref_allele(table)) - 1
+def get_expr_for_end_pos(table, primitives=None):
+    ref_length = primitives.ref_length if primitives is not None else hl.len(get_expr_for_ref_allele(table))
+    return table.locus.position + ref_length - 1
 
 
-def get_expr_for_variant_id(table, max_length=None):
+def get_expr_for_variant_id(table, max_length=None, primitives=None):
     """Expression for computing <chrom>-<pos>-<ref>-<alt>. Assumes alleles were split.
 
     Args:
         max_length: (optional) length at which to truncate the <chrom>-<pos>-<ref>-<alt> string
+        primitives: (optional) get_expr_for_locus_primitives of the table rows, to reuse its id
 
     Return:
         string: "<chrom>-<pos>-<ref>-<alt>"
     """
-    contig = get_expr_for_contig(table.locus)
-    variant_id = contig + "-" + hl.str(table.locus.position) + "-" + table.alleles[0] + "-" + table.alleles[1]
+    if primitives is not None:
+        variant_id = primitives.variant_id
+    else:
+        contig = get_expr_for_contig(table.locus)
+        variant_id = contig + "-" + hl.str(table.locus.position) + "-" + table.alleles[0] + "-" + table.alleles[1]
     if max_length is not None:
         return variant_id[0:max_length]
     return variant_id
 
 
-def get_expr_for_xpos(locus: hl.expr.LocusExpression) -> hl.expr.Int64Expression:
+def get_expr_for_xpos(
+    locus: hl.expr.LocusExpression, primitives: hl.expr.StructExpression = None
+) -> hl.expr.Int64Expression:
     """Genomic position represented as a single number = contig_number * 10**9 + position.
     This represents chrom:pos more compactly and allows for easier sorting.
+    primitives: (optional) get_expr_for_locus_primitives of the locus, to reuse its contig number
     """
-    contig_number = get_expr_for_contig_number(locus)
+    contig_number = primitives.contig_number if primitives is not None else get_expr_for_contig_number(locus)
     return hl.int64(contig_number) * 1_000_000_000 + locus.position
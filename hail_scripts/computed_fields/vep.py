@@ -55,6 +55,45 @@ OMIT_CONSEQUENCE_TERMS = [
     "downstream_gene_variant",
 ]
 
+# transcript_consequences fields copied to sortedTranscriptConsequences, see
+# get_expr_for_vep_sorted_transcript_consequences_array.
+TRANSCRIPT_CONSEQUENCE_FIELDS = [
+    "biotype",
+    "canonical",
+    "cdna_start",
+    "cdna_end",
+    "codons",
+    "exon",
+    "gene_id",
+    "gene_symbol",
+    "hgvsc",
+    "hgvsp",
+    "intron",
+    "transcript_id",
+]
+CODING_TRANSCRIPT_CONSEQUENCE_FIELDS = [
+    "amino_acids",
+    "lof",
+    "lof_filter",
+    "lof_flags",
+    "lof_info",
+    "polyphen_prediction",
+    "protein_id",
+    "protein_start",
+    "sift_prediction",
+]
+
+# Fields of the VEP output that the annotations derived from it read, as field name to None for a whole field
+# or to the fields to keep of a struct or array of structs. The rest can be dropped when VEP output is parsed.
+REQUIRED_VEP_FIELDS = {
+    "most_severe_consequence": None,
+    "transcript_consequences": {
+        field: None
+        for field in TRANSCRIPT_CONSEQUENCE_FIELDS + CODING_TRANSCRIPT_CONSEQUENCE_FIELDS + ["consequence_terms", "domains"]
+    },
+}
+
+
 def get_expr_for_vep_consequence_terms_set(vep_transcript_consequences_root):
     vep_consequence_terms_set = hl.set(vep_transcript_consequences_root.flatmap(lambda c: c.consequence_terms))
     any_canonical_and_non_coding_transcript_exon_variant = hl.any(
@@ -165,35 +204,9 @@ def get_expr_for_vep_sorted_transcript_consequences_array(vep_root,
         include_coding_annotations (bool): if True, fields relevant to protein-coding variants will be included
     """
 
-    selected_annotations = [
-        "biotype",
-        "canonical",
-        "cdna_start",
-        "cdna_end",
-        "codons",
-        "exon",
-        "gene_id",
-        "gene_symbol",
-        "hgvsc",
-        "hgvsp",
-        "intron",
-        "transcript_id",
-    ]
-
+    selected_annotations = list(TRANSCRIPT_CONSEQUENCE_FIELDS)
     if include_coding_annotations:
-        selected_annotations.extend(
-            [
-                "amino_acids",
-                "lof",
-                "lof_filter",
-                "lof_flags",
-                "lof_info",
-                "polyphen_prediction",
-                "protein_id",
-                "protein_start",
-                "sift_prediction",
-            ]
-        )
+        selected_annotations.extend(CODING_TRANSCRIPT_CONSEQUENCE_FIELDS)
 
     omit_consequence_terms = hl.set(omit_consequences) if omit_consequences else hl.empty_set(hl.tstr)
 
@@ -261,6 +274,47 @@ def get_expr_for_vep_sorted_transcript_consequences_array(vep_root,
     )
 
 
+def get_expr_for_vep_consequence_terms(vep_root):
+    """Expression for all the consequence terms of the VEP struct: most_severe_consequence and the terms of each
+    transcript consequence.
+    """
+    return vep_root.transcript_consequences.flatmap(lambda c: c.consequence_terms).append(
+        vep_root.most_severe_consequence
+    )
+
+
+def get_expr_for_encoded_vep_consequence_terms(vep_root, consequence_term_ids):
+    """Replace the consequence terms of the VEP struct by integer ids, e.g. for a compact table of VEP results.
+
+    Args:
+        vep_root (StructExpression): root path of the VEP struct
+        consequence_term_ids (DictExpression): consequence term to id, it must contain all the terms of vep_root
+    Return:
+        StructExpression: vep_root with an int most_severe_consequence and int consequence_terms
+    """
+    return vep_root.annotate(
+        most_severe_consequence=consequence_term_ids.get(vep_root.most_severe_consequence),
+        transcript_consequences=vep_root.transcript_consequences.map(
+            lambda c: c.annotate(consequence_terms=c.consequence_terms.map(lambda t: consequence_term_ids[t]))
+        ),
+    )
+
+
+def get_expr_for_decoded_vep_consequence_terms(vep_root, consequence_terms):
+    """Reverse get_expr_for_encoded_vep_consequence_terms.
+
+    Args:
+        vep_root (StructExpression): root path of the encoded VEP struct
+        consequence_terms (ArrayExpression): consequence terms, indexed by their id
+    """
+    return vep_root.annotate(
+        most_severe_consequence=consequence_terms[vep_root.most_severe_consequence],
+        transcript_consequences=vep_root.transcript_consequences.map(
+            lambda c: c.annotate(consequence_terms=c.consequence_terms.map(lambda i: consequence_terms[i]))
+        ),
+    )
+
+
 def get_expr_for_vep_protein_domains_set_from_sorted(vep_sorted_transcript_consequences_root):
     return hl.set(
         vep_sorted_transcript_consequences_root.flatmap(lambda c: c.domains)
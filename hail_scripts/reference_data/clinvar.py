@@ -136,7 +136,6 @@ def download_and_import_latest_clinvar_vcf(
             gcs_tmp_file_name,
             genome_version,
             drop_samples=True,
-            min_partitions=2000,
             skip_invalid_loci=True,
             more_contig_recoding=mt_contig_recoding,
         )
@@ -2,8 +2,6 @@ import hail as hl
 
 from hail_scripts.utils.hail_utils import import_vcf
 
-PARTITIONS = 100
-
 
 def download_and_import_hgmd_vcf(
     hgmd_url: str,
@@ -15,7 +13,6 @@ def download_and_import_hgmd_vcf(
         hgmd_url,
         genome_version=genome_version,
         force=True,
-        min_partitions=PARTITIONS,
         skip_invalid_loci=True,
         force_bgz=False,
     )
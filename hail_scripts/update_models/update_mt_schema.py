@@ -22,8 +22,9 @@ class HGMDSchema(UpdateSchema):
     def hgmd(self):
         if self._hgmd_data is None:
             raise RowAnnotationOmit
-        return hl.struct(**{'accession': self._hgmd_data[self.mt.row_key].rsid,
-                            'class': self._hgmd_data[self.mt.row_key].info.CLASS})
+        hgmd = self._hgmd_data[self.mt.row_key]
+        return hl.struct(**{'accession': hgmd.rsid,
+                            'class': hgmd.info.CLASS})
 
 
 class CLINVARSchema(UpdateSchema):
@@ -34,9 +35,10 @@ class CLINVARSchema(UpdateSchema):
 
     @row_annotation()
     def clinvar(self):
-        return hl.struct(**{'allele_id': self._clinvar_data[self.mt.row_key].info.ALLELEID,
-                            'clinical_significance': hl.delimit(self._clinvar_data[self.mt.row_key].info.CLNSIG),
-                            'gold_stars': self._clinvar_data[self.mt.row_key].gold_stars})
+        clinvar = self._clinvar_data[self.mt.row_key]
+        return hl.struct(**{'allele_id': clinvar.info.ALLELEID,
+                            'clinical_significance': hl.delimit(clinvar.info.CLNSIG),
+                            'gold_stars': clinvar.gold_stars})
 
 
 class CIDRSchema(UpdateSchema):
@@ -49,5 +51,6 @@ class CIDRSchema(UpdateSchema):
     def cidr(self):
         if self._cidr_data is None:
             raise RowAnnotationOmit
-        return hl.struct(**{'AC': self._cidr_data[self.mt.row_key].info.AC[self.mt.a_index-1],
-                            'AF': self._cidr_data[self.mt.row_key].info.AF[self.mt.a_index-1]})
+        cidr = self._cidr_data[self.mt.row_key]
+        return hl.struct(**{'AC': cidr.info.AC[self.mt.a_index-1],
+                            'AF': cidr.info.AF[self.mt.a_index-1]})
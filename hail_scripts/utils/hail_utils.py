@@ -1,7 +1,10 @@
 import hail as hl
+import json
 import logging
+import re
 
 from hail_scripts.computed_fields.variant_id import get_expr_for_variant_ids
+from hail_scripts.utils.partition_planner import plan_partitions, vcf_sample_count
 
 logger = logging.getLogger()
 
@@ -18,6 +21,9 @@ def import_table(
 
     logger.info(f"\n==> import table: {table_path}")
 
+    if min_partitions is None:
+        min_partitions = plan_partitions(table_path).n_partitions
+
     ht = hl.import_table(
         table_path,
         impute=impute,
@@ -48,7 +54,7 @@ def import_vcf(
     :param str vcf_path: MT to annotate with VEP
     :param str genome_version: "37" or "38"
     :param dict more_contig_recoding: add more contig recoding for importing VCF
-    :param int min_partitions: min partitions
+    :param int min_partitions: min partitions, planned from the input size if not given
     :param bool force_bgz: read .gz as a bgzipped file
     :param bool drop_samples: if True, discard genotype info
     :param bool skip_invalid_loci: if True, skip loci that are not consistent with the reference_genome.
@@ -61,6 +67,10 @@ def import_vcf(
 
     logger.info(f"\n==> import vcf: {vcf_path}")
 
+    if min_partitions is None:
+        n_samples = 0 if drop_samples else vcf_sample_count(vcf_path)
+        min_partitions = plan_partitions(vcf_path, n_samples=n_samples, splittable=not force).n_partitions
+
     # add (or remove) "chr" prefix from vcf chroms so they match the reference
     ref = hl.get_reference(f"GRCh{genome_version}")
     contig_recoding = {
@@ -110,18 +120,87 @@ def write_mt(mt_or_ht, output_path: str, overwrite: bool = True):
 write_ht = write_mt  # alias
 
 
+# Types of the `vep_json_schema` of hail VEP configs, which uses the `Struct{a:Array[String]}` syntax.
+VEP_JSON_SCHEMA_TYPES = {
+    'String': hl.tstr,
+    'Int32': hl.tint32,
+    'Int64': hl.tint64,
+    'Float32': hl.tfloat32,
+    'Float64': hl.tfloat64,
+    'Boolean': hl.tbool,
+}
+
+
+def parse_vep_json_schema(vep_json_schema: str) -> hl.HailType:
+    """Hail type of the `vep_json_schema` of a hail VEP config."""
+    schema = re.sub(r'\bStruct\{', 'struct{', vep_json_schema)
+    schema = re.sub(r'\bArray\[', 'array<', schema).replace(']', '>')
+    for name, dtype in VEP_JSON_SCHEMA_TYPES.items():
+        schema = re.sub(rf'([:<]){name}\b', rf'\g<1>{dtype}', schema)
+    return hl.dtype(schema)
+
+
+def format_vep_json_schema(dtype: hl.HailType) -> str:
+    """`vep_json_schema` of a hail VEP config for a hail type, the reverse of parse_vep_json_schema."""
+    if isinstance(dtype, hl.tstruct):
+        return 'Struct{' + ','.join(f'{name}:{format_vep_json_schema(t)}' for name, t in dtype.items()) + '}'
+    if isinstance(dtype, hl.tarray):
+        return f'Array[{format_vep_json_schema(dtype.element_type)}]'
+    return next(name for name, t in VEP_JSON_SCHEMA_TYPES.items() if t == dtype)
+
+
+def prune_vep_type(dtype: hl.HailType, fields: dict) -> hl.HailType:
+    """Keep some fields of a struct or array of structs type.
+
+    :param fields: field name to None to keep the whole field, or to the fields to keep of its structs
+    """
+    if isinstance(dtype, hl.tarray):
+        return hl.tarray(prune_vep_type(dtype.element_type, fields))
+    return hl.tstruct(**{
+        name: dtype[name] if subfields is None else prune_vep_type(dtype[name], subfields)
+        for name, subfields in fields.items() if name in dtype
+    })
+
+
+def prune_vep_expr(expr: hl.expr.Expression, fields: dict) -> hl.expr.Expression:
+    """Keep some fields of a struct or array of structs expression, see prune_vep_type."""
+    if isinstance(expr.dtype, hl.tarray):
+        return expr.map(lambda element: prune_vep_expr(element, fields))
+    return expr.select(**{
+        name: expr[name] if subfields is None else prune_vep_expr(expr[name], subfields)
+        for name, subfields in fields.items() if name in expr
+    })
+
+
+def write_pruned_vep_config(vep_config_json_path: str, fields: dict) -> str:
+    """Write a copy of a hail VEP config that only parses some fields of the VEP output, see prune_vep_type.
+
+    :return: path of the copy
+    """
+    with hl.hadoop_open(vep_config_json_path, 'r') as f:
+        config = json.load(f)
+    vep_type = prune_vep_type(parse_vep_json_schema(config['vep_json_schema']), fields)
+    config['vep_json_schema'] = format_vep_json_schema(vep_type)
+    path = hl.utils.new_temp_file('vep_config', 'json')
+    with hl.hadoop_open(path, 'w') as f:
+        json.dump(config, f)
+    return path
+
+
 def run_vep(
         mt: hl.MatrixTable,
         genome_version: str,
         name: str = 'vep',
         block_size: int = 1000,
-        vep_config_json_path = None) -> hl.MatrixTable:
+        vep_config_json_path = None,
+        vep_fields: dict = None) -> hl.MatrixTable:
     """Runs VEP.
 
     :param MatrixTable mt: MT to annotate with VEP
     :param str genome_version: "37" or "38"
     :param str name: Name for resulting row field
     :param int block_size: Number of rows to process per VEP invocation.
+    :param dict vep_fields: fields of the VEP output to parse, see prune_vep_type. By default, all of them.
     :return: annotated MT
     :rtype: MatrixTable
     """
@@ -132,6 +211,9 @@ def run_vep(
         if genome_version not in ["37", "38"]:
             raise ValueError(f"Invalid genome version: {genome_version}")
         config = "file:///vep_data/vep-gcloud.json"
+    if vep_fields is not None:
+        # The other fields of the VEP JSON output are skipped when it is parsed.
+        config = write_pruned_vep_config(config, vep_fields)
 
     mt = hl.vep(mt, config=config, name=name, block_size=block_size, tolerate_parse_error=True)
 
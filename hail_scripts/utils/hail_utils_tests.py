@@ -0,0 +1,50 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import hail as hl
+
+from hail_scripts.computed_fields.vep import REQUIRED_VEP_FIELDS
+from hail_scripts.utils.hail_utils import (
+    format_vep_json_schema,
+    parse_vep_json_schema,
+    prune_vep_type,
+    write_pruned_vep_config,
+)
+
+VEP_CONFIG_PATH = os.path.join(
+    os.path.dirname(__file__), '../../docker/vep_configs/vep-GRCh38-loftee-mcri_hpc-vep110.json'
+)
+
+
+class VEPJsonSchemaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_parse_and_format(self):
+        with open(VEP_CONFIG_PATH) as f:
+            vep_json_schema = json.load(f)['vep_json_schema']
+        vep_type = parse_vep_json_schema(vep_json_schema)
+        self.assertEqual(vep_type['transcript_consequences'].element_type['consequence_terms'], hl.tarray(hl.tstr))
+        self.assertEqual(vep_type['colocated_variants'].element_type['aa_maf'], hl.tfloat64)
+        self.assertEqual(format_vep_json_schema(vep_type), vep_json_schema)
+
+    def test_write_pruned_vep_config(self):
+        config_path = os.path.join(self.test_dir, 'vep_config.json')
+        shutil.copy(VEP_CONFIG_PATH, config_path)
+        with hl.hadoop_open(write_pruned_vep_config(config_path, REQUIRED_VEP_FIELDS)) as f:
+            config = json.load(f)
+
+        vep_type = parse_vep_json_schema(config['vep_json_schema'])
+        self.assertEqual(list(vep_type), ['most_severe_consequence', 'transcript_consequences'])
+        self.assertEqual(
+            set(vep_type['transcript_consequences'].element_type),
+            set(REQUIRED_VEP_FIELDS['transcript_consequences']),
+        )
+        self.assertEqual(vep_type, prune_vep_type(vep_type, REQUIRED_VEP_FIELDS))
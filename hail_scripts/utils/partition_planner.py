@@ -0,0 +1,161 @@
+"""
+Pick the number of partitions to import a VCF or table with.
+
+Hail splits a block-gzipped (or uncompressed) input into at least `min_partitions` partitions. A fixed count
+is wrong at both ends: small callsets pay thousands of tiny-task overheads while large WGS callsets get
+partitions big enough to spill. The planner sizes partitions from the compressed input size instead,
+keeps enough partitions to use the available cores, and never plans more splits than the file has
+bgzip blocks.
+
+Before VEP, the variants are repartitioned again by estimated VEP cost rather than row count, see
+plan_vep_intervals.
+"""
+import logging
+import math
+import os
+from collections import namedtuple
+
+import hail as hl
+
+logger = logging.getLogger(__name__)
+
+# Compressed bytes per partition. Genotype columns compress several times better than site-only data,
+# so a callset with samples decodes to much more data per compressed byte.
+TARGET_PARTITION_BYTES = 128 * 1024 * 1024
+TARGET_PARTITION_BYTES_WITH_SAMPLES = 32 * 1024 * 1024
+# Below this, the task overhead outweighs the work, even if it leaves cores idle.
+MIN_PARTITION_BYTES = 4 * 1024 * 1024
+# Wide callsets decode to large rows; shrink partitions further per this many samples.
+SAMPLES_PER_PARTITION_STEP = 1000
+# A bgzip file can only be split at block boundaries, and blocks are at most 64KiB compressed.
+BGZF_BLOCK_BYTES = 64 * 1024
+
+# Relative VEP cost of a variant. Indels go through more consequence and HGVS work than substitutions, and
+# long alleles more still.
+VEP_SUBSTITUTION_COST = 1.0
+VEP_INDEL_COST = 2.5
+VEP_COST_PER_ALLELE_BASE = 0.02
+# Sampled variants per planned VEP partition, to place the partition boundaries.
+VEP_COST_SAMPLES_PER_PARTITION = 100
+
+PartitionPlan = namedtuple('PartitionPlan', ['n_partitions', 'input_bytes', 'n_files', 'n_samples', 'cores', 'splittable'])
+
+
+def available_cores():
+    sc = getattr(hl.current_backend(), 'sc', None)
+    return sc.defaultParallelism if sc is not None else os.cpu_count()
+
+
+def input_file_sizes(paths):
+    """
+    :param paths: path, glob, or list of them
+    :return: list of file sizes in bytes
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    return [f['size_bytes'] for path in paths for f in hl.hadoop_ls(path) if not f['is_dir']]
+
+
+def vcf_sample_count(path):
+    """
+    Count the samples in the VCF header without importing the VCF.
+    :param path: VCF path, or a glob of VCFs with the same samples
+    """
+    if '*' in path:
+        path = hl.hadoop_ls(path)[0]['path']
+    with hl.hadoop_open(path, 'r') as f:
+        for line in f:
+            if line.startswith('#CHROM'):
+                return max(len(line.rstrip('\n').split('\t')) - 9, 0)
+            if not line.startswith('#'):
+                break
+    return 0
+
+
+def plan_partitions(paths, n_samples=0, splittable=True, cores=None):
+    """
+    Pick a partition count for importing the given files.
+
+    :param paths: path, glob, or list of them
+    :param n_samples: number of samples (genotype columns) in the input, 0 for site-only data or tables
+    :param splittable: False if the input is read serially, e.g. plain gzip loaded with `force=True`
+    :param cores: cores to fill, defaults to the Spark default parallelism
+    :return: PartitionPlan
+    """
+    sizes = input_file_sizes(paths)
+    input_bytes = sum(sizes)
+    cores = cores or available_cores()
+
+    if not splittable:
+        # Serial reads give one partition per file whatever min_partitions is.
+        n_partitions = max(len(sizes), 1)
+    else:
+        target_bytes = TARGET_PARTITION_BYTES_WITH_SAMPLES if n_samples else TARGET_PARTITION_BYTES
+        target_bytes = max(target_bytes // (1 + n_samples // SAMPLES_PER_PARTITION_STEP), MIN_PARTITION_BYTES)
+        n_partitions = max(
+            math.ceil(input_bytes / target_bytes),
+            min(cores, input_bytes // MIN_PARTITION_BYTES),
+        )
+        max_partitions = sum(math.ceil(size / BGZF_BLOCK_BYTES) for size in sizes)
+        n_partitions = max(min(n_partitions, max_partitions), len(sizes), 1)
+
+    plan = PartitionPlan(n_partitions, input_bytes, len(sizes), n_samples, cores, splittable)
+    logger.info(f'Partition plan: {plan}')
+    return plan
+
+
+def vep_row_cost(alleles):
+    """
+    Estimated relative VEP cost of a variant from its alleles.
+    """
+    ref_length = hl.len(alleles[0])
+    is_indel = hl.any(lambda alt: hl.len(alt) != ref_length, alleles[1:])
+    return (
+        hl.if_else(is_indel, VEP_INDEL_COST, VEP_SUBSTITUTION_COST)
+        + VEP_COST_PER_ALLELE_BASE * hl.sum(alleles.map(hl.len))
+    )
+
+
+def plan_vep_intervals(ht, n_partitions, n_rows=None):
+    """
+    Split a locus/alleles keyed table into partitions of about the same estimated VEP cost, so dense or
+    indel-heavy regions don't make straggler tasks. The boundaries are placed on a sample of the rows.
+
+    :param ht: table keyed by locus and alleles
+    :param n_partitions: number of partitions to plan
+    :param n_rows: rows of the table, if already counted
+    :return: list of locus intervals covering the reference genome, to read the table with, or None for a
+        single partition
+    """
+    n_rows = ht.count() if n_rows is None else n_rows
+    if n_partitions <= 1 or n_rows == 0:
+        return None
+    fraction = min(1.0, n_partitions * VEP_COST_SAMPLES_PER_PARTITION / n_rows)
+    sample = ht.sample(fraction, seed=0)
+    sample = sample.select(cost=vep_row_cost(sample.alleles)).collect()
+    total_cost = sum(row.cost for row in sample)
+
+    reference_genome = ht.locus.dtype.reference_genome
+    first_locus = hl.Locus(reference_genome.contigs[0], 1, reference_genome)
+    boundaries = []
+    cost = 0
+    for row in sample:
+        cost += row.cost
+        if len(boundaries) == n_partitions - 1:
+            break
+        if cost >= total_cost * (len(boundaries) + 1) / n_partitions and \
+                row.locus != (boundaries[-1] if boundaries else first_locus):
+            boundaries.append(row.locus)
+
+    last_contig = reference_genome.contigs[-1]
+    starts = [first_locus] + boundaries
+    ends = boundaries + [hl.Locus(last_contig, reference_genome.lengths[last_contig], reference_genome)]
+    point_type = hl.tstruct(locus=ht.locus.dtype)
+    intervals = [
+        hl.Interval(hl.Struct(locus=start), hl.Struct(locus=end), includes_start=True,
+                    includes_end=i == len(ends) - 1, point_type=point_type)
+        for i, (start, end) in enumerate(zip(starts, ends))
+    ]
+    logger.info(f'VEP partition plan: {len(intervals)} partitions of about {total_cost / len(intervals):.1f} '
+                f'sampled cost each')
+    return intervals
@@ -0,0 +1,75 @@
+import unittest
+from unittest import mock
+
+import hail as hl
+
+from hail_scripts.utils.partition_planner import (
+    MIN_PARTITION_BYTES,
+    TARGET_PARTITION_BYTES,
+    TARGET_PARTITION_BYTES_WITH_SAMPLES,
+    VEP_INDEL_COST,
+    VEP_SUBSTITUTION_COST,
+    plan_partitions,
+    plan_vep_intervals,
+    vep_row_cost,
+)
+
+MB = 1024 * 1024
+
+
+@mock.patch('hail_scripts.utils.partition_planner.input_file_sizes')
+class PartitionPlannerTest(unittest.TestCase):
+
+    def test_small_input_avoids_tiny_partitions(self, mock_sizes):
+        mock_sizes.return_value = [10 * MB]
+        plan = plan_partitions('small.vcf.bgz', n_samples=3, cores=64)
+        self.assertEqual(plan.n_partitions, 10 * MB // MIN_PARTITION_BYTES)
+
+    def test_fills_cores(self, mock_sizes):
+        mock_sizes.return_value = [200 * MB]
+        self.assertEqual(plan_partitions('mid.vcf.bgz', cores=16).n_partitions, 16)
+
+    def test_large_input_sized_by_bytes(self, mock_sizes):
+        mock_sizes.return_value = [100 * TARGET_PARTITION_BYTES_WITH_SAMPLES, 100 * TARGET_PARTITION_BYTES_WITH_SAMPLES]
+        plan = plan_partitions('wgs-*.vcf.bgz', n_samples=100, cores=16)
+        self.assertEqual(plan.n_partitions, 200)
+        self.assertEqual(plan.n_files, 2)
+
+        mock_sizes.return_value = [100 * TARGET_PARTITION_BYTES]
+        self.assertEqual(plan_partitions('sites.vcf.bgz', cores=16).n_partitions, 100)
+
+    def test_wide_callsets_get_smaller_partitions(self, mock_sizes):
+        mock_sizes.return_value = [100 * TARGET_PARTITION_BYTES_WITH_SAMPLES]
+        self.assertEqual(plan_partitions('wide.vcf.bgz', n_samples=1000, cores=16).n_partitions, 200)
+
+    def test_unsplittable_input(self, mock_sizes):
+        mock_sizes.return_value = [500 * MB]
+        self.assertEqual(plan_partitions('hgmd.vcf.gz', splittable=False, cores=16).n_partitions, 1)
+
+    def test_empty_input(self, mock_sizes):
+        mock_sizes.return_value = [100]
+        self.assertEqual(plan_partitions('tiny.vcf.bgz', cores=16).n_partitions, 1)
+
+
+class VEPPartitionPlannerTest(unittest.TestCase):
+
+    def test_vep_row_cost(self):
+        self.assertLess(hl.eval(vep_row_cost(hl.literal(['A', 'C']))), VEP_INDEL_COST)
+        self.assertGreater(hl.eval(vep_row_cost(hl.literal(['A', 'C']))), VEP_SUBSTITUTION_COST)
+        self.assertGreater(hl.eval(vep_row_cost(hl.literal(['A', 'ACGT']))), VEP_INDEL_COST)
+
+    def test_plan_vep_intervals(self):
+        # Half of the rows are long indels on chr1, half are SNVs on chr2.
+        ht = hl.utils.range_table(2000)
+        ht = ht.key_by(
+            locus=hl.locus(hl.if_else(ht.idx < 1000, '1', '2'), ht.idx % 1000 + 1),
+            alleles=hl.if_else(ht.idx < 1000, ['A', 'A' + 'C' * 50], ['A', 'C']),
+        )
+        self.assertIsNone(plan_vep_intervals(ht, 1))
+
+        intervals = plan_vep_intervals(ht, 4)
+        self.assertEqual(intervals[0].start.locus, hl.Locus('1', 1))
+        self.assertEqual(intervals[-1].end.locus.contig, hl.get_reference('GRCh37').contigs[-1])
+        self.assertTrue(intervals[-1].includes_end)
+        # The costlier chr1 rows get more of the partitions.
+        self.assertGreater(sum(interval.start.locus.contig == '1' for interval in intervals), 2)
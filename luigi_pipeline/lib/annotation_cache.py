@@ -0,0 +1,153 @@
+"""
+Persistent cross-callset cache of variant row annotations.
+
+The cache is a set of Hail tables keyed by locus/alleles holding the cacheable row annotations of a schema
+class (see `row_annotation(cacheable=True)`). Each combination of reference data, VEP and annotation code
+versions gets its own directory under the cache directory, so changing any of them starts a fresh cache
+instead of mixing annotations computed from different inputs.
+
+Each load appends a part table with the rows it added, and the parts are unioned when the cache is read, so
+updating the cache costs the size of the load rather than of the cache. Past MAX_PARTS, the parts are
+compacted into one table.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+
+import hail as hl
+
+logger = logging.getLogger(__name__)
+
+ANNOTATION_CACHE_KEY = ('locus', 'alleles')
+# Number of part tables in a cache directory above which they are merged into one, so reads don't union many tables.
+MAX_PARTS = 20
+
+
+def table_version(ht):
+    """
+    Summarise a reference table's version as the JSON of its globals, e.g. the clinvar release.
+    :param ht: Hail table or None
+    :return: JSON string or None
+    """
+    if ht is None:
+        return None
+    return hl.eval(hl.json(ht.globals))
+
+
+def part_table_paths(path):
+    """
+    :param path: directory of part tables
+    :return: paths of the complete part tables in the directory, oldest first. A cache written as a single table
+        at `<directory>.ht` is read as the first part.
+    """
+    paths = [f'{path}.ht'] if hl.hadoop_exists(os.path.join(f'{path}.ht', '_SUCCESS')) else []
+    if hl.hadoop_exists(path):
+        paths.extend(sorted(
+            entry['path'] for entry in hl.hadoop_ls(path)
+            if entry['is_dir'] and hl.hadoop_exists(os.path.join(entry['path'], '_SUCCESS'))
+        ))
+    return paths
+
+
+def new_part_table_path(path):
+    return os.path.join(path, f'{time.strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:8]}.ht')
+
+
+def read_part_tables(part_paths):
+    """
+    :return: union of the part tables, with the globals of the first one, or None if there are none
+    """
+    if not part_paths:
+        return None
+    tables = [hl.read_table(part_path) for part_path in part_paths]
+    return tables[0].union(*tables[1:]) if len(tables) > 1 else tables[0]
+
+
+def compact_part_tables(path, part_paths):
+    """
+    Merge the part tables of the directory into one part table, then remove them.
+    :return: paths of the part tables after compaction
+    """
+    compacted_path = new_part_table_path(path)
+    read_part_tables(part_paths).write(compacted_path)
+    fs = hl.current_backend().fs
+    for part_path in part_paths:
+        fs.rmtree(part_path)
+    logger.info(f'Compacted {len(part_paths)} tables into {compacted_path}')
+    return [compacted_path]
+
+
+class AnnotationCache:
+
+    def __init__(self, cache_path, version_info):
+        """
+        :param cache_path: directory holding one directory of part tables per version
+        :param version_info: json-serializable dict describing the reference data, VEP and schema versions
+        """
+        self.version_info = version_info
+        self.version = hashlib.sha256(json.dumps(version_info, sort_keys=True).encode()).hexdigest()[:16]
+        self.path = os.path.join(cache_path, self.version)
+
+    def exists(self):
+        return bool(part_table_paths(self.path))
+
+    def read(self):
+        """
+        :return: the cache table for this version, or None if nothing has been cached yet.
+        """
+        cache_ht = read_part_tables(part_table_paths(self.path))
+        if cache_ht is None:
+            logger.info(f'No annotation cache at {self.path}')
+            return None
+        logger.info(f'Using annotation cache {self.path}')
+        return cache_ht
+
+    @staticmethod
+    def split(mt, cache_ht):
+        """
+        Split the MT into the rows missing from the cache and the rows annotated from the cache.
+        :param mt: MT keyed by locus/alleles
+        :param cache_ht: table returned by `read` or None
+        :return: (uncached_mt, cached_mt), cached_mt is None when the cache is empty
+        """
+        if tuple(mt.row_key) != ANNOTATION_CACHE_KEY:
+            raise ValueError(f'Annotation cache requires rows keyed by {ANNOTATION_CACHE_KEY}, got {tuple(mt.row_key)}')
+        if cache_ht is None:
+            return mt, None
+        return mt.anti_join_rows(cache_ht), AnnotationCache.restore(mt, cache_ht)
+
+    @staticmethod
+    def restore(mt, cache_ht):
+        """
+        Filter the MT to the cached rows and annotate them with the cached annotations.
+        """
+        mt = mt.semi_join_rows(cache_ht)
+        return mt.annotate_rows(**cache_ht[mt.row_key])
+
+    def update(self, ht, fields):
+        """
+        Append the rows of an annotated table that are not yet cached.
+        :param ht: annotated rows table keyed by locus/alleles, e.g. the rows of the written MT
+        :param fields: cacheable fields to store
+        """
+        ht = ht.select(*[f for f in fields if f in ht.row]).select_globals(
+            cache_version=hl.literal(json.dumps(self.version_info, sort_keys=True)))
+        part_paths = part_table_paths(self.path)
+        cache_ht = read_part_tables(part_paths)
+        if cache_ht is not None:
+            ht = ht.anti_join(cache_ht)
+
+        part_path = new_part_table_path(self.path)
+        ht.write(part_path)
+        # The row count of a written table is in its metadata.
+        if hl.read_table(part_path).count() == 0:
+            hl.current_backend().fs.rmtree(part_path)
+            logger.info(f'No new rows for the annotation cache {self.path}')
+            return
+        logger.info(f'Added {part_path} to the annotation cache')
+        part_paths.append(part_path)
+        if len(part_paths) > MAX_PARTS:
+            compact_part_tables(self.path, part_paths)
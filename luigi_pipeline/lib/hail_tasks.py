@@ -12,10 +12,13 @@ import luigi
 from luigi.contrib import gcs
 from luigi.parameter import ParameterVisibility
 
+from hail_scripts.computed_fields.vep import REQUIRED_VEP_FIELDS
 from hail_scripts.elasticsearch.hail_elasticsearch_client import HailElasticsearchClient
+from hail_scripts.utils.partition_planner import plan_partitions, vcf_sample_count
 
 import luigi_pipeline.lib.hail_vep_runners as vep_runners
 from luigi_pipeline.lib.global_config import GlobalConfig
+from luigi_pipeline.lib.run_report import RunReport, report_stage, run_report_path
 
 logger = logging.getLogger(__name__)
 
@@ -47,10 +50,26 @@ class HailMatrixTableTask(luigi.Task):
     source_paths = luigi.Parameter(description='Path or list of paths of VCFs to be loaded.')
     dest_path = luigi.Parameter(description='Path to write the matrix table.')
     genome_version = luigi.Parameter(description='Reference Genome Version (37 or 38)')
-    vep_runner = luigi.ChoiceParameter(choices=['VEP', 'DUMMY'], default='VEP', description='Choice of which vep runner'
-                                                                                            'to annotate vep.')
+    vep_runner = luigi.ChoiceParameter(choices=['VEP', 'DUMMY', 'LOCAL_POOL'], default='VEP',
+                                       description='Choice of which vep runner to annotate vep. LOCAL_POOL runs a pool '
+                                                   'of VEP processes on the local node, outside of Spark.')
+    vep_cache_path = luigi.OptionalParameter(default=None, description='Directory of the persistent VEP results cache. '
+                                                                       'VEP only runs on variants missing from the cache.')
+    vep_two_tier = luigi.BoolParameter(description='Run VEP without LOFTEE, then with LOFTEE only on the putative '
+                                                   'loss-of-function variants. Requires a LOFTEE vep_config_json_path.')
+    vep_balance_partitions = luigi.BoolParameter(description='Repartition the variants by estimated VEP cost before '
+                                                             'VEP, and fit the VEP block size to its measured latency.')
+    vep_prune_fields = luigi.BoolParameter(description='Only parse the fields of the VEP output that the annotations '
+                                                       'read, see REQUIRED_VEP_FIELDS, to keep the vep row field small.')
     ignore_missing_samples_when_remapping = luigi.BoolParameter(default=False, description='Allow missing samples in the callset when remapping ids')
     ignore_missing_samples_when_subsetting = luigi.BoolParameter(default=False, description='Allow missing samples in the callset when subsetting to a selection of ids')
+    checkpoint_path = luigi.OptionalParameter(default=None, description='Directory for stage checkpoints. A re-run with the same '
+                                                                         'parameters resumes from the latest completed stage.')
+    checkpoint_stages = luigi.ListParameter(default=[], description='Names of the stages to checkpoint.')
+    # Ordered names of the stages that can be checkpointed, see checkpoint_stage.
+    CHECKPOINT_STAGES = ()
+    # Report of the current run, see new_run_report.
+    _run_report = None
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -79,7 +98,7 @@ class HailMatrixTableTask(luigi.Task):
         mt.write(self.output().path)
 
     def import_vcf(self):
-        # Import the VCFs from inputs. Set min partitions so that local pipeline execution takes advantage of all CPUs.
+        # Import the VCFs from inputs. Min partitions are planned from the input size and the available CPUs.
         recode = {}
         if self.genome_version == "38":
             recode = {f"{i}": f"chr{i}" for i in (list(range(1, 23)) + ['X', 'Y'])}
@@ -91,41 +110,197 @@ class HailMatrixTableTask(luigi.Task):
                              skip_invalid_loci=True,
                              contig_recoding=recode,
                              array_elements_required=False,
-                             force_bgz=True, min_partitions=500)
+                             force_bgz=True, min_partitions=self.import_partitions())
+
+    def import_partitions(self):
+        n_samples = vcf_sample_count(self.source_paths[0])
+        return plan_partitions(self.source_paths, n_samples=n_samples).n_partitions
+
+    def new_run_report(self):
+        """
+        Start the JSON run report written next to the output MT.
+        """
+        self._run_report = RunReport(self.task_id, run_report_path(self.dest_path),
+                                     self.to_str_params(only_significant=True, only_public=True))
+        return self._run_report
+
+    def _checkpoint_stage_path(self, stage):
+        return os.path.join(self.checkpoint_path, f'{stage}.mt')
+
+    def checkpoint_fingerprint(self):
+        """
+        Parameters a checkpoint was written with. A checkpoint is only resumed from if they are unchanged.
+        """
+        return self.to_str_params(only_significant=True)
+
+    def is_checkpointed(self, stage):
+        return bool(self.checkpoint_path) and stage in self.checkpoint_stages
+
+    def checkpoint_stage(self, mt, stage):
+        """
+        Write the MT of a completed stage, if checkpointing is enabled for it.
+        :param mt: MT at the end of the stage
+        :param stage: stage name from CHECKPOINT_STAGES
+        :return: MT read back from the checkpoint or the input MT
+        """
+        if not self.is_checkpointed(stage):
+            return mt
+        path = self._checkpoint_stage_path(stage)
+        logger.info(f'Checkpointing stage {stage} to {path}')
+        mt = mt.checkpoint(path, overwrite=True)
+        with hl.hadoop_open(f'{path}.json', 'w') as f:
+            json.dump(self.checkpoint_fingerprint(), f, sort_keys=True)
+        return mt
+
+    def read_checkpoint(self, stage):
+        """
+        :return: the MT checkpointed for the stage, or None if there is no complete checkpoint for these parameters.
+        """
+        if not self.is_checkpointed(stage):
+            return None
+        path = self._checkpoint_stage_path(stage)
+        if not (hl.hadoop_exists(os.path.join(path, '_SUCCESS')) and hl.hadoop_exists(f'{path}.json')):
+            return None
+        with hl.hadoop_open(f'{path}.json') as f:
+            if json.load(f) != self.checkpoint_fingerprint():
+                logger.warning(f'Ignoring checkpoint {path} written with different parameters')
+                return None
+        return hl.read_matrix_table(path)
+
+    def latest_checkpoint(self):
+        """
+        Find the latest completed stage to resume from.
+        :return: (stage, MT) or (None, None)
+        """
+        for stage in reversed(self.CHECKPOINT_STAGES):
+            mt = self.read_checkpoint(stage)
+            if mt is not None:
+                logger.info(f'Resuming after stage {stage}')
+                return stage, mt
+        return None, None
+
+    def remove_checkpoints(self):
+        if not self.checkpoint_path:
+            return
+        fs = hl.current_backend().fs
+        for stage in self.CHECKPOINT_STAGES:
+            path = self._checkpoint_stage_path(stage)
+            if hl.hadoop_exists(path):
+                fs.rmtree(path)
+            if hl.hadoop_exists(f'{path}.json'):
+                fs.remove(f'{path}.json')
 
     @staticmethod
-    def sample_type_stats(mt, genome_version, threshold=0.3):
+    def sample_partitions(mt, sample_fraction):
         """
-        Calculate stats for sample type by checking against a list of common coding and non-coding variants.
-        If the match for each respective type is over the threshold, we return a match.
+        Keep evenly spaced partitions so that every large enough contig is still represented.
+        :param sample_fraction: fraction of the partitions to keep, rounded up to a whole partition
+        :return: (sampled MT, fraction of partitions kept)
+        """
+        n_partitions = mt.n_partitions()
+        # Rounded first so float error, e.g. 100 * 0.07 = 7.000000000000001, doesn't add a partition.
+        n_sampled = min(n_partitions, math.ceil(round(n_partitions * sample_fraction, 6)))
+        partitions = [i * n_partitions // n_sampled for i in range(n_sampled)]
+        logger.info(f'Sampling {len(partitions)} out of {n_partitions} partitions')
+        return mt._filter_partitions(partitions), len(partitions) / n_partitions
+
+    @staticmethod
+    def validation_stats(mt, genome_version, contigs=None, sample_fraction=None):
+        """
+        Count the rows per contig and the matches to the common coding and non-coding variants in a single pass
+        over the MT. The common variants are small tables, so they are broadcast as sets.
 
         :param mt: Matrix Table to check
         :param genome_version: reference genome version
-        :param threshold: if the matched percentage is over this threshold, we classify as match
-        :return: a dict of coding/non-coding to dict with 'matched_count', 'total_count' and 'match' boolean.
+        :param contigs: only count the common variants on these contigs
+        :param sample_fraction: if set, only read this fraction of the partitions and scale the counts up
+        :return: dict with 'contig_counts', 'sampled' and, for coding/non-coding, a dict with 'matched_count' and
+            'total_count'.
         """
-        stats = {}
         types_to_ht_path = {
             'noncoding': GlobalConfig().param_kwargs[f'validation_{genome_version}_noncoding_ht'],
             'coding': GlobalConfig().param_kwargs[f'validation_{genome_version}_coding_ht']
         }
+        variant_sets = {}
+        total_counts = {}
         for sample_type, ht_path in types_to_ht_path.items():
             ht = hl.read_table(ht_path)
-            stats[sample_type] = ht_stats = {
-                'matched_count': mt.semi_join_rows(ht).count_rows(),
-                'total_count': ht.count(),
-
+            if contigs:
+                ht = hl.filter_intervals(ht, [
+                    hl.parse_locus_interval(contig, reference_genome=ht.locus.dtype.reference_genome)
+                    for contig in contigs
+                ])
+            variants = ht.aggregate(hl.agg.collect_as_set(ht.key))
+            variant_sets[sample_type] = hl.literal(variants, dtype=hl.tset(ht.key.dtype))
+            total_counts[sample_type] = len(variants)
+
+        sampled_fraction = 1
+        if sample_fraction and sample_fraction < 1:
+            mt, sampled_fraction = HailMatrixTableTask.sample_partitions(mt, sample_fraction)
+
+        row_key = hl.struct(locus=mt.locus, alleles=mt.alleles)
+        counts = mt.aggregate_rows(hl.struct(
+            contig_counts=hl.agg.counter(mt.locus.contig),
+            **{sample_type: hl.agg.count_where(variant_set.contains(row_key))
+               for sample_type, variant_set in variant_sets.items()},
+        ))
+
+        # Counts from sampled partitions are estimates for the whole callset.
+        stats = {
+            'contig_counts': {contig: round(count / sampled_fraction) for contig, count in counts.contig_counts.items()},
+            'sampled': sampled_fraction < 1,
+        }
+        for sample_type, total_count in total_counts.items():
+            stats[sample_type] = {
+                'matched_count': min(round(counts[sample_type] / sampled_fraction), total_count),
+                'total_count': total_count,
             }
-            ht_stats['match'] = (ht_stats['matched_count']/ht_stats['total_count']) >= threshold
         return stats
 
-    def run_vep(mt, genome_version, runner='VEP', vep_config_json_path=None):
+    @staticmethod
+    def sample_type_stats(mt, genome_version, threshold=0.3, contigs=None, validation_stats=None):
+        """
+        Calculate stats for sample type by checking against a list of common coding and non-coding variants.
+        If the match for each respective type is over the threshold, we return a match.
+
+        :param mt: Matrix Table to check
+        :param genome_version: reference genome version
+        :param threshold: if the matched percentage is over this threshold, we classify as match
+        :param contigs: only count the common variants on these contigs
+        :param validation_stats: result of `validation_stats` if it was already computed
+        :return: a dict of coding/non-coding to dict with 'matched_count', 'total_count' and 'match' boolean.
+        """
+        if validation_stats is None:
+            validation_stats = HailMatrixTableTask.validation_stats(mt, genome_version, contigs=contigs)
+        stats = {}
+        for sample_type in ['noncoding', 'coding']:
+            stats[sample_type] = ht_stats = dict(validation_stats[sample_type])
+            ht_stats['match'] = ht_stats['total_count'] > 0 and \
+                (ht_stats['matched_count']/ht_stats['total_count']) >= threshold
+        return stats
+
+    def run_vep(mt, genome_version, runner='VEP', vep_config_json_path=None, vep_cache_path=None, vep_two_tier=False,
+                vep_balance_partitions=False, vep_prune_fields=False):
         runners = {
             'VEP': vep_runners.HailVEPRunner,
-            'DUMMY': vep_runners.HailVEPDummyRunner
+            'DUMMY': vep_runners.HailVEPDummyRunner,
+            'LOCAL_POOL': vep_runners.HailVEPLocalPoolRunner,
         }
 
-        return runners[runner]().run(mt, genome_version, vep_config_json_path=vep_config_json_path)
+        vep_runner = runners[runner]()
+        if vep_prune_fields:
+            vep_runner.required_fields = REQUIRED_VEP_FIELDS
+            # Pruned results have another type, so they are cached apart.
+            vep_cache_path = os.path.join(vep_cache_path, 'pruned') if vep_cache_path else None
+        if vep_balance_partitions:
+            vep_runner = vep_runners.HailVEPBalancedRunner(vep_runner)
+        if vep_two_tier:
+            vep_runner = vep_runners.HailVEPTwoTierRunner(vep_runner)
+            # Two-tier results have no LOFTEE fields for most variants, so they are cached apart.
+            vep_cache_path = os.path.join(vep_cache_path, 'two_tier') if vep_cache_path else None
+        if vep_cache_path:
+            vep_runner = vep_runners.HailVEPCacheRunner(vep_runner, vep_cache_path)
+        return vep_runner.run(mt, genome_version, vep_config_json_path=vep_config_json_path)
 
     def relevant_variant_filter_fn(self, mt):
         return mt.GT.is_non_ref()
@@ -210,20 +385,27 @@ class HailMatrixTableTask(luigi.Task):
         return mt
 
 
-    def generate_callstats(self, mt):
+    def generate_callstats(self, mt, drop_monomorphic=False):
         """
         Generate call statistics for all variants in the dataset.
 
         :param mt: MatrixTable to generate call statistics on.
+        :param drop_monomorphic: drop the variants without any non-ref call, including the all no-call variants.
+            The filter only reads the call statistics, so it is computed in the same pass over the entries.
         :return: Matrixtable with gt_stats annotation.
         """
-        return mt.annotate_rows(gt_stats=hl.agg.call_stats(mt.GT, mt.alleles))
+        mt = mt.annotate_rows(gt_stats=hl.agg.call_stats(mt.GT, mt.alleles))
+        if drop_monomorphic:
+            mt = mt.filter_rows(mt.gt_stats.AC[1:].any(lambda ac: ac > 0))
+        return mt
         
 
 class HailElasticSearchTask(luigi.Task):
     """
     Loads a MT to ES (TODO).
     """
+    # Report of the current run, see new_run_report.
+    _run_report = None
     source_path = luigi.OptionalParameter(default=None)
     use_temp_loading_nodes = luigi.BoolParameter(default=True, description='Whether to use temporary loading nodes.')
     es_host = luigi.Parameter(description='ElasticSearch host.', default='localhost')
@@ -253,16 +435,31 @@ class HailElasticSearchTask(luigi.Task):
     def import_mt(self):
         return hl.read_matrix_table(self.input()[0].path)
 
-    def export_table_to_elasticsearch(self, table, num_shards, disabled_fields=None):
+    def new_run_report(self, output_path):
+        """
+        Start the JSON run report written next to the exported MT.
+        """
+        self._run_report = RunReport(self.task_id, run_report_path(output_path, 'es_run_report'),
+                                     self.to_str_params(only_significant=True, only_public=True))
+        return self._run_report
+
+    def export_table_to_elasticsearch(self, table, num_shards, disabled_fields=None, num_docs=None):
+        """
+        :param num_docs: number of rows of the table, if known, to report the export rate
+        """
         func_to_run_after_index_exists = None if not self.use_temp_loading_nodes else \
             lambda: self._es.route_index_to_temp_es_cluster(self.es_index)
-        self._es.export_table_to_elasticsearch(table,
-                                               index_name=self.es_index,
-                                               disable_index_for_fields=disabled_fields,
-                                               func_to_run_after_index_exists=func_to_run_after_index_exists,
-                                               elasticsearch_mapping_id="docId",
-                                               num_shards=num_shards,
-                                               write_null_values=True)
+        with report_stage(self._run_report, 'export') as stage_report:
+            self._es.export_table_to_elasticsearch(table,
+                                                   index_name=self.es_index,
+                                                   disable_index_for_fields=disabled_fields,
+                                                   func_to_run_after_index_exists=func_to_run_after_index_exists,
+                                                   elasticsearch_mapping_id="docId",
+                                                   num_shards=num_shards,
+                                                   write_null_values=True)
+        if self._run_report and num_docs is not None:
+            stage_report.update(docs=num_docs, num_shards=num_shards,
+                                docs_per_second=round(num_docs / max(stage_report['seconds'], 0.001), 1))
 
     def cleanup(self, es_shards):
         self._es.route_index_off_temp_es_cluster(self.es_index)
@@ -1,21 +1,355 @@
+import copy
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 
 import hail as hl
 
+from hail_scripts.computed_fields.vep import CONSEQUENCE_TERM_RANK_LOOKUP
 from hail_scripts.utils import hail_utils
+from hail_scripts.utils.partition_planner import available_cores, plan_vep_intervals
+
+from luigi_pipeline.lib.annotation_cache import (
+    MAX_PARTS,
+    compact_part_tables,
+    new_part_table_path,
+    part_table_paths,
+    read_part_tables,
+)
+
+logger = logging.getLogger(__name__)
 
 
 class HailVEPRunnerBase(ABC):
+    # Fields of the VEP output to keep, see hail_utils.prune_vep_type, or None for all of them. The other fields are
+    # dropped when the VEP output is parsed.
+    required_fields = None
 
     @abstractmethod
-    def run(self, mt, genome_version):
+    def run(self, mt, genome_version, vep_config_json_path=None):
         pass
 
 
 class HailVEPRunner(HailVEPRunnerBase):
 
+    def __init__(self, block_size=1000):
+        """
+        :param block_size: number of variants piped to each VEP process
+        """
+        self.block_size = block_size
+
     def run(self, mt, genome_version, vep_config_json_path=None):
-        return hail_utils.run_vep(mt, genome_version, vep_config_json_path=vep_config_json_path)
+        return hail_utils.run_vep(mt, genome_version, block_size=self.block_size,
+                                  vep_config_json_path=vep_config_json_path, vep_fields=self.required_fields)
+
+
+class HailVEPCacheRunner(HailVEPRunnerBase):
+    """ Runs VEP through another runner, but only on the variants missing from a persistent table of VEP results.
+
+    The cache is a set of Hail tables keyed by locus/alleles with a single `vep` field, unioned when it is read.
+    There is one directory of tables per VEP config (or per genome version for the default config) under
+    `cache_path`, so results from different VEP versions are never mixed. Each run that has misses adds a table
+    with their results, see lib/annotation_cache.py for the layout.
+    """
+
+    def __init__(self, runner, cache_path):
+        self.runner = runner
+        self.cache_path = cache_path
+
+    def cache_table_path(self, genome_version, vep_config_json_path=None):
+        """
+        :return: (directory of the cache tables for the VEP config, VEP config name)
+        """
+        vep_config = vep_config_json_path or f'default-GRCh{genome_version}'
+        return os.path.join(self.cache_path, hashlib.sha256(vep_config.encode()).hexdigest()[:16]), vep_config
+
+    def run(self, mt, genome_version, vep_config_json_path=None):
+        path, vep_config = self.cache_table_path(genome_version, vep_config_json_path)
+        part_paths = part_table_paths(path)
+        cache_ht = read_part_tables(part_paths)
+
+        misses = mt.rows().select()
+        if cache_ht is not None:
+            misses = misses.anti_join(cache_ht)
+        # The keys of the misses are written once, so counting them doesn't compute the MT again.
+        misses = misses.checkpoint(hl.utils.new_temp_file('vep_cache_misses', 'ht'))
+        n_misses = misses.count()
+        logger.info(f'{n_misses} variants missing from the VEP cache {path}')
+
+        if n_misses or cache_ht is None:
+            vep_mt = self.runner.run(hl.MatrixTable.from_rows_table(misses), genome_version,
+                                     vep_config_json_path=vep_config_json_path)
+            # Runner globals, e.g. gencodeVersion, are kept with the results for the runs without misses.
+            runner_globals = vep_mt.globals.drop(*[k for k in vep_mt.globals if k in mt.globals])
+            part_path = new_part_table_path(path)
+            vep_mt.rows().select('vep').select_globals(vep_config=vep_config, **runner_globals).write(part_path)
+            logger.info(f'Added {part_path} to the VEP cache')
+            part_paths.append(part_path)
+            if len(part_paths) > MAX_PARTS:
+                part_paths = compact_part_tables(path, part_paths)
+            cache_ht = read_part_tables(part_paths)
+
+        # Globals of the latest results, e.g. gencodeVersion.
+        latest_globals = hl.read_table(part_paths[-1]).globals
+        runner_globals = hl.eval(latest_globals.drop(*[k for k in latest_globals if k == 'vep_config' or k in mt.globals]))
+        mt = mt.annotate_globals(**runner_globals)
+        return mt.annotate_rows(vep=cache_ht[mt.row_key].vep)
+
+
+class HailVEPLocalPoolRunner(HailVEPRunnerBase):
+    """ Runs VEP outside of Spark on a single node, e.g. an HPC node without a VEP-enabled cluster.
+
+    The variants are exported to VCF chunks on local disk and a pool of VEP processes, each using `--fork`
+    worker processes, annotates the chunks in parallel. The JSON output of each chunk is streamed to a file,
+    and the files are read back into a table keyed by locus/alleles. The `command`, `env` and `vep_json_schema`
+    of the hail VEP config are used, so the same `vep-*-mcri_hpc-*.json` configs work with this runner.
+    """
+
+    def __init__(self, fork=4, workers=None, chunk_size=20000, local_tmp_dir=None):
+        """
+        :param fork: `--fork` of each VEP process
+        :param workers: number of concurrent VEP processes, by default enough to use all cores of the node
+        :param chunk_size: number of variants per VCF chunk
+        :param local_tmp_dir: local directory for the VCF chunks and VEP output, readable by the VEP processes
+        """
+        self.fork = fork
+        self.workers = workers or max(1, (os.cpu_count() or 1) // fork)
+        self.chunk_size = chunk_size
+        self.local_tmp_dir = local_tmp_dir
+
+    @staticmethod
+    def read_config(vep_config_json_path):
+        with hl.hadoop_open(vep_config_json_path, 'r') as f:
+            return json.load(f)
+
+    def vep_command(self, config, input_path):
+        command = ['--json' if arg == '__OUTPUT_FORMAT_FLAG__' else arg for arg in config['command']]
+        return command + ['--input_file', input_path, '--fork', str(self.fork)]
+
+    def run_chunk(self, config, input_path, output_path):
+        env = {**os.environ, **config.get('env', {})}
+        with open(output_path, 'w') as output:
+            subprocess.run(self.vep_command(config, input_path), env=env, stdout=output, check=True)
+        return output_path
+
+    def run(self, mt, genome_version, vep_config_json_path=None):
+        if vep_config_json_path is None:
+            raise ValueError('The local pool VEP runner requires a vep_config_json_path')
+        config = self.read_config(vep_config_json_path)
+        vep_type = hail_utils.parse_vep_json_schema(config['vep_json_schema'])
+        if self.required_fields is not None:
+            # The input line keys the results.
+            vep_type = hail_utils.prune_vep_type(vep_type, {**self.required_fields, 'input': None})
+
+        ht = mt.rows().select()
+        n_chunks = max(self.workers, math.ceil(ht.count() / self.chunk_size))
+        tmp_dir = tempfile.mkdtemp(prefix='vep_pool_', dir=self.local_tmp_dir)
+        try:
+            input_dir = os.path.join(tmp_dir, 'input.vcf.bgz')
+            hl.export_vcf(ht.repartition(n_chunks), f'file://{input_dir}', parallel='header_per_shard')
+            output_dir = os.path.join(tmp_dir, 'output')
+            os.makedirs(output_dir)
+            chunks = sorted(f for f in os.listdir(input_dir) if f.startswith('part-'))
+            logger.info(f'Running VEP on {len(chunks)} chunks with {self.workers} processes of {self.fork} forks')
+            # The VEP processes do the work, so threads are enough to wait on them.
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                list(pool.map(
+                    lambda chunk: self.run_chunk(
+                        config, os.path.join(input_dir, chunk), os.path.join(output_dir, f'{chunk}.json')),
+                    chunks,
+                ))
+
+            vep_ht = hl.import_lines(f'file://{output_dir}/*.json')
+            vep_ht = vep_ht.select(vep=hl.parse_json(vep_ht.text, vep_type))
+            # VEP echoes the input VCF line, which keys the result back to the variant.
+            input_fields = vep_ht.vep.input.split('\t')
+            reference_genome = mt.locus.dtype.reference_genome
+            vep_ht = vep_ht.key_by(
+                locus=hl.locus(input_fields[0], hl.int(input_fields[1]), reference_genome=reference_genome),
+                alleles=hl.array([input_fields[3]]).extend(input_fields[4].split(',')),
+            )
+            if self.required_fields is not None and 'input' not in self.required_fields:
+                vep_ht = vep_ht.annotate(vep=vep_ht.vep.drop('input'))
+            # Materialize before the local files are removed.
+            vep_ht = vep_ht.distinct().checkpoint(hl.utils.new_temp_file('vep_pool', 'ht'))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        mt = mt.annotate_globals(gencodeVersion="unknown")
+        return mt.annotate_rows(vep=vep_ht[mt.row_key].vep)
+
+
+class HailVEPTwoTierRunner(HailVEPRunnerBase):
+    """ Runs VEP through another runner without the LOFTEE plugin, then again with LOFTEE only on the putative
+    loss-of-function variants, whose most severe consequence is at least as severe as `frameshift_variant`.
+
+    The lof, lof_filter, lof_flags and lof_info fields are only meaningful for these variants, and LOFTEE is a
+    large part of the VEP run time. Both passes share the `vep_json_schema` of the LOFTEE config, so the result
+    has the usual vep struct, with the LOFTEE fields missing for the other variants.
+    """
+
+    LOF_PLUGIN = 'LoF'
+    LOF_CONSEQUENCE_RANK = CONSEQUENCE_TERM_RANK_LOOKUP.get('frameshift_variant')
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    @classmethod
+    def without_lof_plugin(cls, command):
+        """
+        VEP command line without the LOFTEE `--plugin LoF,...` argument.
+        """
+        plain_command = []
+        skip_next = False
+        for i, arg in enumerate(command):
+            if skip_next:
+                skip_next = False
+            elif arg == '--plugin' and i + 1 < len(command) and command[i + 1].split(',')[0] == cls.LOF_PLUGIN:
+                skip_next = True
+            elif not arg.startswith(f'--plugin {cls.LOF_PLUGIN},'):
+                plain_command.append(arg)
+        return plain_command
+
+    def write_plain_config(self, vep_config_json_path):
+        with hl.hadoop_open(vep_config_json_path, 'r') as f:
+            config = json.load(f)
+        config['command'] = self.without_lof_plugin(config['command'])
+        path = hl.utils.new_temp_file('vep_config', 'json')
+        with hl.hadoop_open(path, 'w') as f:
+            json.dump(config, f)
+        return path
+
+    def run(self, mt, genome_version, vep_config_json_path=None):
+        if vep_config_json_path is None:
+            raise ValueError('The two-tier VEP runner requires a vep_config_json_path with the LOFTEE plugin')
+        # Runners are lazy, so the plain pass is materialized once and both the LOFTEE candidates and the merge
+        # read it, rather than running it again for each.
+        plain_mt = self.runner.run(hl.MatrixTable.from_rows_table(mt.rows().select()), genome_version,
+                                   vep_config_json_path=self.write_plain_config(vep_config_json_path))
+        plain_ht = plain_mt.rows().select('vep').checkpoint(hl.utils.new_temp_file('vep_plain', 'ht'))
+
+        lof_candidates = plain_ht.filter(
+            CONSEQUENCE_TERM_RANK_LOOKUP.get(plain_ht.vep.most_severe_consequence) <= self.LOF_CONSEQUENCE_RANK
+        ).select()
+        lof_candidates = lof_candidates.checkpoint(hl.utils.new_temp_file('vep_lof_candidates', 'ht'))
+        logger.info(f'Running VEP with LOFTEE on {lof_candidates.count()} putative loss-of-function variants')
+        lof_mt = self.runner.run(hl.MatrixTable.from_rows_table(lof_candidates), genome_version,
+                                 vep_config_json_path=vep_config_json_path)
+        lof_ht = lof_mt.rows().select('vep').checkpoint(hl.utils.new_temp_file('vep_lof', 'ht'))
+
+        # Keep globals added by the runner, e.g. gencodeVersion.
+        runner_globals = hl.eval(plain_mt.globals.drop(*[k for k in plain_mt.globals if k in mt.globals]))
+        mt = mt.annotate_globals(**runner_globals)
+        plain_vep = plain_ht[mt.row_key].vep
+        lof_vep = lof_ht[mt.row_key].vep
+        return mt.annotate_rows(vep=hl.if_else(hl.is_defined(lof_vep), lof_vep, plain_vep))
+
+
+class HailVEPBalancedRunner(HailVEPRunnerBase):
+    """ Runs VEP through another runner on partitions of about the same estimated VEP cost, with a VEP block size
+    fitted to the measured VEP latency.
+
+    The variants are written to a keys-only table and read back split by estimated cost (allele lengths and
+    variant types, see plan_vep_intervals) rather than by the partitioning of the import, so dense regions and
+    indel-heavy partitions don't become stragglers. For runners with a `block_size` (a VEP process per block),
+    a sample of the variants is run first with two block sizes. The two timings separate the start-up time of a
+    VEP process from the time per variant, and the block size is picked so start-up is a small part of each
+    block. A warm-up run on a few variants comes first, so the compilation and VEP cache warm-up of the first run
+    aren't counted as start-up time. The VEP results of the sample are kept. The wrapped runner isn't changed, the
+    block sizes are set on copies of it.
+    """
+
+    PARTITIONS_PER_CORE = 4
+    CALIBRATION_ROWS = 1000
+    CALIBRATION_BLOCK_SIZES = (100, 500)
+    WARMUP_ROWS = 10
+    # Largest part of the time of a block spent starting VEP.
+    MAX_STARTUP_FRACTION = 0.1
+    MIN_BLOCK_SIZE = 100
+    MAX_BLOCK_SIZE = 10000
+
+    def __init__(self, runner, cores=None):
+        self.runner = runner
+        self.cores = cores
+
+    def runner_with_block_size(self, block_size):
+        runner = copy.copy(self.runner)
+        runner.block_size = block_size
+        return runner
+
+    def time_vep(self, ht, genome_version, vep_config_json_path, block_size):
+        runner = self.runner_with_block_size(block_size)
+        start = time.time()
+        vep_ht = runner.run(hl.MatrixTable.from_rows_table(ht), genome_version,
+                            vep_config_json_path=vep_config_json_path).rows()
+        vep_ht = vep_ht.checkpoint(hl.utils.new_temp_file('vep_calibration', 'ht'))
+        return time.time() - start, vep_ht
+
+    def calibrate_block_size(self, ht, n_rows, genome_version, vep_config_json_path):
+        """
+        Run VEP on a sample of the variants, in a single partition, with each calibration block size.
+        :return: (fitted block size or None if the timings are too noisy, VEP results of the sample)
+        """
+        sample = ht.sample(min(1.0, self.CALIBRATION_ROWS / n_rows), seed=0).naive_coalesce(1)
+        sample = sample.checkpoint(hl.utils.new_temp_file('vep_calibration_sample', 'ht'))
+        n_sample = sample.count()
+        self.time_vep(sample.head(self.WARMUP_ROWS), genome_version, vep_config_json_path, self.WARMUP_ROWS)
+        timings = []
+        for block_size in self.CALIBRATION_BLOCK_SIZES:
+            seconds, vep_ht = self.time_vep(sample, genome_version, vep_config_json_path, block_size)
+            timings.append((math.ceil(n_sample / block_size), seconds))
+
+        # seconds = blocks * startup_seconds + n_sample * variant_seconds
+        (blocks_1, seconds_1), (blocks_2, seconds_2) = timings
+        startup_seconds = (seconds_1 - seconds_2) / (blocks_1 - blocks_2) if blocks_1 != blocks_2 else 0
+        variant_seconds = (seconds_2 - blocks_2 * startup_seconds) / n_sample if n_sample else 0
+        logger.info(f'VEP calibration on {n_sample} variants: {timings} (blocks, seconds), {startup_seconds:.2f}s '
+                    f'start-up, {variant_seconds:.4f}s per variant')
+        if startup_seconds <= 0 or variant_seconds <= 0:
+            return None, vep_ht
+        block_size = math.ceil(startup_seconds * (1 - self.MAX_STARTUP_FRACTION)
+                               / (self.MAX_STARTUP_FRACTION * variant_seconds))
+        return min(max(block_size, self.MIN_BLOCK_SIZE), self.MAX_BLOCK_SIZE), vep_ht
+
+    def run(self, mt, genome_version, vep_config_json_path=None):
+        keys_path = hl.utils.new_temp_file('vep_keys', 'ht')
+        mt.rows().select().write(keys_path)
+        ht = hl.read_table(keys_path)
+        n_rows = ht.count()
+
+        runner = self.runner
+        calibration_ht = None
+        if hasattr(self.runner, 'block_size') and n_rows > self.CALIBRATION_ROWS:
+            block_size, calibration_ht = self.calibrate_block_size(ht, n_rows, genome_version, vep_config_json_path)
+            runner = self.runner_with_block_size(block_size or self.runner.block_size)
+            logger.info(f'VEP block size: {runner.block_size}')
+        block_size = getattr(runner, 'block_size', 1)
+
+        # At least a block per partition, and enough partitions for the tasks of stragglers to be short.
+        n_partitions = max(1, min((self.cores or available_cores()) * self.PARTITIONS_PER_CORE,
+                                  n_rows // block_size))
+        ht = hl.read_table(keys_path, _intervals=plan_vep_intervals(ht, n_partitions, n_rows))
+        if calibration_ht is not None:
+            ht = ht.anti_join(calibration_ht)
+
+        vep_mt = runner.run(hl.MatrixTable.from_rows_table(ht), genome_version,
+                            vep_config_json_path=vep_config_json_path)
+        vep_ht = vep_mt.rows().select('vep').select_globals()
+        if calibration_ht is not None:
+            vep_ht = vep_ht.union(calibration_ht.select('vep').select_globals())
+
+        # Keep globals added by the runner, e.g. gencodeVersion.
+        runner_globals = hl.eval(vep_mt.globals.drop(*[k for k in vep_mt.globals if k in mt.globals]))
+        mt = mt.annotate_globals(**runner_globals)
+        return mt.annotate_rows(vep=vep_ht[mt.row_key].vep)
 
 
 class HailVEPDummyRunner(HailVEPRunnerBase):
@@ -559,5 +893,8 @@ class HailVEPDummyRunner(HailVEPRunnerBase):
            'variant_class': 'SNV'},)
 
 
-    def run(self, mt, genome_version):
-        return mt.annotate_rows(vep=self.MOCK_VEP_DATA)
+    def run(self, mt, genome_version, vep_config_json_path=None):
+        vep = self.MOCK_VEP_DATA
+        if self.required_fields is not None:
+            vep = hail_utils.prune_vep_expr(vep, self.required_fields)
+        return mt.annotate_rows(vep=vep)
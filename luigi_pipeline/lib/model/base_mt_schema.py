@@ -1,10 +1,113 @@
+import hashlib
+import json
 import logging
+import os
+import sys
+import time
 from collections import defaultdict
-from inspect import getmembers
+from inspect import getmembers, getsource, isfunction, ismodule
 from typing import List
 
+import hail as hl
+
+from luigi_pipeline.lib.run_report import path_size
+
 logger = logging.getLogger(__name__)
 
+# Directory of the hail_scripts and luigi_pipeline packages: the code under it is part of the annotation
+# fingerprints, see _helper_sources.
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+# Row annotations and annotation plans of each schema class, built once per class.
+_ANNOTATION_REGISTRIES = {}
+_ANNOTATION_PLANS = {}
+
+
+def manifest_path(mt_path):
+    """
+    Path of the schema manifest written next to an annotated MT, see BaseMTSchema.get_manifest.
+    """
+    return f'{mt_path.rstrip("/")}.schema_manifest.json'
+
+
+def _to_expr(value):
+    return value if isinstance(value, hl.expr.Expression) else hl.literal(value)
+
+
+def _has_aggregations(expr):
+    return not expr._aggregations.empty()
+
+
+def _ir_node_count(ir):
+    count = 0
+    to_visit = [ir]
+    while to_visit:
+        node = to_visit.pop()
+        count += 1
+        to_visit.extend(node.children)
+    return count
+
+
+def _code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, 'co_names'):
+            names |= _code_names(const)
+    return names
+
+
+def _is_repo_code(obj):
+    if not (ismodule(obj) or isfunction(obj)):
+        return False
+    module = obj if ismodule(obj) else sys.modules.get(obj.__module__)
+    path = getattr(module, '__file__', None)
+    # Leave out packages installed in a virtualenv under the repo directory.
+    return path is not None and os.path.abspath(path).startswith(_REPO_ROOT + os.sep) and 'site-packages' not in path
+
+
+def _helper_sources(fn, schema_cls, seen=None):
+    """
+    Source of the code of this repo an annotation function calls by name: the modules it uses, e.g.
+    hail_scripts.computed_fields.vep, and the functions and schema methods it calls, with the code they call in
+    turn. Other annotations are left out, they have their own fingerprint.
+    :return: list of sources, in a stable order
+    """
+    seen = set() if seen is None else seen
+    sources = []
+    for name in sorted(_code_names(fn.__code__)):
+        for obj in (fn.__globals__.get(name), getattr(schema_cls, name, None)):
+            if not _is_repo_code(obj):
+                continue
+            key = obj.__name__ if ismodule(obj) else f'{obj.__module__}.{obj.__qualname__}'
+            if key in seen:
+                continue
+            seen.add(key)
+            sources.append(getsource(obj))
+            if isfunction(obj):
+                sources.extend(_helper_sources(obj, schema_cls, seen))
+    return sources
+
+
+class _AnnotationView:
+    """
+    Stands in for the schema MT while annotate_all plans the entry aggregations: annotations that are not
+    applied yet resolve to the given expressions, anything else to the MT.
+    """
+
+    def __init__(self, mt, expressions):
+        self._view_mt = mt
+        self._view_expressions = expressions
+
+    def __getattr__(self, name):
+        if name in self._view_expressions:
+            return self._view_expressions[name]
+        return getattr(self._view_mt, name)
+
+    def __getitem__(self, name):
+        if name in self._view_expressions:
+            return self._view_expressions[name]
+        return self._view_mt[name]
+
 
 class RowAnnotationOmit(Exception):
     pass
@@ -15,11 +118,12 @@ class RowAnnotationFailed(Exception):
 
 
 class RowAnnotation:
-    def __init__(self, fn, name=None, disable_index=False, requirements: List[str]=None):
+    def __init__(self, fn, name=None, disable_index=False, requirements: List[str]=None, cacheable=False):
         self.fn = fn
         self.name = name or fn.__name__
         self.disable_index=disable_index
         self.requirements = requirements
+        self.cacheable = cacheable
 
     def __repr__(self):
         requires = None
@@ -33,14 +137,14 @@ class RowAnnotation:
         stats dict.
         NB: No dependency resolution here!
         """
-        if self.name in schema.mt.rows()._fields and overwrite is False:
+        if self.name in schema.mt.row and overwrite is False:
             return schema
         schema.mt_instance_meta["row_annotations"][self.name]["result"] = self.fn(schema)
         schema.mt_instance_meta["row_annotations"][self.name]["annotated"] += 1
         return schema
 
 
-def row_annotation(name=None, disable_index=False, fn_require=None):
+def row_annotation(name=None, disable_index=False, fn_require=None, cacheable=False):
     """
     Function decorator for methods in a subclass of BaseMTSchema.
     Allows the function to be treated like an row_annotation with annotation name and value.
@@ -60,6 +164,8 @@ def row_annotation(name=None, disable_index=False, fn_require=None):
 
     :param name: name in the final MT. If not provided, uses the function name.
     :param fn_require: method names in class that are dependencies.
+    :param cacheable: the value depends only on the row key (locus/alleles) and the reference data, so it can
+        be reused across callsets through the annotation cache.
     :return:
     """
     def mt_prop_wrapper(func):
@@ -73,7 +179,8 @@ def row_annotation(name=None, disable_index=False, fn_require=None):
                     )
             requirements = [fn.name for fn in fn_requirements]
 
-        return RowAnnotation(func, name=name, disable_index=disable_index, requirements=requirements)
+        return RowAnnotation(func, name=name, disable_index=disable_index, requirements=requirements,
+                             cacheable=cacheable)
 
     return mt_prop_wrapper
 
@@ -105,6 +212,11 @@ class BaseMTSchema:
     `TestSchema(mt).b().c_1().select_annotated_mt()` will annotate with {'a': 0, 'b': 1, 'c': 2}
 
     """
+    # Row and entry fields of the imported dataset read by the annotations of this class, see get_source_fields.
+    # Nested INFO fields are written as 'info.<name>'.
+    SOURCE_ROW_FIELDS = ()
+    SOURCE_ENTRY_FIELDS = ()
+
     def __init__(self, mt):
         self._mt = None
         self.set_mt(mt)
@@ -129,76 +241,302 @@ class BaseMTSchema:
 
     def all_annotation_fns(self):
         """
-        Get all row_annotation decorated methods using introspection.
+        Get all row_annotation decorated methods of the schema class.
         :return: list of all annotation functions
         """
-        return [a[1] for a in getmembers(self, lambda x: isinstance(x, RowAnnotation))]
+        return list(self.get_annotation_registry().values())
 
-    def annotate_all(self, overwrite=False):
+    @classmethod
+    def get_annotation_registry(cls):
         """
-        Iterate over all annotation functions and call them on the instance.
-        :return: instance object
+        Row annotations of the class and its parents by annotation name, found by introspection once per class.
+        :return: dict of annotation name to RowAnnotation
         """
-        called_annotations = set()
-        rounds: List[List[RowAnnotation]] = [self.all_annotation_fns()]
-        logger.debug(f'Will attempt to apply {len(rounds[0])} row annotations')
+        if cls not in _ANNOTATION_REGISTRIES:
+            _ANNOTATION_REGISTRIES[cls] = {
+                annotation.name: annotation for _, annotation in getmembers(cls, lambda x: isinstance(x, RowAnnotation))
+            }
+        return _ANNOTATION_REGISTRIES[cls]
+
+    @classmethod
+    def get_annotation_plan(cls):
+        """
+        Order the annotations of the class into layers applied by one `annotate_rows` each. Every annotation is
+        in the layer after its deepest requirement, so there are as many layers as the longest requirement chain.
+        :return: list of layers, each a list of annotation names
+        """
+        if cls not in _ANNOTATION_PLANS:
+            registry = cls.get_annotation_registry()
+            depths = {}
+
+            def depth(name, path):
+                if name in path:
+                    raise RowAnnotationFailed(f'Circular annotation requirements: {" -> ".join(path + (name,))}')
+                if name not in depths:
+                    requirements = registry[name].requirements or []
+                    missing = [r for r in requirements if r not in registry]
+                    if missing:
+                        raise RowAnnotationFailed(
+                            f"Couldn't apply annotations {name}, "
+                            f"their dependencies could not be fulfilled: {', '.join(missing)}"
+                        )
+                    depths[name] = 1 + max((depth(r, path + (name,)) for r in requirements), default=-1)
+                return depths[name]
+
+            plan = []
+            for name in registry:
+                layer = depth(name, ())
+                plan.extend([] for _ in range(layer + 1 - len(plan)))
+                plan[layer].append(name)
+            _ANNOTATION_PLANS[cls] = plan
+        return [list(layer) for layer in _ANNOTATION_PLANS[cls]]
+
+    @classmethod
+    def get_annotation_requirements(cls, names):
+        """
+        :param names: annotation names
+        :return: set of the names and the names of all the annotations they require, directly or not
+        """
+        registry = cls.get_annotation_registry()
+        unknown = [name for name in names if name not in registry]
+        if unknown:
+            raise RowAnnotationFailed(f'Unknown annotations for schema {cls.__name__}: {", ".join(unknown)}')
+        required = set()
+        to_visit = list(names)
+        while to_visit:
+            name = to_visit.pop()
+            if name not in required:
+                required.add(name)
+                to_visit.extend(registry[name].requirements or [])
+        return required
+
+    def annotation_data_versions(self, annotation):
+        """
+        Versions of the data, besides the MT, an annotation reads. Overwrite for schemas with reference data.
+        :return: list of strings
+        """
+        return []
 
-        while len(rounds) > 0:
-            rnd = rounds.pop(0)
-            logger.debug(f'Starting round with {len(rnd)} annotations')
-            # add callers that you can't run yet to this list
-            next_round = []
-            annotations_to_apply = {}
-            for annotation in rnd:
-                # apply each atn_fn here
-                instance_metadata = self.mt_instance_meta['row_annotations'][annotation.name]
+    def annotation_fingerprints(self):
+        """
+        Fingerprint of each annotation: a hash of its function source, the source of the repo helpers it calls
+        (see _helper_sources), the versions of the data it reads and the fingerprints of its requirements.
+        :return: dict of annotation name to fingerprint
+        """
+        registry = self.get_annotation_registry()
+        fingerprints = {}
+
+        def fingerprint(name):
+            if name not in fingerprints:
+                annotation = registry[name]
+                parts = [getsource(annotation.fn)] + _helper_sources(annotation.fn, type(self)) + \
+                    self.annotation_data_versions(annotation) + [fingerprint(r) for r in annotation.requirements or []]
+                fingerprints[name] = hashlib.sha256('\n'.join(parts).encode()).hexdigest()[:16]
+            return fingerprints[name]
+
+        for name in registry:
+            fingerprint(name)
+        return fingerprints
+
+    def changed_annotations(self, fingerprints):
+        """
+        :param fingerprints: annotation fingerprints the MT was annotated with, e.g. from its globals
+        :return: sorted names of the annotations that are new or whose fingerprint changed
+        """
+        return sorted(
+            name for name, fingerprint in self.annotation_fingerprints().items() if fingerprints.get(name) != fingerprint
+        )
+
+    def annotate_all(self, overwrite=False, exclude=None, annotations=None):
+        """
+        Apply all annotation functions, following the class annotation plan.
+
+        Annotations that aggregate over the entries are applied first, together in one `annotate_rows` with the
+        annotations they require, so the entries are aggregated in a single pass however deep their requirements
+        are: an aggregation that requires another annotation is built on that annotation's expression instead of
+        its row field. Hail can't nest aggregations though, so an aggregation over the result of another one is
+        left to a second entry pass, which reads that result from its row field. The remaining annotations are then
+        applied layer by layer from the row fields.
+        :param overwrite: overwrite annotations that are already present in the MT.
+        :param exclude: names of annotations already present in the MT (e.g. restored from the annotation cache)
+            that should not be recomputed. They still fulfil the requirements of other annotations.
+        :param annotations: only apply these annotations and their requirements, e.g. to refresh some annotations
+            of an already annotated MT. The other annotations are excluded.
+        :return: instance object
+        """
+        exclude = set(exclude or [])
+        registry = self.get_annotation_registry()
+        plan = self.get_annotation_plan()
+        if annotations is not None:
+            exclude.update(set(registry) - self.get_annotation_requirements(annotations))
+        mt = self.mt
+        logger.debug(f'Will attempt to apply {len(registry)} row annotations in {len(plan)} layers')
+
+        pending = []
+        for layer in plan:
+            for name in layer:
+                if name in exclude:
+                    continue
+                instance_metadata = self.mt_instance_meta['row_annotations'][name]
                 if instance_metadata['annotated'] > 0:
                     # already called
                     continue
 
                 # MT already has annotation, so only continue if overwrite requested.
-                if annotation.name in self.mt.rows()._fields or annotation.name in annotations_to_apply:
+                if name in mt.row:
                     logger.warning(
-                        'MT using schema class %s already has "%s" annotation.' % (self.__class__.__name__, annotation.name))
+                        'MT using schema class %s already has "%s" annotation.' % (self.__class__.__name__, name))
                     if not overwrite:
                         continue
-                    logger.info(f'Overwriting matrix table annotation {annotation.name}')
-
-                if annotation.requirements and any(r not in called_annotations for r in annotation.requirements):
-                    # this annotation has unfulfilled annotations,
-                    # so let's do it in the next round
-                    next_round.append(annotation)
+                    logger.info(f'Overwriting matrix table annotation {name}')
+                pending.append(name)
+
+        # Find the aggregating annotations. Their requirements are stood in for by expressions without
+        # aggregations, so an annotation only counts as aggregating if it aggregates itself. The expressions of the
+        # annotations that don't depend on an aggregation are the ones of the entry pass, so they are kept for it.
+        placeholders = {}
+        expressions = {}
+        aggregating = []
+        depends_on_aggregation = set()
+        self.set_mt(_AnnotationView(mt, placeholders))
+        for name in pending:
+            annotation = registry[name]
+            missing = [r for r in annotation.requirements or [] if r not in exclude and r not in placeholders]
+            if missing:
+                self.set_mt(mt)
+                raise RowAnnotationFailed(
+                    f"Couldn't apply annotations {name}, "
+                    f"their dependencies could not be fulfilled: {', '.join(missing)}"
+                )
+            try:
+                expr = _to_expr(annotation.fn(self))
+            except RowAnnotationOmit:
+                # Do not annotate when RowAnnotationOmit raised.
+                logger.debug(f'Received RowAnnotationOmit for "{name}"')
+                continue
+            if any(r in aggregating or r in depends_on_aggregation for r in annotation.requirements or []):
+                depends_on_aggregation.add(name)
+            else:
+                expressions[name] = expr
+            if _has_aggregations(expr):
+                aggregating.append(name)
+                placeholders[name] = hl.missing(expr.dtype)
+            else:
+                placeholders[name] = expr
+
+        layers = []
+        applied = set()
+        remaining = aggregating
+        while remaining:
+            # Entry pass: aggregations and the annotations they need, inlined as expressions.
+            needed = set(remaining)
+            for name in reversed(pending):
+                if name in needed:
+                    needed.update(r for r in registry[name].requirements or [] if r not in applied)
+            pass_expressions = {}
+            deferred = {}
+            self.set_mt(_AnnotationView(mt, pass_expressions))
+            for name in pending:
+                if name not in placeholders or name not in needed or name in applied:
                     continue
+                if any(r in deferred for r in registry[name].requirements or []):
+                    deferred[name] = None
+                    continue
+                if name in expressions:
+                    expr = expressions[name]
+                else:
+                    try:
+                        expr = _to_expr(registry[name].fn(self))
+                    except hl.expr.ExpressionException as e:
+                        if name not in aggregating:
+                            raise
+                        # Aggregates the result of an aggregation of this pass.
+                        deferred[name] = e
+                        continue
+                instance_metadata = self.mt_instance_meta['row_annotations'][name]
+                instance_metadata['result'] = expr
+                instance_metadata['annotated'] += 1
+                pass_expressions[name] = expr
+            if not pass_expressions:
+                self.set_mt(mt)
+                raise RowAnnotationFailed(
+                    f"Couldn't apply the entry aggregations {', '.join(deferred)}: "
+                    f"{'; '.join(str(e) for e in deferred.values() if e is not None)}"
+                )
+            logger.debug('Applying entry aggregations: ' + ', '.join(pass_expressions))
+            mt = mt.annotate_rows(**pass_expressions)
+            layers.append(list(pass_expressions))
+            applied.update(pass_expressions)
+            remaining = [name for name in remaining if name in deferred]
 
-                try:
-                    # evaluate the function
-                    annotation(self, overwrite=overwrite)
-                    annotations_to_apply[annotation.name] = instance_metadata['result']
-                except RowAnnotationOmit:
-                    # Do not annotate when RowAnnotationOmit raised.
-                    logger.debug(f'Received RowAnnotationOmit for "{annotation.name}"')
-
+        self.set_mt(mt)
+        for layer in plan:
+            annotations_to_apply = {}
+            for name in layer:
+                if name not in placeholders or name in applied:
+                    continue
+                # evaluate the function
+                registry[name](self, overwrite=overwrite)
+                annotations_to_apply[name] = self.mt_instance_meta['row_annotations'][name]['result']
 
             # update the mt
-            logger.debug('Applying annotations: ' + ', '.join(annotations_to_apply.keys()))
-            self.set_mt(self.mt.annotate_rows(**annotations_to_apply))
-
-            called_annotations = called_annotations.union(set(annotations_to_apply.keys()))
-
-            if len(next_round) > 0:
-                if len(next_round) == len(rnd):
-                    # something has got stuck and it's requirements can't be fulfilled
-                    failed_annotations = ', '.join(an.name for an in next_round)
-                    flattened_reqs = [inner for an in next_round for inner in (an.requirements or [])]
-                    requirements = ', '.join(set(flattened_reqs))
-                    raise RowAnnotationFailed(
-                        f"Couldn't apply annotations {failed_annotations}, "
-                        f"their dependencies could not be fulfilled: {requirements}"
-                    )
-                rounds.append(next_round)
+            if annotations_to_apply:
+                logger.debug('Applying annotations: ' + ', '.join(annotations_to_apply.keys()))
+                self.set_mt(self.mt.annotate_rows(**annotations_to_apply))
+                layers.append(list(annotations_to_apply))
 
+        self.mt_instance_meta['annotation_layers'] = layers
         return self
 
+    def profile_annotations(self, sample_fraction=0.01):
+        """
+        Measure the cost of each annotation on a sample of the MT partitions. All annotations are computed and
+        checkpointed once, then each one is recomputed on its own from the checkpoint, so its cost doesn't include
+        its requirements. Use a schema instance of its own, as the annotations are applied to it.
+
+        :param sample_fraction: fraction of the partitions to profile on, evenly spaced
+        :return: list of dicts with, per annotation, the seconds to compute and write it beyond writing the row keys,
+            the node count of its IR and its serialized bytes. For schemas with an `elasticsearch_row`, also the number
+            of flattened ES fields and their bytes as JSON. Sorted by decreasing seconds.
+        """
+        mt = self.mt
+        step = max(1, round(1 / sample_fraction))
+        sample = mt._filter_partitions(list(range(0, mt.n_partitions(), step)))
+        self.set_mt(sample.checkpoint(hl.utils.new_temp_file('profile_sample', 'mt')))
+        self.annotate_all(overwrite=True)
+        annotated = self.mt.checkpoint(hl.utils.new_temp_file('profile_annotated', 'mt'))
+        self.set_mt(annotated)
+
+        def write_rows(**fields):
+            path = hl.utils.new_temp_file('profile_rows', 'ht')
+            start = time.time()
+            annotated.select_rows(**fields).rows().write(path)
+            return time.time() - start, path_size(path), path
+
+        key_seconds, key_bytes, _ = write_rows()
+        es_row = getattr(self, 'elasticsearch_row', None)
+        profile = []
+        for name, annotation in self.get_annotation_registry().items():
+            if self.mt_instance_meta['row_annotations'][name]['annotated'] == 0:
+                # Omitted or excluded annotation.
+                continue
+            expr = _to_expr(annotation.fn(self))
+            seconds, size, path = write_rows(**{name: expr})
+            annotation_profile = {
+                'name': name,
+                'seconds': round(max(seconds - key_seconds, 0), 3),
+                'ir_nodes': _ir_node_count(expr._ir),
+                'bytes': size - key_bytes,
+            }
+            if es_row is not None:
+                es_ht = es_row(hl.read_table(path))
+                annotation_profile['es_fields'] = len(es_ht.row)
+                annotation_profile['es_bytes'] = es_ht.aggregate(hl.agg.sum(hl.len(hl.json(es_ht.row))))
+            logger.info(f'Annotation profile: {annotation_profile}')
+            profile.append(annotation_profile)
+
+        self.set_mt(mt)
+        return sorted(profile, key=lambda annotation_profile: -annotation_profile['seconds'])
 
     def select_annotated_mt(self):
         """
@@ -226,10 +564,97 @@ class BaseMTSchema:
         Retrieve the field indices that should be disabled
         return: list of strings
         '''
-        all_fields: List[RowAnnotation] = self.all_annotation_fns()
-        disabled_indices = []
-        for field in all_fields:
-            if field.disable_index == True:
-                disabled_indices += [field.name]
-  
-        return disabled_indices
+        return self.get_disabled_index_fields()
+
+    @classmethod
+    def get_disabled_index_fields(cls, manifest=None):
+        '''
+        Retrieve the annotations that should not be indexed in ES, without instantiating the schema.
+        :param manifest: manifest to read them from, defaults to the manifest of the class
+        return: list of strings
+        '''
+        manifest = manifest or cls.get_manifest()
+        return [annotation['name'] for annotation in manifest['annotations'] if annotation['disable_index']]
+
+    @classmethod
+    def get_manifest(cls, mt=None):
+        '''
+        Static description of the annotations of the class, serializable to JSON: the name, disable_index flag,
+        requirements and cacheable flag of each annotation.
+        :param mt: optional annotated MT or table to record the dtypes of the annotations from
+        return: dict
+        '''
+        annotations = []
+        for name, annotation in cls.get_annotation_registry().items():
+            annotation_manifest = {
+                'name': name,
+                'disable_index': annotation.disable_index,
+                'requirements': list(annotation.requirements or []),
+                'cacheable': annotation.cacheable,
+            }
+            if mt is not None and name in mt.row:
+                annotation_manifest['dtype'] = str(mt.row[name].dtype)
+            annotations.append(annotation_manifest)
+        return {'schema': f'{cls.__module__}.{cls.__qualname__}', 'annotations': annotations}
+
+    @classmethod
+    def write_manifest(cls, path, mt=None):
+        '''
+        Write the manifest of the class as JSON, e.g. to `manifest_path(<MT path>)` with the dtypes of the written MT.
+        '''
+        with hl.hadoop_open(path, 'w') as f:
+            json.dump(cls.get_manifest(mt), f, indent=2)
+
+    @staticmethod
+    def read_manifest(path):
+        '''
+        return: the manifest written by write_manifest, or None if there is none
+        '''
+        if not hl.hadoop_exists(path):
+            return None
+        with hl.hadoop_open(path, 'r') as f:
+            return json.load(f)
+
+    @staticmethod
+    def validate_manifest(manifest, mt):
+        '''
+        Check that an MT or table has the annotations of a manifest with the recorded dtypes.
+        :raises ValueError: listing the missing annotations and the annotations with another dtype
+        '''
+        errors = []
+        for annotation in manifest['annotations']:
+            if 'dtype' not in annotation:
+                continue
+            name = annotation['name']
+            if name not in mt.row:
+                errors.append(f'{name} is missing')
+            elif str(mt.row[name].dtype) != annotation['dtype']:
+                errors.append(f'{name} has dtype {mt.row[name].dtype}, expected {annotation["dtype"]}')
+        if errors:
+            raise ValueError(f'Annotations do not match the {manifest["schema"]} manifest: {"; ".join(errors)}')
+
+    @classmethod
+    def get_cacheable_annotation_names(cls):
+        '''
+        Retrieve the names of the annotations that only depend on the row key and reference data.
+        return: sorted list of strings
+        '''
+        return sorted(name for name, annotation in cls.get_annotation_registry().items() if annotation.cacheable)
+
+    @classmethod
+    def get_source_fields(cls):
+        '''
+        Retrieve the imported row and entry fields read by the annotations of the class and its parents.
+        Every class defining annotations has to declare SOURCE_ROW_FIELDS/SOURCE_ENTRY_FIELDS, otherwise
+        the fields are unknown and None is returned.
+        return: (sorted row fields, sorted entry fields) or None
+        '''
+        row_fields, entry_fields = set(), set()
+        for klass in cls.__mro__:
+            if not any(isinstance(member, RowAnnotation) for member in vars(klass).values()):
+                continue
+            if 'SOURCE_ROW_FIELDS' not in vars(klass) and 'SOURCE_ENTRY_FIELDS' not in vars(klass):
+                return None
+            row_fields.update(klass.SOURCE_ROW_FIELDS)
+            entry_fields.update(klass.SOURCE_ENTRY_FIELDS)
+        return sorted(row_fields), sorted(entry_fields)
@@ -161,22 +161,13 @@ class SeqrGCNVGenotypesSchema(SeqrGenotypesSchema):
 
     @row_annotation(fn_require=SeqrGenotypesSchema.genotypes)
     def samples_qs(self, start=0, end=1000, step=10):
-        return hl.struct(**{
-            f'{i}_to_{i + step}': self._genotype_filter_samples(lambda g: ((g.qs >= i) & (g.qs < i+step)))
-            for i in range(start, end, step)
-        }, **{
-            "gt_1000": self._genotype_filter_samples(lambda g: g.qs >= 1000)
-        })
+        return self._genotype_bin_samples(lambda g: g.qs, start, end, step, open_bin_name='gt_1000')
 
     @row_annotation(name="samples_cn", fn_require=SeqrGenotypesSchema.genotypes)
     def samples_cn(self, start=0, end=4, step=1):
-        return hl.struct(**{
-            f'{i}': self._genotype_filter_samples(lambda g: g.cn == i)
-            for i in range(start, end, step)
-        }, **{
-            "gte_4": self._genotype_filter_samples(lambda g: g.cn >= 4)
-        })
-    
+        return self._genotype_bin_samples(lambda g: g.cn, start, end, step, bin_name=lambda i: f'{i}',
+                                          open_bin_name='gte_4')
+
     def _genotype_fields(self):
         if self._is_new_joint_call:
             call_fields = {
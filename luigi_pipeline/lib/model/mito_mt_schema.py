@@ -15,23 +15,23 @@ class SeqrMitoVariantSchema(BaseSeqrSchema):
         self._high_constraint_region = high_constraint_region
 
     # Mitochondrial only fields
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def gnomad_mito(self):
         return self._selected_ref_data.gnomad_mito
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def mitomap(self):
         return self._selected_ref_data.mitomap
 
-    @row_annotation(name='mitimpact_apogee')
+    @row_annotation(name='mitimpact_apogee', cacheable=True)
     def mitimpact(self):
         return self._selected_ref_data.mitimpact.score
 
-    @row_annotation(name='hmtvar_hmtVar')
+    @row_annotation(name='hmtvar_hmtVar', cacheable=True)
     def hmtvar(self):
         return self._selected_ref_data.hmtvar.score
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def helix(self):
         return self._selected_ref_data.helix_mito
 
@@ -47,7 +47,7 @@ class SeqrMitoVariantSchema(BaseSeqrSchema):
     def mitotip_mitoTIP(self):
         return self.mt.mitotip_trna_prediction
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def high_constraint_region(self):
         return hl.is_defined(self._high_constraint_region[self.mt.locus])
 
@@ -78,16 +78,12 @@ class SeqrMitoVariantSchema(BaseSeqrSchema):
 
 
 class SeqrMitoGenotypesSchema(SeqrGenotypesSchema):
+    GENOTYPE_FLOAT_SCALES = {'hl': 1000}
 
     @row_annotation(fn_require=SeqrGenotypesSchema.genotypes)
     def samples_hl(self, start=0, end=45, step=5):
         # struct of x_to_y to a set of samples in range of x and y for heteroplasmy level.
-        return hl.struct(**{
-            f'{i}_to_{i + step}': self._genotype_filter_samples(
-                lambda g: ((g.num_alt == 1) & ((g.hl*100) >= i) & ((g.hl*100) < i+step))
-            )
-            for i in range(start, end, step)
-        })
+        return self._genotype_bin_samples(lambda g: g.hl*100, start, end, step, filter=lambda g: g.num_alt == 1)
 
     # Override the samples_ab annotation
     def samples_ab(self):
@@ -1,7 +1,11 @@
+import re
+from inspect import getsource
+
 import hail as hl
 
 from hail_scripts.computed_fields import variant_id, vep
 
+from luigi_pipeline.lib.annotation_cache import table_version
 from luigi_pipeline.lib.model.base_mt_schema import (
     BaseMTSchema,
     RowAnnotationOmit,
@@ -10,31 +14,61 @@ from luigi_pipeline.lib.model.base_mt_schema import (
 
 
 class BaseVariantSchema(BaseMTSchema):
+    SOURCE_ROW_FIELDS = ()
+
+    # Hidden row field with the locus and allele derived values shared by several annotations, see annotate_all.
+    LOCUS_PRIMITIVES_FIELD = '_locus_primitives'
 
     def __init__(self, mt, *args, **kwargs):
         super().__init__(mt)
 
-    @row_annotation(disable_index=True)
+    def _locus_primitives(self):
+        """
+        Contig, contig number, ref length and variant id of the rows, see variant_id.get_expr_for_locus_primitives.
+        Reads the hidden field added by annotate_all, or computes them on the spot when an annotation is called on
+        its own.
+        """
+        if self.LOCUS_PRIMITIVES_FIELD in self.mt.row:
+            return self.mt[self.LOCUS_PRIMITIVES_FIELD]
+        return variant_id.get_expr_for_locus_primitives(self.mt.locus, self.mt.alleles)
+
+    def annotate_all(self, overwrite=False, exclude=None, annotations=None):
+        """
+        Compute the locus primitives once into a hidden row field, annotate, then drop the field.
+        """
+        hoist = 'locus' in self.mt.row and 'alleles' in self.mt.row
+        if hoist:
+            self.set_mt(self.mt.annotate_rows(**{self.LOCUS_PRIMITIVES_FIELD: self._locus_primitives()}))
+        super().annotate_all(overwrite=overwrite, exclude=exclude, annotations=annotations)
+        if hoist:
+            self.set_mt(self.mt.drop(self.LOCUS_PRIMITIVES_FIELD))
+        return self
+
+    @row_annotation(disable_index=True, cacheable=True)
     def contig(self):
-        return variant_id.get_expr_for_contig(self.mt.locus)
+        return self._locus_primitives().contig
 
-    @row_annotation(disable_index=True)
+    @row_annotation(disable_index=True, cacheable=True)
     def start(self):
         return variant_id.get_expr_for_start_pos(self.mt)
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def pos(self):
         return variant_id.get_expr_for_start_pos(self.mt)
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def xpos(self):
-        return variant_id.get_expr_for_xpos(self.mt.locus)
+        return variant_id.get_expr_for_xpos(self.mt.locus, self._locus_primitives())
 
-    @row_annotation(disable_index=True)
+    @row_annotation(disable_index=True, cacheable=True)
     def xstart(self):
-        return variant_id.get_expr_for_xpos(self.mt.locus)
+        return variant_id.get_expr_for_xpos(self.mt.locus, self._locus_primitives())
 
 class BaseSeqrSchema(BaseVariantSchema):
+    SOURCE_ROW_FIELDS = ('rsid', 'filters')
+
+    # Reference tables joined to the rows, by schema attribute name, see annotate_all.
+    REF_JOINS = ('ref_data', 'interval_ref_data', 'clinvar_data', 'hgmd_data')
 
     def __init__(self, *args, ref_data, interval_ref_data, clinvar_data, hgmd_data=None, **kwargs):
         self._ref_data = ref_data
@@ -42,32 +76,68 @@ class BaseSeqrSchema(BaseVariantSchema):
         self._clinvar_data = clinvar_data
         self._hgmd_data = hgmd_data
 
-        # See _selected_ref_data
-        self._selected_ref_data_cache = None
+        # See annotation_data_versions
+        self._ref_versions = {}
 
         super().__init__(*args, **kwargs)
 
-    def set_mt(self, mt):
-        super().set_mt(mt)
-        # set this to None, and the @property _selected_ref_data
-        # can populate it if it gets used after each MT update.
-        self._selected_ref_data_cache = None
+    @staticmethod
+    def _ref_join_field(name):
+        return f'_{name}_join'
+
+    def _ref_join(self, name):
+        """
+        Join expression of a reference table: the interval table is indexed by locus, the others by row key.
+        """
+        if name == 'interval_ref_data':
+            return self._interval_ref_data.index(self.mt.locus, all_matches=True)
+        return getattr(self, f'_{name}')[self.mt.row_key]
+
+    def _joined(self, name):
+        """
+        Rows of a reference table matching the MT rows. Reads the join field added by annotate_all, so that each
+        table is joined once per load rather than once per lookup, or joins on the spot when an annotation is
+        called on its own.
+        """
+        field = self._ref_join_field(name)
+        if field in self.mt.row:
+            return self.mt[field]
+        return self._ref_join(name)
 
     @property
     def _selected_ref_data(self):
         """
-        Reuse `self._ref_data[self.mt.row_key]` for all annotations.
-        We'll use the @property _selected_ref_data to access this
-        value, and lazily cache it (so as not to compute it if it
-        doesn't get get accessed after an update to self.mt).
-
         Returns: self._ref_data[self.mt.row_key]
         """
-        if not self._selected_ref_data_cache:
-            self._selected_ref_data_cache = self._ref_data[self.mt.row_key]
-        return self._selected_ref_data_cache
+        return self._joined('ref_data')
 
-    @row_annotation()
+    def annotation_data_versions(self, annotation):
+        """
+        Versions of the reference tables the annotation reads through _selected_ref_data or _joined.
+        """
+        source = getsource(annotation.fn)
+        names = set(re.findall(r"_joined\('(\w+)'\)", source))
+        if '_selected_ref_data' in source:
+            names.add('ref_data')
+        for name in names:
+            if name not in self._ref_versions:
+                self._ref_versions[name] = table_version(getattr(self, f'_{name}'))
+        return [f'{name}: {self._ref_versions[name]}' for name in sorted(names)]
+
+    def annotate_all(self, overwrite=False, exclude=None, annotations=None):
+        """
+        Join each reference table into a hidden row field, annotate, then drop the join fields.
+        """
+        joins = {
+            self._ref_join_field(name): self._ref_join(name)
+            for name in self.REF_JOINS if getattr(self, f'_{name}') is not None
+        }
+        self.set_mt(self.mt.annotate_rows(**joins))
+        super().annotate_all(overwrite=overwrite, exclude=exclude, annotations=annotations)
+        self.set_mt(self.mt.drop(*joins))
+        return self
+
+    @row_annotation(cacheable=True)
     def vep(self):
         return self.mt.vep
 
@@ -79,77 +149,80 @@ class BaseSeqrSchema(BaseVariantSchema):
     def filters(self):
         return self.mt.filters
 
-    @row_annotation(name='sortedTranscriptConsequences', disable_index=True, fn_require=vep)
+    @row_annotation(name='sortedTranscriptConsequences', disable_index=True, fn_require=vep, cacheable=True)
     def sorted_transcript_consequences(self):
         return vep.get_expr_for_vep_sorted_transcript_consequences_array(self.mt.vep)
 
-    @row_annotation(name='docId', disable_index=True)
+    @row_annotation(name='docId', disable_index=True, cacheable=True)
     def doc_id(self, length=512):
-        return variant_id.get_expr_for_variant_id(self.mt, length)
+        return variant_id.get_expr_for_variant_id(self.mt, length, self._locus_primitives())
 
-    @row_annotation(name='variantId')
+    @row_annotation(name='variantId', cacheable=True)
     def variant_id(self):
-        return variant_id.get_expr_for_variant_id(self.mt)
+        return variant_id.get_expr_for_variant_id(self.mt, primitives=self._locus_primitives())
 
-    @row_annotation(disable_index=True)
+    @row_annotation(disable_index=True, cacheable=True)
     def end(self):
-        return variant_id.get_expr_for_end_pos(self.mt)
+        return variant_id.get_expr_for_end_pos(self.mt, self._locus_primitives())
 
-    @row_annotation(disable_index=True)
+    @row_annotation(disable_index=True, cacheable=True)
     def ref(self):
         return variant_id.get_expr_for_ref_allele(self.mt)
 
-    @row_annotation(disable_index=True)
+    @row_annotation(disable_index=True, cacheable=True)
     def alt(self):
         return variant_id.get_expr_for_alt_allele(self.mt)
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def xstop(self):
-        return variant_id.get_expr_for_xpos(self.mt.locus) + hl.len(variant_id.get_expr_for_ref_allele(self.mt)) - 1
+        primitives = self._locus_primitives()
+        return variant_id.get_expr_for_xpos(self.mt.locus, primitives) + primitives.ref_length - 1
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def rg37_locus(self):
         if self.mt.locus.dtype.reference_genome.name != "GRCh38":
             raise RowAnnotationOmit
         return self.mt.rg37_locus
 
-    @row_annotation(disable_index=True, fn_require=sorted_transcript_consequences)
+    @row_annotation(disable_index=True, fn_require=sorted_transcript_consequences, cacheable=True)
     def domains(self):
         return vep.get_expr_for_vep_protein_domains_set_from_sorted(
             self.mt.sortedTranscriptConsequences)
 
-    @row_annotation(name='transcriptConsequenceTerms', fn_require=sorted_transcript_consequences)
+    @row_annotation(name='transcriptConsequenceTerms', fn_require=sorted_transcript_consequences, cacheable=True)
     def transcript_consequence_terms(self):
         return vep.get_expr_for_vep_consequence_terms_set(self.mt.sortedTranscriptConsequences)
 
-    @row_annotation(name='transcriptIds', disable_index=True, fn_require=sorted_transcript_consequences)
+    @row_annotation(name='transcriptIds', disable_index=True, fn_require=sorted_transcript_consequences, cacheable=True)
     def transcript_ids(self):
         return vep.get_expr_for_vep_transcript_ids_set(self.mt.sortedTranscriptConsequences)
 
-    @row_annotation(name='mainTranscript', disable_index=True, fn_require=sorted_transcript_consequences)
+    @row_annotation(name='mainTranscript', disable_index=True, fn_require=sorted_transcript_consequences, cacheable=True)
     def main_transcript(self):
         return vep.get_expr_for_worst_transcript_consequence_annotations_struct(
             self.mt.sortedTranscriptConsequences)
 
-    @row_annotation(name='geneIds', fn_require=sorted_transcript_consequences)
+    @row_annotation(name='geneIds', fn_require=sorted_transcript_consequences, cacheable=True)
     def gene_ids(self):
         return vep.get_expr_for_vep_gene_ids_set(self.mt.sortedTranscriptConsequences)
 
-    @row_annotation(name='codingGeneIds', disable_index=True, fn_require=sorted_transcript_consequences)
+    @row_annotation(name='codingGeneIds', disable_index=True, fn_require=sorted_transcript_consequences, cacheable=True)
     def coding_gene_ids(self):
         return vep.get_expr_for_vep_gene_ids_set(self.mt.sortedTranscriptConsequences, only_coding_genes=True)
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def clinvar(self):
-        return hl.struct(**{'allele_id': self._clinvar_data[self.mt.row_key].info.ALLELEID,
-                            'clinical_significance': hl.delimit(self._clinvar_data[self.mt.row_key].info.CLNSIG),
-                            'gold_stars': self._clinvar_data[self.mt.row_key].gold_stars})
+        clinvar = self._joined('clinvar_data')
+        return hl.struct(**{'allele_id': clinvar.info.ALLELEID,
+                            'clinical_significance': hl.delimit(clinvar.info.CLNSIG),
+                            'gold_stars': clinvar.gold_stars})
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def dbnsfp(self):
         return self._selected_ref_data.dbnsfp
 
 class SeqrSchema(BaseSeqrSchema):
+    SOURCE_ROW_FIELDS = ()
     @row_annotation(disable_index=True)
     def aIndex(self):
         return self.mt.a_index
@@ -158,62 +231,61 @@ class SeqrSchema(BaseSeqrSchema):
     def wasSplit(self):
         return self.mt.was_split
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def cadd(self):
         return self._selected_ref_data.cadd
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def gnomad_exomes(self):
         return self._selected_ref_data.gnomad_exomes
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def gnomad_genomes(self):
         return self._selected_ref_data.gnomad_genomes
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def eigen(self):
         return self._selected_ref_data.eigen
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def exac(self):
         return self._selected_ref_data.exac
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def mpc(self):
         return self._selected_ref_data.mpc
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def primate_ai(self):
         return self._selected_ref_data.primate_ai
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def splice_ai(self):
         return self._selected_ref_data.splice_ai
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def topmed(self):
         return self._selected_ref_data.topmed
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def alpha_missense(self):
         return self._selected_ref_data.alpha_missense
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def hgmd(self):
         if self._hgmd_data is None:
             raise RowAnnotationOmit
-        return hl.struct(**{'accession': self._hgmd_data[self.mt.row_key].rsid,
-                            'class': self._hgmd_data[self.mt.row_key].info.CLASS})
+        hgmd = self._joined('hgmd_data')
+        return hl.struct(**{'accession': hgmd.rsid,
+                            'class': hgmd.info.CLASS})
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def gnomad_non_coding_constraint(self):
         if self._interval_ref_data is None:
             raise RowAnnotationOmit
         return hl.struct(
             **{
-                "z_score": self._interval_ref_data.index(
-                    self.mt.locus, all_matches=True
-                )
+                "z_score": self._joined('interval_ref_data')
                 .filter(
                     lambda x: hl.is_defined(x.gnomad_non_coding_constraint["z_score"])
                 )
@@ -221,19 +293,18 @@ class SeqrSchema(BaseSeqrSchema):
             }
         )
 
-    @row_annotation()
+    @row_annotation(cacheable=True)
     def screen(self):
         if self._interval_ref_data is None:
             raise RowAnnotationOmit
         return hl.struct(
             **{
-                "region_type": self._interval_ref_data.index(
-                    self.mt.locus, all_matches=True
-                ).flatmap(lambda x: x.screen["region_type"])
+                "region_type": self._joined('interval_ref_data').flatmap(lambda x: x.screen["region_type"])
             }
         )
 
 class SeqrVariantSchema(SeqrSchema):
+    SOURCE_ROW_FIELDS = ()
 
     @row_annotation(name='AC')
     def ac(self):
@@ -253,10 +324,27 @@ class SeqrVariantSchema(SeqrSchema):
 
 
 class SeqrGenotypesSchema(BaseMTSchema):
+    SOURCE_ENTRY_FIELDS = ('GT', 'GQ', 'AD')
+    # Float genotype fields stored as integers by encode_genotypes, with their scale.
+    GENOTYPE_FLOAT_SCALES = {'ab': 1000}
+    # Upper bound of the samples_gq bins.
+    GQ_BINS_END = 95
+
+    def __init__(self, *args, sparse_genotypes=False, **kwargs):
+        """
+        :param sparse_genotypes: only keep the genotypes selected by _is_sparse_genotype, i.e. leave out the hom-ref
+            calls with a GQ above the samples_gq bins. The samples_* annotations then treat the samples missing from
+            the genotypes as hom-ref.
+        """
+        self._sparse_genotypes = sparse_genotypes
+        super().__init__(*args, **kwargs)
 
     @row_annotation(disable_index=True)
     def genotypes(self):
-        return hl.agg.collect(hl.struct(**self._genotype_fields()))
+        genotype = hl.struct(**self._genotype_fields())
+        if self._sparse_genotypes and 'num_alt' in genotype:
+            return hl.agg.filter(self._is_sparse_genotype(genotype), hl.agg.collect(genotype))
+        return hl.agg.collect(genotype)
 
     @row_annotation(fn_require=genotypes)
     def samples_no_call(self):
@@ -264,28 +352,72 @@ class SeqrGenotypesSchema(BaseMTSchema):
 
     @row_annotation(fn_require=genotypes)
     def samples_num_alt(self, start=1, end=3, step=1):
-        return hl.struct(**{
-            f'{i}': self._genotype_filter_samples(lambda g: g.num_alt == i)
-            for i in range(start, end, step)
-        })
+        return self._genotype_bin_samples(lambda g: g.num_alt, start, end, step, bin_name=lambda i: f'{i}')
 
     @row_annotation(fn_require=genotypes)
-    def samples_gq(self, start=0, end=95, step=5):
+    def samples_gq(self, start=0, end=GQ_BINS_END, step=5):
         # struct of x_to_y to a set of samples in range of x and y for gq.
-        return hl.struct(**{
-            f'{i}_to_{i + step}': self._genotype_filter_samples(lambda g: ((g.gq >= i) & (g.gq < i+step)))
-            for i in range(start, end, step)
-        })
+        return self._genotype_bin_samples(lambda g: g.gq, start, end, step)
 
     @row_annotation(fn_require=genotypes)
     def samples_ab(self, start=0, end=45, step=5):
         # struct of x_to_y to a set of samples in range of x and y for ab.
-        return hl.struct(**{
-            f'{i}_to_{i + step}': self._genotype_filter_samples(
-                lambda g: ((g.num_alt == 1) & ((g.ab*100) >= i) & ((g.ab*100) < i+step))
-            )
-            for i in range(start, end, step)
-        })
+        return self._genotype_bin_samples(lambda g: g.ab*100, start, end, step, filter=lambda g: g.num_alt == 1)
+
+    @classmethod
+    def encode_genotypes(cls, mt):
+        """
+        Store the genotypes as a struct of arrays, one per genotype field, rather than an array of structs. Sample
+        ids are replaced by their index in the `genotype_sample_ids` global, the float fields of
+        GENOTYPE_FLOAT_SCALES by scaled integers, and num_alt is shifted by one so no-calls (-1) aren't negative.
+        Hail writes integers as variable-length, so the small non-negative ints only take a byte each.
+        :param mt: MT with the `genotypes` row annotation
+        :return: MT with encoded genotypes, see decode_genotypes
+        """
+        sample_ids = mt.s.collect()
+        sample_index = hl.literal({sample_id: i for i, sample_id in enumerate(sample_ids)})
+
+        def encode(field):
+            if field == 'sample_id':
+                return 'sample_index', mt.genotypes.map(lambda g: sample_index[g.sample_id])
+            values = mt.genotypes.map(lambda g: g[field])
+            if field in cls.GENOTYPE_FLOAT_SCALES:
+                values = values.map(lambda value: hl.int(hl.round(value * cls.GENOTYPE_FLOAT_SCALES[field])))
+            if field == 'num_alt':
+                values = values.map(lambda value: value + 1)
+            return field, values
+
+        mt = mt.annotate_globals(genotype_sample_ids=sample_ids)
+        return mt.annotate_rows(genotypes=hl.struct(**dict(encode(field) for field in mt.genotypes.dtype.element_type)))
+
+    @classmethod
+    def decode_genotypes(cls, ht, sample_ids):
+        """
+        Convert the genotypes written by encode_genotypes back to an array of structs.
+        :param ht: table with encoded `genotypes`
+        :param sample_ids: list of sample ids, the `genotype_sample_ids` global of the encoded MT
+        :return: table
+        """
+        encoded = ht.genotypes
+        sample_ids = hl.literal(sample_ids)
+
+        def decode(field, i):
+            if field == 'sample_index':
+                return 'sample_id', sample_ids[encoded.sample_index[i]]
+            if field in cls.GENOTYPE_FLOAT_SCALES:
+                return field, hl.float(encoded[field][i]) / cls.GENOTYPE_FLOAT_SCALES[field]
+            if field == 'num_alt':
+                return field, encoded[field][i] - 1
+            return field, encoded[field][i]
+
+        return ht.annotate(genotypes=hl.range(hl.len(encoded.sample_index)).map(
+            lambda i: hl.struct(**dict(decode(field, i) for field in encoded))
+        ))
+
+    def _is_sparse_genotype(self, genotype):
+        # Non-ref calls and no-calls are kept in sparse genotypes, and so are the hom-ref calls in a samples_gq bin, so
+        # a GQ filter still excludes low quality hom-ref calls.
+        return (genotype.num_alt != 0) | (genotype.gq < self.GQ_BINS_END)
 
     def _num_alt(self, is_called):
         return hl.if_else(is_called, self.mt.GT.n_alt_alleles(), -1)
@@ -294,6 +426,41 @@ class SeqrGenotypesSchema(BaseMTSchema):
         # Filter on the genotypes.
         return hl.set(self.mt.genotypes.filter(filter).map(lambda g: g.sample_id))
 
+    def _genotype_bin_samples(self, value, start, end, step, filter=None, bin_name=None, open_bin_name=None):
+        """
+        Bin the samples by a genotype value in a single pass over the genotypes, rather than filtering the
+        genotypes once per bin.
+        :param value: function of a genotype returning the value to bin. Missing values are not binned.
+        :param start: lower bound of the first bin
+        :param end: the bins start at each multiple of step from start up to end, excluded
+        :param step: width of the bins
+        :param filter: optional function of a genotype selecting the genotypes to bin
+        :param bin_name: function of a bin lower bound returning the bin field name, `<lower>_to_<upper>` by default
+        :param open_bin_name: if given, the values at or above the upper bound of the last bin go in a bin of this name
+        :return: struct of bin name to the set of the sample ids in the bin
+        """
+        lower_bounds = list(range(start, end, step))
+        edges = lower_bounds + [lower_bounds[-1] + step]
+        names = [bin_name(i) if bin_name else f'{i}_to_{i + step}' for i in lower_bounds]
+        if open_bin_name:
+            names.append(open_bin_name)
+
+        edges_expr = hl.literal([float(edge) for edge in edges])
+
+        def bin_index(g):
+            v = hl.float64(value(g))
+            # binary_search gives the first edge not smaller than the value, the bin starts at the edge before it
+            # unless the value is on the edge.
+            i = hl.binary_search(edges_expr, v)
+            i = hl.if_else(i < len(edges), hl.if_else(edges_expr[i] == v, i, i - 1), i - 1)
+            i = hl.or_missing((i >= 0) & (i < len(names)), i)
+            return i if filter is None else hl.or_missing(filter(g), i)
+
+        return hl.bind(
+            lambda bins: hl.struct(**{name: bins.get(i, hl.empty_set(hl.tstr)) for i, name in enumerate(names)}),
+            self.mt.genotypes.aggregate(lambda g: hl.agg.group_by(bin_index(g), hl.agg.collect_as_set(g.sample_id))),
+        )
+
     def _genotype_fields(self):
         # Convert the mt genotype entries into num_alt, gq, ab, dp, and sample_id.
         is_called = hl.is_defined(self.mt.GT)
@@ -312,6 +479,11 @@ class SeqrGenotypesSchema(BaseMTSchema):
 
 
 class SeqrMcriVariantSchema(BaseSeqrSchema):
+    SOURCE_ROW_FIELDS = (
+        'info.AC_MCRI', 'info.AN_MCRI', 'info.AF_MCRI', 'info.GT.All.Diseases', 'info.GT.All.Inheritances',
+        'info.GT.Alt.Res.Flag', 'info.GT.Flag', 'info.GT.GeneClass.Info', 'info.GT.GeneClass', 'info.GT.Previous',
+        'info.GT.VarClass.Num',
+    )
 
     @row_annotation(name='pop_mcri_AC')
     def acMcri(self):
@@ -57,6 +57,8 @@ def get_cpx_interval(x):
 
 
 class SeqrSVVariantSchema(BaseVariantSchema):
+    # The gene predictions are read from every PREDICTED_ INFO field, so the whole INFO struct is kept.
+    SOURCE_ROW_FIELDS = ('info', 'filters')
 
     def __init__(self, *args, gene_id_mapping=None, **kwargs):
         super().__init__(*args, **kwargs)
@@ -224,6 +226,7 @@ class SeqrSVVariantSchema(BaseVariantSchema):
 
 
 class SeqrSVGenotypesSchema(SeqrGenotypesSchema):
+    SOURCE_ENTRY_FIELDS = ('GT', 'GQ', 'RD_CN', 'CONC_ST')
 
     def _genotype_fields(self):
         is_called = hl.is_defined(self.mt.GT)
@@ -244,6 +247,10 @@ class SeqrSVGenotypesSchema(SeqrGenotypesSchema):
             'new_call': hl.or_missing(is_called, ~was_previously_called | novel_genotype),
         }
 
+    def _is_sparse_genotype(self, genotype):
+        # Also keep the hom-ref calls of samples previously called with an alt allele, see samples_new_call.
+        return (genotype.num_alt != 0) | hl.is_defined(genotype.prev_num_alt)
+
     @row_annotation(fn_require=SeqrGenotypesSchema.genotypes)
     def samples_new_call(self):
         return self._genotype_filter_samples(lambda g: g.new_call | hl.is_defined(g.prev_num_alt))
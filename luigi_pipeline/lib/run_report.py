@@ -0,0 +1,165 @@
+"""
+Machine-readable report of a task run, written as JSON next to the task output.
+
+Each stage records its wall time and the Spark jobs and stages it ran, plus rows, partitions and bytes where the
+caller knows them cheaply (e.g. for a checkpointed or written MT). Hail is lazy, so a stage that doesn't run an
+action only records the time to build its pipeline; its work is reported by the stage that materializes it.
+"""
+import json
+import logging
+import statistics
+import time
+import urllib.request
+import uuid
+from contextlib import contextmanager
+
+import hail as hl
+
+logger = logging.getLogger(__name__)
+
+
+def path_size(path):
+    """
+    Total size in bytes of the files under a path, e.g. a written MT or table.
+    """
+    return sum(
+        path_size(f['path']) if f['is_dir'] else f['size_bytes']
+        for f in hl.hadoop_ls(path)
+    )
+
+
+def run_report_path(path, name='run_report'):
+    """
+    Path of the run report written next to a task output, e.g. `<dest_path>.run_report.json`.
+    """
+    return f'{path.rstrip("/")}.{name}.json'
+
+
+# Slowest tasks listed per Spark stage in the task durations of a stage report.
+SLOWEST_TASKS = 10
+
+
+@contextmanager
+def report_stage(run_report, name, task_durations=False):
+    """
+    Stage of an optional run report, so task methods also work when called outside of a reported run.
+    """
+    if run_report is None:
+        yield {}
+        return
+    with run_report.stage(name, task_durations=task_durations) as stage:
+        yield stage
+
+
+# Spark local properties set by SparkContext.setJobGroup.
+JOB_GROUP_PROPERTIES = ('spark.jobGroup.id', 'spark.job.description', 'spark.job.interruptOnCancel')
+
+
+def _spark_context():
+    return getattr(hl.current_backend(), 'sc', None)
+
+
+def spark_task_durations(sc, stage_ids):
+    """
+    Summary of the durations of the tasks (one per partition) of Spark stages, from the REST API of the Spark UI.
+    :return: dict of stage id to task count, median and max seconds and the slowest partitions, or None if the
+        Spark UI is not available
+    """
+    if not sc.uiWebUrl:
+        return None
+    durations = {}
+    try:
+        for stage_id in stage_ids:
+            url = f'{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}/stages/{stage_id}'
+            with urllib.request.urlopen(f'{url}?details=true&taskStatus=SUCCESS') as response:
+                attempts = json.load(response)
+            tasks = [task for attempt in attempts for task in attempt.get('tasks', {}).values()]
+            if not tasks:
+                continue
+            for task in tasks:
+                task['seconds'] = task.get('duration', 0) / 1000
+            seconds = [task['seconds'] for task in tasks]
+            slowest = sorted(tasks, key=lambda task: task['seconds'], reverse=True)[:SLOWEST_TASKS]
+            durations[stage_id] = {
+                'tasks': len(tasks),
+                'median_seconds': round(statistics.median(seconds), 3),
+                'max_seconds': round(max(seconds), 3),
+                'slowest': [{'partition': task['index'], 'seconds': task['seconds']} for task in slowest],
+            }
+    except OSError as e:
+        logger.warning(f'Could not read the Spark task durations: {e}')
+        return None
+    return durations
+
+
+class RunReport:
+
+    def __init__(self, task_id, report_path, parameters=None):
+        """
+        :param task_id: luigi task id
+        :param report_path: path of the JSON report
+        :param parameters: task parameters to include in the report
+        """
+        self.report_path = report_path
+        self._start = time.time()
+        self.report = {
+            'task_id': task_id,
+            'parameters': parameters or {},
+            'hail_version': hl.__version__,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self._start)),
+            'stages': [],
+        }
+
+    @contextmanager
+    def stage(self, name, task_durations=False):
+        """
+        Time a stage and collect the Spark jobs it runs. The yielded dict can be updated with more stage metrics.
+        Stages can be nested: the jobs of an inner stage are only collected by it, and the job group of the outer
+        stage is restored when it ends.
+        :param task_durations: also record the durations of the tasks of each Spark stage, to find stragglers
+        """
+        stage = {'name': name}
+        sc = _spark_context()
+        job_group = f'{name}-{uuid.uuid4().hex}'
+        if sc is not None:
+            previous_job_group = {prop: sc.getLocalProperty(prop) for prop in JOB_GROUP_PROPERTIES}
+            sc.setJobGroup(job_group, f'{self.report["task_id"]} {name}')
+        start = time.time()
+        try:
+            yield stage
+        finally:
+            stage['seconds'] = round(time.time() - start, 3)
+            if sc is not None:
+                tracker = sc.statusTracker()
+                job_ids = sorted(tracker.getJobIdsForGroup(job_group))
+                job_infos = [tracker.getJobInfo(job_id) for job_id in job_ids]
+                stage['spark_job_ids'] = job_ids
+                stage['spark_stage_ids'] = sorted(
+                    stage_id for job_info in job_infos if job_info for stage_id in job_info.stageIds
+                )
+                if task_durations:
+                    stage['spark_task_durations'] = spark_task_durations(sc, stage['spark_stage_ids'])
+                for prop, value in previous_job_group.items():
+                    sc.setLocalProperty(prop, value)
+            self.report['stages'].append(stage)
+            logger.info(f'Stage {name}: {stage}')
+
+    @staticmethod
+    def mt_metrics(mt, path=None):
+        """
+        Rows and partitions of a materialized MT or table (counting them is only cheap once it is written),
+        and the bytes written when its path is given.
+        """
+        metrics = {
+            'rows': mt.count_rows() if isinstance(mt, hl.MatrixTable) else mt.count(),
+            'partitions': mt.n_partitions(),
+        }
+        if path:
+            metrics['bytes_written'] = path_size(path)
+        return metrics
+
+    def write(self):
+        self.report['seconds'] = round(time.time() - self._start, 3)
+        with hl.hadoop_open(self.report_path, 'w') as f:
+            json.dump(self.report, f, indent=2, default=str)
+        logger.info(f'Wrote run report {self.report_path}')
@@ -0,0 +1,71 @@
+"""
+Compact table of the VEP results of an annotated MT.
+
+The table is keyed by locus/alleles and holds the VEP struct pruned to the fields the VEP-derived annotations
+read (see REQUIRED_VEP_FIELDS), with the consequence terms replaced by their index in the
+`vep_consequence_terms` global. It is written next to the MT, so the annotations derived from VEP can be
+recomputed by joining it, e.g. for another MT of the same variants, rather than by running VEP again.
+"""
+import logging
+
+import hail as hl
+
+from hail_scripts.computed_fields.vep import (
+    CONSEQUENCE_TERM_RANK_LOOKUP,
+    CONSEQUENCE_TERMS,
+    REQUIRED_VEP_FIELDS,
+    get_expr_for_decoded_vep_consequence_terms,
+    get_expr_for_encoded_vep_consequence_terms,
+    get_expr_for_vep_consequence_terms,
+)
+from hail_scripts.utils.hail_utils import prune_vep_expr
+
+logger = logging.getLogger(__name__)
+
+
+def vep_table_path(mt_path):
+    """
+    :param mt_path: path of the annotated MT
+    :return: path of the VEP table written next to it
+    """
+    return f'{mt_path.rstrip("/")}.vep.ht'
+
+
+def encode_vep_table(ht):
+    """
+    Select the pruned VEP results of a table with integer-encoded consequence terms. The terms missing from
+    CONSEQUENCE_TERMS, e.g. added by a newer VEP, are appended to the `vep_consequence_terms` global so nothing
+    is lost.
+    :param ht: table keyed by locus/alleles with a `vep` row field, e.g. the rows of the annotated MT
+    :return: table with the encoded `vep` row field, see decode_vep_table
+    """
+    vep = prune_vep_expr(ht.vep, REQUIRED_VEP_FIELDS)
+    other_terms = ht.aggregate(hl.agg.explode(
+        hl.agg.collect_as_set,
+        get_expr_for_vep_consequence_terms(vep).filter(
+            lambda t: hl.is_defined(t) & ~CONSEQUENCE_TERM_RANK_LOOKUP.contains(t)),
+    ))
+    if other_terms:
+        logger.info(f'Consequence terms missing from CONSEQUENCE_TERMS: {sorted(other_terms)}')
+    consequence_terms = CONSEQUENCE_TERMS + sorted(other_terms)
+    consequence_term_ids = hl.literal({term: i for i, term in enumerate(consequence_terms)})
+    ht = ht.select(vep=get_expr_for_encoded_vep_consequence_terms(vep, consequence_term_ids))
+    return ht.select_globals(vep_consequence_terms=consequence_terms)
+
+
+def decode_vep_table(ht):
+    """
+    Convert the VEP results written by encode_vep_table back to a VEP struct, with the pruned fields.
+    """
+    return ht.annotate(vep=get_expr_for_decoded_vep_consequence_terms(ht.vep, ht.vep_consequence_terms))
+
+
+def annotate_vep_table(mt, vep_ht):
+    """
+    Annotate the rows of the MT with the VEP results of the VEP table. Variants missing from the table get a
+    missing `vep`.
+    :param mt: MT keyed by locus/alleles
+    :param vep_ht: table written by encode_vep_table
+    """
+    vep_ht = decode_vep_table(vep_ht)
+    return mt.annotate_rows(vep=vep_ht[mt.row_key].vep)
@@ -4,6 +4,8 @@ import sys
 import hail as hl
 import luigi
 
+from hail_scripts.utils.partition_planner import plan_partitions
+
 from luigi_pipeline.lib.model.gcnv_mt_schema import (
     SeqrGCNVGenotypesSchema,
     SeqrGCNVVariantsAndGenotypesSchema,
@@ -42,6 +44,7 @@ class SeqrGCNVVariantMTTask(SeqrVCFToVariantMTTask):
 
     RUN_VEP = False
     SCHEMA_CLASS = SeqrGCNVVariantSchema
+    GENOTYPES_SCHEMA_CLASS = SeqrGCNVGenotypesSchema
 
     def split_multi_hts(self, mt, *args, **kwargs):
         return mt
@@ -54,7 +57,8 @@ class SeqrGCNVVariantMTTask(SeqrVCFToVariantMTTask):
         return mt
 
     def import_dataset(self):
-        ht = hl.import_table(self.source_paths[0], types=FIELD_TYPES, min_partitions=500)
+        ht = hl.import_table(self.source_paths[0], types=FIELD_TYPES,
+                              min_partitions=plan_partitions(self.source_paths[0]).n_partitions)
         mt = ht.to_matrix_table(
             row_key=['variant_name', 'svtype'], col_key=['sample_fix'],
             # Analagous to CORE_COLUMNS = [CHR_COL, SC_COL, SF_COL, CALL_COL, IN_SILICO_COL] in the old implementation
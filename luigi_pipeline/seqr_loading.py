@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 import pprint
@@ -7,22 +8,31 @@ import hail as hl
 import luigi
 import pkg_resources
 
+from luigi_pipeline.lib.annotation_cache import AnnotationCache, table_version
 from luigi_pipeline.lib.hail_tasks import (
     GCSorLocalTarget,
     HailElasticSearchTask,
     HailMatrixTableTask,
     MatrixTableSampleSetError,
 )
+from luigi_pipeline.lib.model.base_mt_schema import manifest_path
 from luigi_pipeline.lib.model.seqr_mt_schema import (
     SeqrGenotypesSchema,
     SeqrVariantsAndGenotypesSchema,
     SeqrVariantSchema,
 )
+from luigi_pipeline.lib.run_report import RunReport, report_stage
+from luigi_pipeline.lib.vep_table import (
+    annotate_vep_table,
+    encode_vep_table,
+    vep_table_path,
+)
 
 logger = logging.getLogger(__name__)
 GRCh37_STANDARD_CONTIGS = {'1','10','11','12','13','14','15','16','17','18','19','2','20','21','22','3','4','5','6','7','8','9','X','Y', 'MT'}
 GRCh38_STANDARD_CONTIGS = {'chr1','chr10','chr11','chr12','chr13','chr14','chr15','chr16','chr17','chr18','chr19','chr2','chr20','chr21','chr22','chr3','chr4','chr5','chr6','chr7','chr8','chr9','chrX','chrY', 'chrM'}
 OPTIONAL_CHROMOSOMES = ['MT', 'chrM', 'Y', 'chrY']
+CONTIG_ORDER = [str(i) for i in range(1, 23)] + ['X', 'Y', 'M', 'MT']
 VARIANT_THRESHOLD = 100
 CONST_GRCh37 = '37'
 CONST_GRCh38 = '38'
@@ -36,6 +46,15 @@ def check_if_path_exists(path, label=""):
     if not does_file_exist(path):
         raise ValueError(f"{label} path not found: {path}")
 
+def sorted_contigs(contigs):
+    """Sort contigs in reference genome order: 1-22, X, Y, M."""
+    return sorted(contigs, key=lambda contig: CONTIG_ORDER.index(contig.replace('chr', '', 1)))
+
+def contig_groups(standard_contigs, group_size):
+    """Split the standard contigs into ordered groups of at most group_size contigs."""
+    contigs = sorted_contigs(standard_contigs)
+    return [contigs[i:i + group_size] for i in range(0, len(contigs), group_size)]
+
 class SeqrValidationError(Exception):
     pass
 
@@ -51,6 +70,8 @@ class SeqrVCFToMTTask(HailMatrixTableTask):
     sample_type = luigi.ChoiceParameter(choices=['WGS', 'WES'], description='Sample type, WGS or WES', var_type=str)
     dont_validate = luigi.BoolParameter(description='Disable checking whether the dataset matches the specified '
                                                     'genome version and WGS vs. WES sample type.')
+    validation_sample_fraction = luigi.FloatParameter(default=1.0, description='Fraction of the callset partitions read '
+                                                      'by validation. Lower it to speed up the validation of very large WGS callsets.')
     dataset_type = luigi.ChoiceParameter(choices=['VARIANTS', 'SV', 'MITO'], default='VARIANTS',
                                          description='VARIANTS or SV or MITO.')
     remap_path = luigi.OptionalParameter(default=None,
@@ -62,13 +83,64 @@ class SeqrVCFToMTTask(HailMatrixTableTask):
     grch38_to_grch37_ref_chain = luigi.OptionalParameter(default='gs://hail-common/references/grch38_to_grch37.over.chain.gz',
                                         description="Path to GRCh38 to GRCh37 coordinates file")
     hail_temp_dir = luigi.OptionalParameter(default=None, description="Networked temporary directory used by hail for temporary file storage. Must be a network-visible file path.")
+    annotation_cache_path = luigi.OptionalParameter(default=None, description="Directory of the persistent annotation cache. "
+                                                    "Only variants missing from the cache are annotated, and they are added to it after the load.")
+    checkpoint_stages = luigi.ListParameter(default=['split', 'vep', 'annotate'],
+                                            description="Stages to checkpoint when checkpoint_path is set: split, vep, annotate.")
+    contig_group_size = luigi.IntParameter(default=0, description="Fan the load out into sub-tasks of this many contigs, "
+                                           "which are annotated independently and concatenated. 0 loads all contigs in one task.")
+    contigs = luigi.ListParameter(default=[], description="Only load these contigs. Set on the sub-tasks of a contig fan-out.")
+    drop_monomorphic_rows = luigi.BoolParameter(description="Drop the variants where no sample has a non-ref call, "
+                                                 "including the all no-call variants, and '*' alleles before VEP and the reference joins.")
+    downcast_entry_floats = luigi.BoolParameter(description="Store the float entry fields kept after import as float32.")
+    annotation_profile_fraction = luigi.FloatParameter(default=0.0, description="Profile the cost of each annotation on this "
+                                                       "fraction of the partitions and add it to the run report. 0 disables profiling.")
+    vep_table = luigi.BoolParameter(description="Also write the pruned VEP results, with integer-encoded consequence terms, "
+                                    "to a table next to the MT, from which SeqrReannotateMTTask can recompute the VEP-derived annotations.")
     RUN_VEP = True
     SCHEMA_CLASS = SeqrVariantsAndGenotypesSchema
+    # Schema annotating the genotypes of this task's output in a separate task, whose entry fields have to be kept.
+    GENOTYPES_SCHEMA_CLASS = None
+    # Imported row and entry fields used by the task itself, e.g. by the contig filter and generate_callstats.
+    # locus and alleles are usually the row key, but not when a subclass keys the rows differently, e.g. SVs.
+    SOURCE_ROW_FIELDS = ('locus', 'alleles')
+    SOURCE_ENTRY_FIELDS = ('GT',)
+    CHECKPOINT_STAGES = ('split', 'vep', 'annotate')
+    _annotation_cache = None
+
+    def is_contig_fan_out(self):
+        return self.contig_group_size > 0 and not self.contigs
+
+    def standard_contigs(self):
+        return GRCh38_STANDARD_CONTIGS if self.genome_version == '38' else GRCh37_STANDARD_CONTIGS
+
+    def requires(self):
+        if not self.is_contig_fan_out():
+            return super().requires()
+        if self.vep_cache_path:
+            raise ValueError('vep_cache_path is not supported with contig_group_size, '
+                             'parallel contig tasks would overwrite the VEP cache')
+        return [
+            self.clone(
+                source_paths=json.dumps(self.source_paths),
+                dest_path=os.path.join(f'{self.dest_path}_contigs', f'{contigs[0]}-{contigs[-1]}.mt'),
+                checkpoint_path=os.path.join(self.checkpoint_path, f'{contigs[0]}-{contigs[-1]}') if self.checkpoint_path else None,
+                contig_group_size=0,
+                contigs=contigs,
+            )
+            for contigs in contig_groups(self.standard_contigs(), self.contig_group_size)
+        ]
 
     def run(self):
         if self.hail_temp_dir:
             hl.init(tmp_dir=self.hail_temp_dir) # Need to use the GCP bucket as temp storage for very large callset joins
 
+        run_report = self.new_run_report()
+        if self.is_contig_fan_out():
+            self.concatenate_contig_mts()
+            run_report.write()
+            return
+
         # first validate paths
         for source_path in self.source_paths:
             if '*' in source_path:
@@ -86,6 +158,7 @@ class SeqrVCFToMTTask(HailMatrixTableTask):
         if self.hail_temp_dir: check_if_path_exists(self.hail_temp_dir, "hail_temp_dir")
 
         self.read_input_write_mt()
+        run_report.write()
 
     def get_schema_class_kwargs(self):
         ref = hl.read_table(self.reference_ht_path)
@@ -105,6 +178,14 @@ class SeqrVCFToMTTask(HailMatrixTableTask):
             mt = mt.annotate_globals(clinvar_version=clinvar_data.index_globals().version)
         return mt
 
+    @staticmethod
+    def annotate_fingerprint_globals(mt, fingerprints):
+        """
+        Record the fingerprints of the annotations in the globals, so SeqrReannotateMTTask can find the
+        annotations that changed since.
+        """
+        return mt.annotate_globals(annotation_fingerprints=hl.literal(fingerprints, hl.tdict(hl.tstr, hl.tstr)))
+
     def import_dataset(self):
         logger.info("Args:")
         pprint.pprint(self.__dict__)
@@ -114,70 +195,343 @@ class SeqrVCFToMTTask(HailMatrixTableTask):
     def read_input_write_mt(self):
         hl._set_flags(use_new_shuffle='1') # Interval ref data join causes shuffle death, this prevents it
 
-        mt = self.import_dataset()
-        if hasattr(mt, 'PL'):
-            mt = mt.drop('PL')
-        if hasattr(mt, 'AF'):
-            mt = mt.drop('AF')
+        kwargs = self.get_schema_class_kwargs()
+        self._annotation_cache = self.annotation_cache(kwargs) if self.annotation_cache_path else None
+        cache_ht = self._annotation_cache.read() if self._annotation_cache else None
+
+        stage, mt = self.latest_checkpoint()
+        cached_mt = None
+        if stage is None:
+            mt = self.import_and_split()
+            with report_stage(self._run_report, 'split') as stage_report:
+                mt = self.report_checkpoint_stage(mt, 'split', stage_report)
+        if stage in (None, 'split'):
+            # With the annotation cache, only the variants missing from the cache go through VEP.
+            if self._annotation_cache:
+                mt, cached_mt = AnnotationCache.split(mt, cache_ht)
+            with report_stage(self._run_report, 'vep', task_durations=True) as stage_report:
+                mt = self.report_checkpoint_stage(self.run_vep_stage(mt), 'vep', stage_report)
+        if stage != 'annotate':
+            if self.annotation_profile_fraction:
+                with report_stage(self._run_report, 'annotation_profile') as stage_report:
+                    stage_report['annotations'] = self.SCHEMA_CLASS(mt, **kwargs).profile_annotations(
+                        self.annotation_profile_fraction)
+            with report_stage(self._run_report, 'annotate') as stage_report:
+                schema = self.SCHEMA_CLASS(mt, **kwargs).annotate_all(overwrite=True)
+                mt = self.annotate_fingerprint_globals(schema.select_annotated_mt(), schema.annotation_fingerprints())
+                if cache_ht is not None:
+                    mt = self.restore_cached_variants(mt, kwargs, cache_ht, cached_mt)
+                mt = self.annotate_globals(mt, kwargs.get("clinvar_data"))
+                mt = self.report_checkpoint_stage(mt, 'annotate', stage_report)
+
+        mt.describe()
+        with report_stage(self._run_report, 'write') as stage_report:
+            mt.write(self.output().path, stage_locally=True, overwrite=True)
+        if self._run_report:
+            stage_report.update(RunReport.mt_metrics(hl.read_matrix_table(self.output().path), self.output().path))
+        self.write_schema_manifest()
+
+        # Contig sub-tasks run in parallel, so the fan-out task updates the cache once they are concatenated.
+        if not self.contigs:
+            with report_stage(self._run_report, 'update_annotation_cache'):
+                self.update_annotation_cache()
+            self.write_vep_table()
+        self.remove_checkpoints()
+
+    def write_schema_manifest(self):
+        """
+        Write the manifest of the schema class next to the output MT, with the dtypes of the written annotations,
+        so the ES mapping can be generated and checked without instantiating the schema.
+        """
+        self.SCHEMA_CLASS.write_manifest(manifest_path(self.output().path),
+                                         hl.read_matrix_table(self.output().path))
+
+    def write_vep_table(self):
+        """
+        Write the VEP results of the output MT to a compact table next to it, see lib/vep_table.py.
+        """
+        if not self.vep_table:
+            return
+        ht = hl.read_matrix_table(self.output().path).rows()
+        if 'vep' not in ht.row:
+            logger.info('No vep field in the output MT, skipping the VEP table')
+            return
+        with report_stage(self._run_report, 'vep_table') as stage_report:
+            stage_report['path'] = vep_table_path(self.output().path)
+            encode_vep_table(ht).write(stage_report['path'], overwrite=True)
+
+    def report_checkpoint_stage(self, mt, stage, stage_report):
+        """
+        Checkpoint the stage and add the rows and partitions of the checkpoint to the stage report.
+        Without a checkpoint the stage is only materialized by the final write.
+        """
+        mt = self.checkpoint_stage(mt, stage)
+        if self._run_report and self.is_checkpointed(stage):
+            stage_report.update(RunReport.mt_metrics(mt, self._checkpoint_stage_path(stage)))
+        return mt
+
+    def update_annotation_cache(self):
+        if self._annotation_cache:
+            self._annotation_cache.update(hl.read_matrix_table(self.output().path).rows(),
+                                          self.SCHEMA_CLASS.get_cacheable_annotation_names())
+
+    def concatenate_contig_mts(self):
+        """
+        Concatenate the MTs written by the contig sub-tasks. The groups are disjoint and in contig order, so
+        the result is already sorted.
+        """
+        mts = [hl.read_matrix_table(target.path) for target in self.input()]
+        mt = mts[0].union_rows(*mts[1:])
+        with report_stage(self._run_report, 'write') as stage_report:
+            mt.write(self.output().path, stage_locally=True, overwrite=True)
+        if self._run_report:
+            stage_report.update(RunReport.mt_metrics(hl.read_matrix_table(self.output().path), self.output().path),
+                                contig_tasks=len(mts))
+        self.write_schema_manifest()
+
+        if self.annotation_cache_path:
+            with report_stage(self._run_report, 'update_annotation_cache'):
+                self._annotation_cache = self.annotation_cache(self.get_schema_class_kwargs())
+                self.update_annotation_cache()
+        self.write_vep_table()
+
+    def import_and_split(self):
+        """
+        Import the callset, split multi-allelic variants, validate and subset it.
+        """
+        with report_stage(self._run_report, 'import'):
+            mt = self.import_dataset()
+            if self.contigs:
+                mt = hl.filter_intervals(mt, [
+                    hl.parse_locus_interval(contig, reference_genome=mt.locus.dtype.reference_genome)
+                    for contig in self.contigs
+                ])
+            mt = self.prune_source_fields(mt)
         mt = self.split_multi_hts(mt)
-        standard_contigs = GRCh38_STANDARD_CONTIGS if self.genome_version == '38' else GRCh37_STANDARD_CONTIGS
         mt = mt.filter_rows(
-            hl.set(standard_contigs).contains(
+            hl.set(self.standard_contigs()).contains(
                 mt.locus.contig,
             ),
         )
         if not self.dont_validate:
-            self.validate_mt(mt, self.genome_version, self.sample_type)
+            with report_stage(self._run_report, 'validate'):
+                self.validate_mt(mt, self.genome_version, self.sample_type, contigs=self.contigs or None,
+                                 sample_fraction=self.validation_sample_fraction)
         if self.remap_path:
             mt = self.remap_sample_ids(mt, self.remap_path)
         if self.subset_path:
             mt = self.subset_samples_and_variants(mt, self.subset_path)
+        mt = self.generate_callstats(mt, drop_monomorphic=self.drop_monomorphic_rows)
+        if self.RUN_VEP or self.drop_monomorphic_rows:
+            mt = mt.filter_rows((mt.alleles[0] != '*') & (mt.alleles[1] != '*'))
+        return mt
+
+    def source_fields(self):
+        """
+        Imported row and entry fields read by the schema classes of this task.
+        :return: (row fields, entry fields), or None if a schema class doesn't declare its source fields
+        """
+        schema_classes = [self.SCHEMA_CLASS] + ([self.GENOTYPES_SCHEMA_CLASS] if self.GENOTYPES_SCHEMA_CLASS else [])
+        source_fields = [schema_class.get_source_fields() for schema_class in schema_classes]
+        if None in source_fields:
+            return None
+        row_fields = {f for fields, _ in source_fields for f in fields} | set(self.SOURCE_ROW_FIELDS)
+        entry_fields = {f for _, fields in source_fields for f in fields} | set(self.SOURCE_ENTRY_FIELDS)
+        return sorted(row_fields), sorted(entry_fields)
+
+    def prune_source_fields(self, mt):
+        """
+        Drop the imported INFO and FORMAT fields no annotation reads, so they aren't carried through the
+        split, VEP and annotation stages. Optionally downcast the remaining float entry fields to float32.
+        """
+        source_fields = self.source_fields()
+        if source_fields is None:
+            logger.info(f'Source fields of {self.SCHEMA_CLASS.__name__} are not declared, keeping all fields')
+            mt = mt.drop(*[f for f in ('PL', 'AF') if f in mt.entry])
+        else:
+            row_fields, entry_fields = source_fields
+            rows = {f: mt[f] for f in row_fields if f in mt.row_value}
+            info_fields = {f.split('.', 1)[1] for f in row_fields if f.startswith('info.')}
+            # INFO fields are read with defaults, so INFO is kept even when none of them are in the callset.
+            if info_fields and 'info' not in rows and 'info' in mt.row_value:
+                rows['info'] = mt.info.select(*[f for f in mt.info if f in info_fields])
+            mt = mt.select_rows(**rows)
+            mt = mt.select_entries(*[f for f in entry_fields if f in mt.entry])
+            logger.info(f'Kept row fields {list(mt.row_value)} and entry fields {list(mt.entry)}')
+
+        if self.downcast_entry_floats:
+            mt = mt.annotate_entries(**{
+                f: hl.float32(mt[f]) if mt[f].dtype == hl.tfloat64 else mt[f].map(hl.float32)
+                for f in mt.entry
+                if mt[f].dtype == hl.tfloat64 or mt[f].dtype == hl.tarray(hl.tfloat64)
+            })
+        return mt
+
+    def run_vep_stage(self, mt):
+        """
+        Run liftover and VEP.
+        """
         if self.genome_version == '38':
             mt = self.add_37_coordinates(mt, self.grch38_to_grch37_ref_chain)
-        mt = self.generate_callstats(mt)
         if self.RUN_VEP:
-            mt = mt.filter_rows((mt.alleles[0] != '*') & (mt.alleles[1] != '*'))
             mt = HailMatrixTableTask.run_vep(mt, self.genome_version, self.vep_runner,
-                                             vep_config_json_path=self.vep_config_json_path)
-
-        kwargs = self.get_schema_class_kwargs()
-        mt = self.SCHEMA_CLASS(mt, **kwargs).annotate_all(overwrite=True).select_annotated_mt()
-        mt = self.annotate_globals(mt, kwargs.get("clinvar_data"))
+                                             vep_config_json_path=self.vep_config_json_path,
+                                             vep_cache_path=self.vep_cache_path, vep_two_tier=self.vep_two_tier,
+                                             vep_balance_partitions=self.vep_balance_partitions,
+                                             vep_prune_fields=self.vep_prune_fields)
+        return mt
 
-        mt.describe()
-        mt.write(self.output().path, stage_locally=True, overwrite=True)
+    def annotation_cache(self, kwargs):
+        """
+        Annotation cache for the reference data, VEP and schema versions of this load. The fingerprints of the
+        cacheable annotations are part of the version, so changing their code starts a new cache.
+        """
+        fingerprints = self.SCHEMA_CLASS(None, **kwargs).annotation_fingerprints()
+        version_info = {
+            'schema': f'{self.SCHEMA_CLASS.__module__}.{self.SCHEMA_CLASS.__qualname__}',
+            'annotations': {name: fingerprints[name] for name in self.SCHEMA_CLASS.get_cacheable_annotation_names()},
+            'genome_version': self.genome_version,
+            'vep_runner': self.vep_runner if self.RUN_VEP else None,
+            'vep_config_json_path': self.vep_config_json_path if self.RUN_VEP else None,
+            'grch38_to_grch37_ref_chain': self.grch38_to_grch37_ref_chain if self.genome_version == '38' else None,
+            'reference_ht_path': self.reference_ht_path,
+            'interval_ref_ht_path': self.interval_ref_ht_path,
+            'clinvar_ht_path': self.clinvar_ht_path,
+            'hgmd_ht_path': self.hgmd_ht_path,
+        }
+        # Only set when enabled, so the caches of loads without these VEP options stay valid.
+        if self.RUN_VEP and self.vep_two_tier:
+            version_info['vep_two_tier'] = True
+        if self.RUN_VEP and self.vep_prune_fields:
+            version_info['vep_prune_fields'] = True
+        for name, ht in kwargs.items():
+            if isinstance(ht, hl.Table):
+                version_info[f'{name}_version'] = table_version(ht)
+        return AnnotationCache(self.annotation_cache_path, version_info)
+
+    def restore_cached_variants(self, mt, kwargs, cache_ht, cached_mt=None):
+        """
+        Add the variants that were skipped because they are in the annotation cache. Their cached annotations are
+        restored and only the callset-specific annotations (genotypes, AC, filters...) are computed.
+        :param mt: annotated MT of the variants missing from the cache
+        :param cached_mt: split MT of the cached variants with their cached annotations, from AnnotationCache.split.
+            When resuming after the vep stage, it is restored from the split stage instead.
+        """
+        if cached_mt is None:
+            cached_mt = AnnotationCache.restore(self.split_stage_mt(), cache_ht)
+        cached_fields = [f for f in self.SCHEMA_CLASS.get_cacheable_annotation_names() if f in cache_ht.row]
+        cached_mt = self.SCHEMA_CLASS(cached_mt, **kwargs).annotate_all(overwrite=True, exclude=cached_fields).mt
+        return mt.union_rows(cached_mt.select_rows(*mt.row_value))
+
+    def split_stage_mt(self):
+        mt = self.read_checkpoint('split')
+        return mt if mt is not None else self.import_and_split()
+
+    def checkpoint_fingerprint(self):
+        fingerprint = super().checkpoint_fingerprint()
+        if self._annotation_cache:
+            fingerprint['annotation_cache_version'] = self._annotation_cache.version
+        return fingerprint
 
     def split_multi_hts(self, mt):
         """
         Additional logic is added here to support VCFs which contain biallelic and
         multiallelic rows.  The `split_multi_hts` function, by default, will fail if there are both
-        split and unsplit loci.  We want to only run the split on the multiallelic rows
-        for performance reasons, rather than allowing a shuffle to happen.
+        split and unsplit loci, and splitting with `permit_shuffle=True` shuffles every split row.
+
+        Instead, like `hl.split_multi`, every alt allele gets its own row with its minimal representation.
+        The split rows are checkpointed, so the source is read and split once. The alleles whose minimal
+        representation stays at the locus of their row keep the locus order, so re-keying them by locus and
+        alleles only sorts the rows of each locus, locally in each partition, including co-located biallelic and
+        multiallelic rows. Only the few alleles whose minimal representation moves the locus are shuffled into place.
+        """
+        def split_allele(i):
+            min_rep = hl.min_rep(mt.locus, [mt.alleles[0], mt.alleles[i]])
+            return hl.struct(locus=min_rep.locus, alleles=min_rep.alleles, a_index=i)
+
+        split = mt.annotate_rows(
+            was_split=hl.len(mt.alleles) > 2,
+            old_alleles=mt.alleles,
+            split_alleles=hl.range(1, hl.len(mt.alleles)).map(split_allele),
+        )
+        split = split.explode_rows(split.split_alleles)
+        # Keyed by locus only, the alleles can be replaced in place.
+        split = split.key_rows_by('locus')
+        split = split.annotate_rows(
+            alleles=split.split_alleles.alleles,
+            a_index=split.split_alleles.a_index,
+            moved_locus=hl.or_missing(split.split_alleles.locus != split.locus, split.split_alleles.locus),
+        )
+        split = split.annotate_entries(**self._split_entries(split))
+        split = split.drop('split_alleles', 'old_alleles').checkpoint(hl.utils.new_temp_file('split_multi', 'mt'))
+
+        kept = split.filter_rows(hl.is_missing(split.moved_locus)).drop('moved_locus')
+        # The locus of the moved alleles changes, so they are re-keyed from scratch with a shuffle.
+        moved = split.filter_rows(hl.is_defined(split.moved_locus)).key_rows_by()
+        moved = moved.annotate_rows(locus=moved.moved_locus).drop('moved_locus')
+        return kept.key_rows_by('locus', 'alleles').union_rows(moved.key_rows_by('locus', 'alleles'), _check_cols=False)
+
+    @staticmethod
+    def _split_entries(mt):
+        """
+        Downcode the entries of split rows like `hl.split_multi_hts`, entries of biallelic rows are unchanged.
         """
-        bi = mt.filter_rows(hl.len(mt.alleles) == 2)
-        bi = bi.annotate_rows(a_index=1, was_split=False)
-        multi = mt.filter_rows(hl.len(mt.alleles) > 2)
-        split = hl.split_multi_hts(multi, permit_shuffle=True)
-        return split.union_rows(bi)
+        def split_value(split_expr, value):
+            return hl.if_else(mt.was_split, split_expr, value)
+
+        entries = {}
+        if 'GT' in mt.entry:
+            entries['GT'] = split_value(hl.downcode(mt.GT, mt.a_index), mt.GT)
+        if 'AD' in mt.entry:
+            entries['AD'] = split_value(
+                hl.or_missing(hl.is_defined(mt.AD), [hl.sum(mt.AD) - mt.AD[mt.a_index], mt.AD[mt.a_index]]), mt.AD)
+        if 'PL' in mt.entry:
+            pl = hl.or_missing(
+                hl.is_defined(mt.PL),
+                hl.range(0, 3).map(lambda i: hl.min(
+                    hl.range(0, hl.triangle(hl.len(mt.old_alleles)))
+                    .filter(lambda j: hl.downcode(hl.unphased_diploid_gt_index_call(j), mt.a_index) ==
+                            hl.unphased_diploid_gt_index_call(i))
+                    .map(lambda j: mt.PL[j])
+                )),
+            )
+            entries['PL'] = split_value(pl, mt.PL)
+            if 'GQ' in mt.entry:
+                entries['GQ'] = split_value(hl.or_else(hl.gq_from_pl(pl), mt.GQ), mt.GQ)
+        if 'PGT' in mt.entry:
+            entries['PGT'] = split_value(hl.downcode(mt.PGT, mt.a_index), mt.PGT)
+        return entries
 
     @staticmethod
-    def contig_check(mt, standard_contigs, threshold):
+    def contig_check(mt, standard_contigs, threshold, contig_counts=None, sampled=False):
+        """
+        :param contig_counts: rows per contig if they were already counted, see validation_stats
+        :param sampled: the contig counts are estimated from a sample of the partitions. A contig whose rows are all
+            in partitions that weren't sampled isn't counted, and the rows of a contig can be over or under
+            estimated, so missing contigs and contigs under the threshold aren't reported.
+        """
         check_result_dict = {}
 
         # check chromosomes that are not in the VCF
-        row_dict = mt.aggregate_rows(hl.agg.counter(mt.locus.contig))
+        row_dict = contig_counts if contig_counts is not None else mt.aggregate_rows(hl.agg.counter(mt.locus.contig))
         contigs_set = set(row_dict.keys())
 
         all_missing_contigs = standard_contigs - contigs_set
         missing_contigs_without_optional = [contig for contig in all_missing_contigs if contig not in OPTIONAL_CHROMOSOMES]
 
-        if missing_contigs_without_optional:
+        if missing_contigs_without_optional and sampled:
+            logger.info('Contigs not found in the sampled partitions, not checked: {}'.format(
+                ', '.join(missing_contigs_without_optional)))
+        elif missing_contigs_without_optional:
             check_result_dict['Missing contig(s)'] = missing_contigs_without_optional
             logger.warning('Missing the following chromosomes(s):{}'.format(', '.join(missing_contigs_without_optional)))
 
         for k,v in row_dict.items():
             if k not in standard_contigs:
                 logger.warning(f'Chromosome {k} is unexpected.')
+            elif (k not in OPTIONAL_CHROMOSOMES) and (v < threshold) and sampled:
+                logger.warning(f'Chromosome {k} has about {v} rows in the sampled partitions, which is lower than '
+                               f'threshold {threshold}, not checked.')
             elif (k not in OPTIONAL_CHROMOSOMES) and (v < threshold):
                 check_result_dict.setdefault(f'Chromosome(s) whose variants count under threshold {threshold}',[]).append(k)
                 logger.warning(f'Chromosome {k} has {v} rows, which is lower than threshold {threshold}.')
@@ -185,7 +539,7 @@ class SeqrVCFToMTTask(HailMatrixTableTask):
         return check_result_dict
 
     @staticmethod
-    def validate_mt(mt, genome_version, sample_type):
+    def validate_mt(mt, genome_version, sample_type, contigs=None, sample_fraction=None):
         """
         Validate the mt by checking against a list of common coding and non-coding variants given its
         genome version. This validates genome_version, variants, and the reported sample type.
@@ -193,15 +547,25 @@ class SeqrVCFToMTTask(HailMatrixTableTask):
         :param mt: mt to validate
         :param genome_version: reference genome version
         :param sample_type: WGS or WES
+        :param contigs: only validate these contigs, e.g. in a contig sub-task
+        :param sample_fraction: only read this fraction of the partitions
         :return: True or Exception
         """
         if mt is None or not isinstance(mt, hl.MatrixTable):
             raise SeqrValidationError("mt should probably be a MatrixTable")
 
         if genome_version == CONST_GRCh37:
-            contig_check_result = SeqrVCFToMTTask.contig_check(mt, GRCh37_STANDARD_CONTIGS, VARIANT_THRESHOLD)
+            standard_contigs = GRCh37_STANDARD_CONTIGS
         elif genome_version == CONST_GRCh38:
-            contig_check_result = SeqrVCFToMTTask.contig_check(mt, GRCh38_STANDARD_CONTIGS, VARIANT_THRESHOLD)
+            standard_contigs = GRCh38_STANDARD_CONTIGS
+        if contigs:
+            standard_contigs = standard_contigs & set(contigs)
+        # Contig counts and common variant matches are computed in one pass over the callset.
+        validation_stats = HailMatrixTableTask.validation_stats(mt, genome_version, contigs=contigs,
+                                                                sample_fraction=sample_fraction)
+        contig_check_result = SeqrVCFToMTTask.contig_check(mt, standard_contigs, VARIANT_THRESHOLD,
+                                                           contig_counts=validation_stats['contig_counts'],
+                                                           sampled=validation_stats['sampled'])
 
         if bool(contig_check_result):
             err_msg = ''
@@ -209,12 +573,17 @@ class SeqrVCFToMTTask(HailMatrixTableTask):
                 err_msg += '{k}: {v}. '.format(k=k, v=', '.join(v))
             raise SeqrValidationError(err_msg)
 
-        sample_type_stats = HailMatrixTableTask.sample_type_stats(mt, genome_version)
+        sample_type_stats = HailMatrixTableTask.sample_type_stats(mt, genome_version, contigs=contigs,
+                                                                  validation_stats=validation_stats)
 
         for name, stat in sample_type_stats.items():
             logger.info('Table contains %i out of %i common %s variants.' %
                         (stat['matched_count'], stat['total_count'], name))
 
+        if contigs and not any(stat['total_count'] for stat in sample_type_stats.values()):
+            logger.info(f'No common validation variants on contigs {", ".join(contigs)}, skipping sample type validation.')
+            return True
+
         has_coding = sample_type_stats['coding']['match']
         has_noncoding = sample_type_stats['noncoding']['match']
 
@@ -247,11 +616,78 @@ class SeqrVCFToMTTask(HailMatrixTableTask):
         return True
 
 
+class SeqrReannotateMTTask(SeqrVCFToMTTask):
+    """
+    Recompute some annotations of an MT written by SeqrVCFToMTTask, e.g. to refresh clinvar or add a new score,
+    without importing the callset or running VEP again. source_paths is the path of the annotated MT.
+    If the MT has no vep field, the VEP-derived annotations are recomputed from a VEP table, see vep_ht_path.
+    """
+    annotations = luigi.ListParameter(default=[], description="Annotations to recompute, with their requirements. "
+                                      "By default, the annotations whose code or reference data changed since the MT was annotated.")
+    vep_ht_path = luigi.OptionalParameter(default=None, description="VEP table to read the VEP results from when the source MT "
+                                          "has no vep field, e.g. written with vep_table for another MT of the same variants. "
+                                          "By default, the VEP table next to the source MT, if any.")
+
+    def requires(self):
+        return []
+
+    def run(self):
+        run_report = self.new_run_report()
+        kwargs = self.get_schema_class_kwargs()
+        mt = hl.read_matrix_table(self.source_paths[0])
+        source_fields = list(mt.row_value)
+        if 'vep' not in mt.row_value:
+            mt = self.annotate_vep_table(mt)
+        schema = self.SCHEMA_CLASS(mt, **kwargs)
+        fingerprints = hl.eval(mt.annotation_fingerprints) if 'annotation_fingerprints' in mt.globals else {}
+        annotations = list(self.annotations) or schema.changed_annotations(fingerprints)
+        logger.info(f'Recomputing annotations: {annotations}')
+
+        with report_stage(run_report, 'annotate') as stage_report:
+            stage_report['annotations'] = annotations
+            if annotations:
+                recomputed = self.SCHEMA_CLASS.get_annotation_requirements(annotations)
+                new_fingerprints = schema.annotation_fingerprints()
+                fingerprints = {**fingerprints, **{name: new_fingerprints[name] for name in recomputed}}
+                schema.annotate_all(overwrite=True, annotations=annotations)
+                # Keep the fields of the source MT, and add the annotations it didn't have. VEP results read from
+                # the VEP table stay out of the MT.
+                recomputed_fields = [name for name in recomputed
+                                     if name in schema.mt.row_value and name not in source_fields and name != 'vep']
+                mt = schema.mt.select_rows(*source_fields, *recomputed_fields)
+                mt = self.annotate_fingerprint_globals(mt, fingerprints)
+                if kwargs.get('clinvar_data') is not None:
+                    mt = mt.annotate_globals(clinvar_version=kwargs['clinvar_data'].index_globals().version)
+
+        with report_stage(run_report, 'write') as stage_report:
+            mt.write(self.output().path, stage_locally=True, overwrite=True)
+        stage_report.update(RunReport.mt_metrics(hl.read_matrix_table(self.output().path), self.output().path))
+        self.write_schema_manifest()
+        self.write_vep_table()
+        run_report.write()
+
+    def annotate_vep_table(self, mt):
+        """
+        Annotate the MT with the VEP results of the VEP table, so the VEP-derived annotations can be recomputed
+        without the vep field.
+        """
+        if self.vep_ht_path:
+            check_if_path_exists(self.vep_ht_path, "vep_ht_path")
+            path = self.vep_ht_path
+        else:
+            path = vep_table_path(self.source_paths[0])
+            if not hl.hadoop_exists(os.path.join(path, '_SUCCESS')):
+                logger.info(f'No VEP table at {path}')
+                return mt
+        logger.info(f'Using VEP table {path}')
+        return annotate_vep_table(mt, hl.read_table(path))
+
+
 class SeqrMTToESTask(HailElasticSearchTask):
     source_paths = luigi.Parameter(default="[]", description='Path or list of paths of VCFs to be loaded.')
     dest_path = luigi.Parameter(description='Path to write the matrix table.')
     genome_version = luigi.Parameter(description='Reference Genome Version (37 or 38)')
-    vep_runner = luigi.ChoiceParameter(choices=['VEP', 'DUMMY'], default='VEP', description='Choice of which vep runner to annotate vep.')
+    vep_runner = luigi.ChoiceParameter(choices=['VEP', 'DUMMY', 'LOCAL_POOL'], default='VEP', description='Choice of which vep runner to annotate vep.')
 
     reference_ht_path = luigi.Parameter(default=None, description='Path to the Hail table storing the reference variants.')
     interval_ref_ht_path = luigi.Parameter(default=None, description='Path to the Hail Table storing interval-keyed reference data.')
@@ -266,6 +702,10 @@ class SeqrMTToESTask(HailElasticSearchTask):
     vep_config_json_path = luigi.OptionalParameter(default=None, description="Path of hail vep config .json file")
     grch38_to_grch37_ref_chain = luigi.OptionalParameter(default='gs://hail-common/references/grch38_to_grch37.over.chain.gz',
                                         description="Path to GRCh38 to GRCh37 coordinates file")
+    annotation_cache_path = luigi.OptionalParameter(default=None, description="Directory of the persistent annotation cache.")
+    vep_cache_path = luigi.OptionalParameter(default=None, description="Directory of the persistent VEP results cache.")
+    checkpoint_path = luigi.OptionalParameter(default=None, description="Directory for stage checkpoints of the MT task.")
+    contig_group_size = luigi.IntParameter(default=0, description="Number of contigs per parallel MT sub-task, 0 disables the fan-out.")
 
     def __init__(self, *args, **kwargs):
         # TODO: instead of hardcoded index, generate from project_guid, etc.
@@ -291,6 +731,10 @@ class SeqrMTToESTask(HailElasticSearchTask):
             subset_path=self.subset_path,
             vep_config_json_path=self.vep_config_json_path,
             grch38_to_grch37_ref_chain=self.grch38_to_grch37_ref_chain,
+            annotation_cache_path=self.annotation_cache_path,
+            vep_cache_path=self.vep_cache_path,
+            checkpoint_path=self.checkpoint_path,
+            contig_group_size=self.contig_group_size,
         )]
 
     def output(self):
@@ -304,15 +748,18 @@ class SeqrMTToESTask(HailElasticSearchTask):
         return GCSorLocalTarget(filename=self.completed_marker_path).exists()
 
     def run(self):
+        run_report = self.new_run_report(self.dest_path)
         mt = self.import_mt()
         row_table = SeqrVariantsAndGenotypesSchema.elasticsearch_row(mt)
         es_shards = self._mt_num_shards(mt)
-        self.export_table_to_elasticsearch(row_table, es_shards)
+        self.export_table_to_elasticsearch(row_table, es_shards, num_docs=mt.count_rows())
 
         with hl.hadoop_open(self.completed_marker_path, "w") as f:
             f.write(".")
 
-        self.cleanup(es_shards)
+        with report_stage(run_report, 'cleanup'):
+            self.cleanup(es_shards)
+        run_report.write()
 
 
 if __name__ == '__main__':
@@ -1,16 +1,17 @@
 import logging
 import sys
-from collections import defaultdict
 
 import hail as hl
 import luigi
 
 from luigi_pipeline.lib.hail_tasks import HailElasticSearchTask, HailMatrixTableTask
+from luigi_pipeline.lib.model.base_mt_schema import BaseMTSchema, manifest_path
 from luigi_pipeline.lib.model.seqr_mt_schema import (
     SeqrGenotypesSchema,
     SeqrVariantsAndGenotypesSchema,
     SeqrVariantSchema,
 )
+from luigi_pipeline.lib.run_report import RunReport, report_stage
 from luigi_pipeline.seqr_loading import SeqrVCFToMTTask, check_if_path_exists
 
 logger = logging.getLogger(__name__)
@@ -21,6 +22,7 @@ class SeqrVCFToVariantMTTask(SeqrVCFToMTTask):
     Loads all annotations for the variants of a VCF into a Hail Table (parent class of MT is a misnomer).
     """
     SCHEMA_CLASS = SeqrVariantSchema
+    GENOTYPES_SCHEMA_CLASS = SeqrGenotypesSchema
 
 
 class BaseVCFToGenotypesMTTask(HailMatrixTableTask):
@@ -28,6 +30,10 @@ class BaseVCFToGenotypesMTTask(HailMatrixTableTask):
                                          description="Path to a tsv file with two columns: s and seqr_id.")
     subset_path = luigi.OptionalParameter(default=None,
                                           description="Path to a tsv file with one column of sample IDs: s.")
+    compact_genotypes = luigi.BoolParameter(description="Write the genotypes as a struct of small int arrays with the "
+                                            "sample ids in the globals, see SeqrGenotypesSchema.encode_genotypes.")
+    sparse_genotypes = luigi.BoolParameter(description="Only keep the non-ref calls, no-calls and low GQ hom-ref calls in "
+                                           "the genotypes. Samples missing from the genotypes of a variant are hom-ref.")
 
     def get_schema_class_kwargs(self):
         return {}
@@ -36,19 +42,33 @@ class BaseVCFToGenotypesMTTask(HailMatrixTableTask):
         return [self.VariantTask()]
 
     def run(self):
-        mt = hl.read_matrix_table(self.input()[0].path)
-        if self.remap_path:
-            check_if_path_exists(self.remap_path, "remap_path")
-            mt = self.remap_sample_ids(mt, self.remap_path)
-        if self.subset_path:
-            check_if_path_exists(self.subset_path, "subset_path")
-            mt = self.subset_samples_and_variants(mt, self.subset_path)
-
-        kwargs = self.get_schema_class_kwargs()
-        mt = self.GenotypesSchema(mt, **kwargs).annotate_all(overwrite=True).select_annotated_mt()
+        run_report = self.new_run_report()
+        with report_stage(run_report, 'import') as stage_report:
+            mt = hl.read_matrix_table(self.input()[0].path)
+            stage_report.update(RunReport.mt_metrics(mt))
+            if self.remap_path:
+                check_if_path_exists(self.remap_path, "remap_path")
+                mt = self.remap_sample_ids(mt, self.remap_path)
+            if self.subset_path:
+                check_if_path_exists(self.subset_path, "subset_path")
+                mt = self.subset_samples_and_variants(mt, self.subset_path)
+
+        with report_stage(run_report, 'annotate'):
+            kwargs = self.get_schema_class_kwargs()
+            if self.sparse_genotypes:
+                kwargs['sparse_genotypes'] = True
+            mt = self.GenotypesSchema(mt, **kwargs).annotate_all(overwrite=True).select_annotated_mt()
+            if self.sparse_genotypes:
+                mt = mt.annotate_globals(sparseGenotypes=True)
+            if self.compact_genotypes:
+                mt = self.GenotypesSchema.encode_genotypes(mt)
 
         mt.describe()
-        mt.write(self.output().path, stage_locally=True, overwrite=True)
+        with report_stage(run_report, 'write') as stage_report:
+            mt.write(self.output().path, stage_locally=True, overwrite=True)
+        stage_report.update(RunReport.mt_metrics(hl.read_matrix_table(self.output().path), self.output().path))
+        self.GenotypesSchema.write_manifest(manifest_path(self.output().path), hl.read_matrix_table(self.output().path))
+        run_report.write()
 
 
 class SeqrVCFToGenotypesMTTask(BaseVCFToGenotypesMTTask):
@@ -66,20 +86,42 @@ class BaseMTToESOptimizedTask(HailElasticSearchTask):
         return [self.VariantTask(), self.GenotypesTask()]
 
     def run(self):
+        run_report = self.new_run_report(self.input()[1].path)
         variants_mt = hl.read_matrix_table(self.input()[0].path)
         genotypes_mt = hl.read_matrix_table(self.input()[1].path)
+        self.validate_manifests([variants_mt, genotypes_mt])
+        sample_ids = hl.eval(genotypes_mt.genotype_sample_ids) if 'genotype_sample_ids' in genotypes_mt.globals else None
+        sparse_genotypes = 'sparseGenotypes' in genotypes_mt.globals
         genotypes_mt = genotypes_mt.drop(*[k for k in genotypes_mt.globals.keys()])
         row_ht = genotypes_mt.rows().join(variants_mt.rows())
+        if sample_ids is not None:
+            # Compact genotypes are joined as they are written and only decoded for the ES docs.
+            row_ht = self.VariantsAndGenotypesSchema.decode_genotypes(row_ht, sample_ids)
+        if sparse_genotypes:
+            # The globals go to the index _meta: the samples of the index that are missing from the genotypes of a
+            # variant doc are hom-ref.
+            row_ht = row_ht.annotate_globals(sparseGenotypes=True, sampleIds=genotypes_mt.s.collect())
 
         row_ht = self.VariantsAndGenotypesSchema.elasticsearch_row(row_ht)
         es_shards = self._mt_num_shards(genotypes_mt)
 
-        # Initialize an empty SeqrVariantsAndGenotypesSchema to access class properties
-        disabled_fields = self.VariantsAndGenotypesSchema(None, ref_data=defaultdict(dict), interval_ref_data=None, clinvar_data=None).get_disable_index_field()
+        disabled_fields = self.VariantsAndGenotypesSchema.get_disabled_index_fields()
+
+        self.export_table_to_elasticsearch(table=row_ht, num_shards=es_shards, disabled_fields=disabled_fields,
+                                           num_docs=genotypes_mt.count_rows())
+
+        with report_stage(run_report, 'cleanup'):
+            self.cleanup(es_shards)
+        run_report.write()
 
-        self.export_table_to_elasticsearch(table=row_ht, num_shards=es_shards, disabled_fields=disabled_fields)
-        
-        self.cleanup(es_shards)
+    def validate_manifests(self, mts):
+        """
+        Check the input MTs against the schema manifests written next to them, if any, before building the ES mapping.
+        """
+        for target, mt in zip(self.input(), mts):
+            manifest = BaseMTSchema.read_manifest(manifest_path(target.path))
+            if manifest is not None:
+                BaseMTSchema.validate_manifest(manifest, mt)
 
 
 class SeqrMTToESOptimizedTask(BaseMTToESOptimizedTask):
@@ -28,6 +28,7 @@ class SeqrMitoVariantMTTask(SeqrVCFToVariantMTTask):
     high_constraint_interval_path = luigi.Parameter(description='Path to the tsv file storing the high constraint intervals.')
     RUN_VEP = False
     SCHEMA_CLASS = SeqrMitoVariantSchema
+    GENOTYPES_SCHEMA_CLASS = SeqrMitoGenotypesSchema
 
     def get_schema_class_kwargs(self):
         kwargs = super().get_schema_class_kwargs()
@@ -33,6 +33,7 @@ class SeqrSVVariantMTTask(SeqrVCFToVariantMTTask):
     gencode_path = luigi.OptionalParameter(default="", description="Path for downloaded gencode data")
     RUN_VEP = False
     SCHEMA_CLASS = SeqrSVVariantsAndGenotypesSchema
+    GENOTYPES_SCHEMA_CLASS = SeqrSVGenotypesSchema
 
     # NB: electing not to override import_vcf here eventhough the inherited args are slightly different
     # than from the old pipeline.
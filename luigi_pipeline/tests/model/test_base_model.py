@@ -1,8 +1,16 @@
+import os
+import shutil
+import tempfile
 import unittest
 
 import hail as hl
 
-from luigi_pipeline.lib.model.base_mt_schema import BaseMTSchema, row_annotation
+from luigi_pipeline.lib.model.base_mt_schema import (
+    BaseMTSchema,
+    RowAnnotationFailed,
+    manifest_path,
+    row_annotation,
+)
 
 
 class TestBaseModel(unittest.TestCase):
@@ -173,3 +181,263 @@ class TestBaseModel(unittest.TestCase):
 
         count_dict = self._count_dicts(test_schema)
         self.assertEqual(count_dict, {'a': 1, 'b': 1, 'c': 1, 'info': 1})
+
+    def test_annotate_all_exclude(self):
+        test_schema = TestBaseModel.TestSchema()
+        test_schema.set_mt(test_schema.mt.annotate_rows(a=11))
+        mt = test_schema.annotate_all(overwrite=True, exclude=['a']).mt
+
+        count_dict = self._count_dicts(test_schema)
+        self.assertEqual(count_dict, {'b': 1, 'c': 1})
+        self.assertEqual(mt.rows().take(1)[0].a, 11)
+
+    def test_get_source_fields(self):
+        self.assertIsNone(TestBaseModel.TestSchema.get_source_fields())
+
+        class DeclaredSchema(BaseMTSchema):
+            SOURCE_ROW_FIELDS = ('rsid', 'info.AC')
+
+            @row_annotation()
+            def a(self):
+                return self.mt.rsid
+
+        class ChildSchema(DeclaredSchema):
+            SOURCE_ENTRY_FIELDS = ('GT',)
+
+            @row_annotation()
+            def b(self):
+                return hl.agg.count_where(self.mt.GT.is_hom_var())
+
+        self.assertEqual(
+            ChildSchema.get_source_fields(),
+            (['info.AC', 'rsid'], ['GT']),
+        )
+
+        class UndeclaredChildSchema(DeclaredSchema):
+            @row_annotation()
+            def c(self):
+                return self.mt.qual
+
+        self.assertIsNone(UndeclaredChildSchema.get_source_fields())
+
+    def test_annotation_plan(self):
+        class TestSchemaChild(TestBaseModel.TestSchema):
+            @row_annotation(fn_require=TestBaseModel.TestSchema.b)
+            def d(self):
+                return self.mt.b + 4
+
+        self.assertEqual(
+            TestBaseModel.TestSchema.get_annotation_plan(),
+            [['a'], ['b', 'c']],
+        )
+        self.assertEqual(
+            TestSchemaChild.get_annotation_plan(),
+            [['a'], ['b', 'c'], ['d']],
+        )
+        self.assertEqual(
+            list(TestSchemaChild.get_annotation_registry()),
+            ['a', 'b', 'c', 'd'],
+        )
+
+    def test_annotation_plan_missing_requirement(self):
+        class TestSchemaChild(TestBaseModel.TestSchema):
+            # Overriding a required annotation with a plain method removes it.
+            def a(self):
+                pass
+
+        self.assertRaises(RowAnnotationFailed, TestSchemaChild.get_annotation_plan)
+
+    def test_annotate_all_fuses_entry_aggregations(self):
+        class TestSchemaChild(TestBaseModel.TestSchema):
+            @row_annotation()
+            def n_called(self):
+                return hl.agg.count_where(hl.is_defined(self.mt.GT))
+
+            @row_annotation(fn_require=n_called)
+            def hom_var_fraction(self):
+                return hl.agg.count_where(self.mt.GT.is_hom_var()) / self.mt.n_called
+
+            @row_annotation(fn_require=n_called)
+            def n_called_plus(self):
+                return self.mt.n_called + 1
+
+        test_schema = TestSchemaChild().annotate_all()
+        self.assertEqual(
+            test_schema.mt_instance_meta['annotation_layers'],
+            [['n_called', 'hom_var_fraction'], ['a'], ['b', 'c', 'n_called_plus']],
+        )
+
+        row = test_schema.select_annotated_mt().rows().take(1)[0]
+        expected = (
+            test_schema.mt.annotate_rows(
+                n_hom_var=hl.agg.count_where(test_schema.mt.GT.is_hom_var()),
+            )
+            .rows()
+            .take(1)[0]
+        )
+        self.assertEqual(row.n_called_plus, row.n_called + 1)
+        self.assertAlmostEqual(row.hom_var_fraction, expected.n_hom_var / row.n_called)
+
+    def test_annotate_all_chained_entry_aggregations(self):
+        class TestSchemaChild(TestBaseModel.TestSchema):
+            @row_annotation()
+            def mean_dp(self):
+                return hl.agg.mean(self.mt.DP)
+
+            @row_annotation(fn_require=mean_dp)
+            def low_dp(self):
+                return self.mt.mean_dp / 2
+
+            @row_annotation(fn_require=low_dp)
+            def n_low_dp(self):
+                return hl.agg.count_where(self.mt.low_dp > self.mt.DP)
+
+        test_schema = TestSchemaChild().annotate_all()
+        # n_low_dp aggregates over the result of mean_dp, so it needs a second entry pass.
+        self.assertEqual(
+            test_schema.mt_instance_meta['annotation_layers'],
+            [['mean_dp', 'low_dp'], ['n_low_dp'], ['a'], ['b', 'c']],
+        )
+        self.assertEqual(
+            self._count_dicts(test_schema),
+            {'a': 1, 'b': 1, 'c': 1, 'mean_dp': 1, 'low_dp': 1, 'n_low_dp': 1},
+        )
+
+        row = test_schema.select_annotated_mt().rows().take(1)[0]
+        mt = test_schema.mt.annotate_rows(
+            expected_mean_dp=hl.agg.mean(test_schema.mt.DP),
+        )
+        mt = mt.annotate_rows(
+            expected_n_low_dp=hl.agg.count_where(mt.expected_mean_dp / 2 > mt.DP),
+        )
+        self.assertEqual(row.n_low_dp, mt.rows().take(1)[0].expected_n_low_dp)
+
+    def test_annotate_all_selected_annotations(self):
+        class TestSchemaChild(TestBaseModel.TestSchema):
+            @row_annotation(fn_require=TestBaseModel.TestSchema.b)
+            def d(self):
+                return self.mt.b + 4
+
+        self.assertEqual(
+            TestSchemaChild.get_annotation_requirements(['d']),
+            {'a', 'b', 'd'},
+        )
+        self.assertRaises(
+            RowAnnotationFailed,
+            TestSchemaChild.get_annotation_requirements,
+            ['e'],
+        )
+
+        test_schema = TestSchemaChild().annotate_all(annotations=['d'])
+        self.assertEqual(self._count_dicts(test_schema), {'a': 1, 'b': 1, 'd': 1})
+        self.assertEqual(test_schema.mt.rows().take(1)[0].d, 24)
+
+    def test_changed_annotations(self):
+        fingerprints = TestBaseModel.TestSchema().annotation_fingerprints()
+        self.assertEqual(sorted(fingerprints), ['a', 'b', 'c'])
+
+        class TestSchemaChild(TestBaseModel.TestSchema):
+            @row_annotation()
+            def a(self):
+                return 11
+
+            @row_annotation(fn_require=TestBaseModel.TestSchema.a)
+            def d(self):
+                return 40
+
+        # b and c require the changed a, d is new.
+        self.assertEqual(
+            TestSchemaChild().changed_annotations(fingerprints),
+            ['a', 'b', 'c', 'd'],
+        )
+        self.assertEqual(
+            TestBaseModel.TestSchema().changed_annotations(fingerprints),
+            [],
+        )
+
+    def test_fingerprints_helpers(self):
+        class TestSchemaHelper(TestBaseModel.TestSchema):
+            def _helper(self):
+                return 1
+
+            @row_annotation(cacheable=True)
+            def d(self):
+                return self._helper()
+
+        class TestSchemaChild(TestSchemaHelper):
+            def _helper(self):
+                return 2
+
+        fingerprints = TestSchemaHelper().annotation_fingerprints()
+        # Changing a helper changes the fingerprint of the annotations calling it.
+        self.assertEqual(TestSchemaChild().changed_annotations(fingerprints), ['d'])
+
+    def test_profile_annotations(self):
+        class TestSchemaChild(TestBaseModel.TestSchema):
+            @row_annotation()
+            def n_called(self):
+                return hl.agg.count_where(hl.is_defined(self.mt.GT))
+
+        test_schema = TestSchemaChild()
+        profile = test_schema.profile_annotations(sample_fraction=1)
+        self.assertEqual(
+            sorted(annotation['name'] for annotation in profile),
+            ['a', 'b', 'c', 'n_called'],
+        )
+        for annotation in profile:
+            self.assertGreaterEqual(annotation['seconds'], 0)
+            self.assertGreater(annotation['ir_nodes'], 0)
+            self.assertNotIn('es_bytes', annotation)
+        # The input MT is restored.
+        self.assertNotIn('n_called', test_schema.mt.row)
+
+    def test_manifest(self):
+        class TestSchemaChild(TestBaseModel.TestSchema):
+            @row_annotation(disable_index=True, fn_require=TestBaseModel.TestSchema.a)
+            def d(self):
+                return hl.str(self.mt.a)
+
+        self.assertEqual(TestSchemaChild.get_disabled_index_fields(), ['d'])
+        self.assertEqual(
+            TestSchemaChild.get_disabled_index_fields(),
+            TestSchemaChild().get_disable_index_field(),
+        )
+
+        mt = TestSchemaChild().annotate_all().select_annotated_mt()
+        test_dir = tempfile.mkdtemp()
+        try:
+            path = manifest_path(os.path.join(test_dir, 'test.mt/'))
+            self.assertEqual(
+                path,
+                os.path.join(test_dir, 'test.mt.schema_manifest.json'),
+            )
+            self.assertIsNone(BaseMTSchema.read_manifest(path))
+            TestSchemaChild.write_manifest(path, mt)
+            manifest = BaseMTSchema.read_manifest(path)
+        finally:
+            shutil.rmtree(test_dir)
+
+        self.assertEqual(manifest, TestSchemaChild.get_manifest(mt))
+        self.assertEqual(
+            manifest['annotations'][-1],
+            {
+                'name': 'd',
+                'disable_index': True,
+                'requirements': ['a'],
+                'cacheable': False,
+                'dtype': 'str',
+            },
+        )
+        BaseMTSchema.validate_manifest(manifest, mt)
+        self.assertRaises(
+            ValueError,
+            BaseMTSchema.validate_manifest,
+            manifest,
+            mt.annotate_rows(d=1),
+        )
+        self.assertRaises(
+            ValueError,
+            BaseMTSchema.validate_manifest,
+            manifest,
+            mt.drop('d'),
+        )
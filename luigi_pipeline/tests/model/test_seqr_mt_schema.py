@@ -2,10 +2,24 @@ import unittest
 
 import hail as hl
 
-from luigi_pipeline.lib.model.seqr_mt_schema import SeqrVariantSchema
+from luigi_pipeline.lib.model.seqr_mt_schema import (
+    BaseSeqrSchema,
+    SeqrGenotypesSchema,
+    SeqrVariantSchema,
+)
 from luigi_pipeline.tests.data.sample_vep import DERIVED_DATA, VEP_DATA
 
 
+def _varint_length(value):
+    # Bytes of an int written by Hail as a LEB128 varint of its unsigned 32 bit value.
+    value &= 0xFFFFFFFF
+    length = 1
+    while value >> 7:
+        value >>= 7
+        length += 1
+    return length
+
+
 class TestSeqrModel(unittest.TestCase):
     def _get_filtered_mt(self, rsid='rs35471880'):
         mt = hl.import_vcf('tests/data/1kg_30variants.vcf.bgz')
@@ -231,3 +245,140 @@ class TestSeqrModel(unittest.TestCase):
             name = 'samples_ab.%i_to_%i' % (i, i + step)
             if name not in non_empty:
                 self.assertEqual(row[name], set())
+
+    def test_reference_joins(self):
+        rsid = 'rs35471880'
+        mt = self._get_filtered_mt(rsid).annotate_rows(**VEP_DATA[rsid])
+        rows = mt.rows()
+        ref_data = rows.select(dbnsfp=hl.struct(REVEL_score='0.5'))
+        clinvar_data = rows.select(
+            info=hl.struct(ALLELEID=1, CLNSIG=['Benign', 'Likely_benign']),
+            gold_stars=2,
+        )
+
+        seqr_schema = BaseSeqrSchema(
+            mt,
+            ref_data=ref_data,
+            interval_ref_data=None,
+            clinvar_data=clinvar_data,
+        ).annotate_all(overwrite=True)
+        self.assertNotIn('_ref_data_join', seqr_schema.mt.row)
+        self.assertNotIn('_clinvar_data_join', seqr_schema.mt.row)
+
+        obj = seqr_schema.select_annotated_mt().rows().collect()[0]
+        self.assertEqual(
+            obj.clinvar,
+            hl.Struct(
+                allele_id=1,
+                clinical_significance='Benign|Likely_benign',
+                gold_stars=2,
+            ),
+        )
+        self.assertEqual(obj.dbnsfp, hl.Struct(REVEL_score='0.5'))
+
+    def test_genotype_bin_samples(self):
+        mt = hl.import_vcf('tests/data/1kg_30variants.vcf.bgz')
+        schema = SeqrGenotypesSchema(hl.split_multi_hts(mt))
+        schema.set_mt(schema.mt.annotate_rows(genotypes=schema.genotypes.fn(schema)))
+
+        mt = schema.mt.annotate_rows(
+            samples_gq=schema.samples_gq.fn(schema),
+            samples_ab=schema.samples_ab.fn(schema),
+            samples_num_alt=schema.samples_num_alt.fn(schema),
+            expected_gq=hl.struct(
+                **{
+                    f'{i}_to_{i + 5}': schema._genotype_filter_samples(
+                        lambda g, i=i: (g.gq >= i) & (g.gq < i + 5),
+                    )
+                    for i in range(0, 95, 5)
+                },
+            ),
+            expected_ab=hl.struct(
+                **{
+                    f'{i}_to_{i + 5}': schema._genotype_filter_samples(
+                        lambda g, i=i: (g.num_alt == 1)
+                        & (g.ab * 100 >= i)
+                        & (g.ab * 100 < i + 5),
+                    )
+                    for i in range(0, 45, 5)
+                },
+            ),
+            expected_num_alt=hl.struct(
+                **{
+                    f'{i}': schema._genotype_filter_samples(
+                        lambda g, i=i: g.num_alt == i,
+                    )
+                    for i in range(1, 3)
+                },
+            ),
+        )
+        for row in mt.rows().collect():
+            self.assertEqual(row.samples_gq, row.expected_gq)
+            self.assertEqual(row.samples_ab, row.expected_ab)
+            self.assertEqual(row.samples_num_alt, row.expected_num_alt)
+
+    def test_encode_genotypes(self):
+        mt = self._get_filtered_mt()
+        # A no-call.
+        mt = mt.annotate_entries(GT=hl.or_missing(mt.s != mt.s.take(1)[0], mt.GT))
+        mt = SeqrGenotypesSchema(mt).annotate_all().select_annotated_mt()
+        mt = mt.annotate_rows(
+            genotypes=mt.genotypes.map(
+                lambda g: g.annotate(ab=hl.float(hl.int(g.ab * 1000)) / 1000),
+            ),
+        )
+
+        encoded_mt = SeqrGenotypesSchema.encode_genotypes(mt)
+        sample_ids = hl.eval(encoded_mt.genotype_sample_ids)
+        self.assertEqual(sample_ids, mt.s.collect())
+        self.assertEqual(
+            list(encoded_mt.genotypes.dtype),
+            ['num_alt', 'gq', 'ab', 'dp', 'sample_index'],
+        )
+        self.assertEqual(encoded_mt.genotypes.ab.dtype, hl.tarray(hl.tint32))
+        num_alts = [n for row in encoded_mt.genotypes.num_alt.collect() for n in row]
+        self.assertIn(0, num_alts)
+        self.assertEqual({_varint_length(n) for n in num_alts}, {1})
+        self.assertEqual(_varint_length(-1), 5)
+
+        decoded = SeqrGenotypesSchema.decode_genotypes(encoded_mt.rows(), sample_ids)
+        self.assertEqual(
+            decoded.genotypes.collect(),
+            mt.rows().genotypes.collect(),
+        )
+
+    def test_sparse_genotypes(self):
+        mt = hl.split_multi_hts(hl.import_vcf('tests/data/1kg_30variants.vcf.bgz'))
+        dense = SeqrGenotypesSchema(mt).annotate_all().select_annotated_mt().rows()
+        sparse = (
+            SeqrGenotypesSchema(mt, sparse_genotypes=True)
+            .annotate_all()
+            .select_annotated_mt()
+            .rows()
+        )
+
+        for dense_row, sparse_row in zip(dense.collect(), sparse.collect()):
+            self.assertEqual(
+                sparse_row.genotypes,
+                [
+                    g
+                    for g in dense_row.genotypes
+                    if g.num_alt != 0 or g.gq < SeqrGenotypesSchema.GQ_BINS_END
+                ],
+            )
+            self.assertEqual(sparse_row.samples_num_alt, dense_row.samples_num_alt)
+            self.assertEqual(sparse_row.samples_gq, dense_row.samples_gq)
+            self.assertEqual(sparse_row.samples_no_call, dense_row.samples_no_call)
+            self.assertEqual(sparse_row.samples_ab, dense_row.samples_ab)
+
+    def test_sparse_genotypes_low_gq_hom_ref(self):
+        mt = hl.import_vcf('tests/data/1kg_30variants.vcf.bgz').head(1)
+        mt = mt.annotate_entries(GT=hl.call(0, 0), GQ=12, AD=[10, 0])
+        row = (
+            SeqrGenotypesSchema(mt, sparse_genotypes=True)
+            .annotate_all()
+            .select_annotated_mt()
+            .rows()
+            .collect()[0]
+        )
+        self.assertEqual(row.samples_gq['10_to_15'], set(mt.s.collect()))
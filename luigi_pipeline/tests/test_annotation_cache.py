@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import hail as hl
+
+from luigi_pipeline.lib import annotation_cache
+from luigi_pipeline.lib.annotation_cache import AnnotationCache, part_table_paths
+
+TEST_DATA_MT_1KG = 'tests/data/1kg_30variants.vcf.bgz'
+
+
+class TestAnnotationCache(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.mt = hl.import_vcf(TEST_DATA_MT_1KG)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _annotated_rows(self, mt):
+        return mt.annotate_rows(score=hl.len(mt.alleles[0])).rows()
+
+    def test_version_path(self):
+        cache = AnnotationCache(self.test_dir, {'vep': 'a', 'schema': 'b'})
+        self.assertEqual(
+            cache.path,
+            AnnotationCache(self.test_dir, {'schema': 'b', 'vep': 'a'}).path,
+        )
+        self.assertNotEqual(
+            cache.path,
+            AnnotationCache(self.test_dir, {'schema': 'b', 'vep': 'c'}).path,
+        )
+
+    def test_empty_cache(self):
+        cache = AnnotationCache(self.test_dir, {})
+        self.assertIsNone(cache.read())
+        uncached_mt, cached_mt = AnnotationCache.split(self.mt, cache.read())
+        self.assertIsNone(cached_mt)
+        self.assertEqual(uncached_mt.count_rows(), 30)
+
+    def test_update_and_split(self):
+        cache = AnnotationCache(self.test_dir, {})
+        cache.update(self._annotated_rows(self.mt.head(10)), ['score'])
+        self.assertEqual(cache.read().count(), 10)
+
+        uncached_mt, cached_mt = AnnotationCache.split(self.mt, cache.read())
+        self.assertEqual(uncached_mt.count_rows(), 20)
+        self.assertEqual(cached_mt.count_rows(), 10)
+        self.assertTrue(
+            cached_mt.aggregate_rows(hl.agg.all(hl.is_defined(cached_mt.score))),
+        )
+
+        cache.update(self._annotated_rows(self.mt), ['score'])
+        self.assertEqual(cache.read().count(), 30)
+        self.assertEqual(list(cache.read().row_value), ['score'])
+        self.assertEqual(len(part_table_paths(cache.path)), 2)
+
+        # A load without new variants doesn't add a part.
+        cache.update(self._annotated_rows(self.mt), ['score'])
+        self.assertEqual(len(part_table_paths(cache.path)), 2)
+
+    def test_compact(self):
+        cache = AnnotationCache(self.test_dir, {})
+        with patch.object(annotation_cache, 'MAX_PARTS', 2):
+            for i in range(3):
+                cache.update(
+                    self._annotated_rows(
+                        self.mt.filter_rows(self.mt.locus.position % 3 == i),
+                    ),
+                    ['score'],
+                )
+        part_paths = part_table_paths(cache.path)
+        self.assertEqual(len(part_paths), 1)
+        self.assertEqual(os.listdir(cache.path), [os.path.basename(part_paths[0])])
+        self.assertEqual(cache.read().count(), 30)
+
+    def test_split_requires_locus_alleles_key(self):
+        self.assertRaises(
+            ValueError,
+            AnnotationCache.split,
+            self.mt.key_rows_by('rsid'),
+            None,
+        )
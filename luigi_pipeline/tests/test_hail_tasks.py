@@ -1,5 +1,7 @@
+import json
 import os
 import shutil
+import sys
 import tempfile
 import unittest
 from unittest.mock import patch
@@ -8,12 +10,22 @@ import hail as hl
 import luigi
 from elasticsearch.client.indices import IndicesClient
 
+from hail_scripts.computed_fields.vep import (
+    get_expr_for_vep_sorted_transcript_consequences_array,
+)
+
 from luigi_pipeline.lib.global_config import GlobalConfig
 from luigi_pipeline.lib.hail_tasks import (
     HailElasticSearchTask,
     HailMatrixTableTask,
     MatrixTableSampleSetError,
 )
+from luigi_pipeline.lib.hail_vep_runners import (
+    HailVEPBalancedRunner,
+    HailVEPDummyRunner,
+    HailVEPRunner,
+    HailVEPTwoTierRunner,
+)
 
 TEST_DATA_MT_1KG = 'tests/data/1kg_30variants.vcf.bgz'
 
@@ -61,6 +73,38 @@ class TestHailTasks(unittest.TestCase):
         mt = hl.read_matrix_table(self._temp_dest_path())
         self.assertEqual(mt.count(), (30, 16))
 
+    def test_checkpoint_resume(self):
+        class CheckpointTask(HailMatrixTableTask):
+            CHECKPOINT_STAGES = ('import', 'annotate')
+
+        def checkpoint_task(**kwargs):
+            return CheckpointTask(
+                source_paths=[TEST_DATA_MT_1KG],
+                dest_path=self._temp_dest_path(),
+                genome_version='37',
+                checkpoint_path=os.path.join(self.test_dir, 'checkpoints'),
+                checkpoint_stages=['import', 'annotate'],
+                **kwargs,
+            )
+
+        task = checkpoint_task()
+        self.assertEqual(task.latest_checkpoint(), (None, None))
+        mt = task.checkpoint_stage(task.import_vcf(), 'import')
+        task.checkpoint_stage(mt.annotate_rows(a=1), 'annotate')
+
+        stage, mt = checkpoint_task().latest_checkpoint()
+        self.assertEqual(stage, 'annotate')
+        self.assertEqual(mt.count(), (30, 16))
+
+        # Checkpoints written with other parameters are not resumed from.
+        self.assertEqual(
+            checkpoint_task(vep_runner='DUMMY').latest_checkpoint(),
+            (None, None),
+        )
+
+        task.remove_checkpoints()
+        self.assertEqual(checkpoint_task().latest_checkpoint(), (None, None))
+
     def test_mt_sample_type_stats_1kg_30(self):
         self._set_validation_configs()
 
@@ -74,6 +118,55 @@ class TestHailTasks(unittest.TestCase):
             },
         )
 
+    def test_validation_stats(self):
+        self._set_validation_configs()
+
+        mt = hl.import_vcf(TEST_DATA_MT_1KG)
+        stats = HailMatrixTableTask.validation_stats(mt, '37')
+        self.assertEqual(sum(stats['contig_counts'].values()), 30)
+        self.assertEqual(
+            {k: v for k, v in stats.items() if k != 'contig_counts'},
+            {
+                'noncoding': {'matched_count': 1, 'total_count': 2243},
+                'coding': {'matched_count': 4, 'total_count': 359},
+                'sampled': False,
+            },
+        )
+
+        sampled_stats = HailMatrixTableTask.validation_stats(
+            mt.repartition(4),
+            '37',
+            sample_fraction=0.5,
+        )
+        self.assertEqual(sampled_stats['coding']['total_count'], 359)
+        self.assertTrue(sampled_stats['sampled'])
+
+    def test_sample_partitions(self):
+        mt = hl.utils.range_matrix_table(100, 1, n_partitions=10)
+        for sample_fraction, n_sampled in [
+            (0.3, 3),
+            (0.7, 7),
+            (0.8, 8),
+            (0.05, 1),
+            (1, 10),
+        ]:
+            sampled_mt, sampled_fraction = HailMatrixTableTask.sample_partitions(
+                mt,
+                sample_fraction,
+            )
+            self.assertEqual(sampled_mt.n_partitions(), n_sampled)
+            self.assertEqual(sampled_fraction, n_sampled / 10)
+        sampled_mt, _ = HailMatrixTableTask.sample_partitions(mt, 0.3)
+        # Evenly spaced: the first rows of partitions 0, 3 and 6.
+        self.assertEqual(
+            sampled_mt.aggregate_rows(hl.agg.min(sampled_mt.row_idx)),
+            0,
+        )
+        self.assertEqual(
+            sampled_mt.aggregate_rows(hl.agg.max(sampled_mt.row_idx)),
+            69,
+        )
+
     def test_mt_sample_type_stats_threshold(self):
         threshold = 0.5
         self._set_validation_configs()
@@ -104,6 +197,241 @@ class TestHailTasks(unittest.TestCase):
             },
         )
 
+    def test_run_vep_with_cache(self):
+        mt = hl.import_vcf(TEST_DATA_MT_1KG)
+        vep_cache_path = os.path.join(self.test_dir, 'vep_cache')
+
+        vep_mt = HailMatrixTableTask.run_vep(
+            mt.head(10),
+            '37',
+            'DUMMY',
+            vep_cache_path=vep_cache_path,
+        )
+        self.assertEqual(
+            vep_mt.aggregate_rows(hl.agg.count_where(hl.is_defined(vep_mt.vep))),
+            10,
+        )
+
+        with patch.object(
+            HailVEPDummyRunner,
+            'run',
+            side_effect=HailVEPDummyRunner.run,
+            autospec=True,
+        ) as mock_run:
+            vep_mt = HailMatrixTableTask.run_vep(
+                mt,
+                '37',
+                'DUMMY',
+                vep_cache_path=vep_cache_path,
+            )
+            self.assertEqual(mock_run.call_args[0][1].count_rows(), 20)
+        self.assertEqual(
+            vep_mt.aggregate_rows(hl.agg.count_where(hl.is_defined(vep_mt.vep))),
+            30,
+        )
+
+        # Without misses, VEP doesn't run and the cache is unchanged.
+        with patch.object(HailVEPDummyRunner, 'run') as mock_run:
+            vep_mt = HailMatrixTableTask.run_vep(
+                mt,
+                '37',
+                'DUMMY',
+                vep_cache_path=vep_cache_path,
+            )
+            mock_run.assert_not_called()
+        self.assertEqual(
+            vep_mt.aggregate_rows(hl.agg.count_where(hl.is_defined(vep_mt.vep))),
+            30,
+        )
+        (cache_dir,) = os.listdir(vep_cache_path)
+        self.assertEqual(len(os.listdir(os.path.join(vep_cache_path, cache_dir))), 2)
+
+    def test_run_vep_prune_fields(self):
+        mt = hl.import_vcf(TEST_DATA_MT_1KG)
+        vep_mt = HailMatrixTableTask.run_vep(mt, '37', 'DUMMY', vep_prune_fields=True)
+        self.assertEqual(
+            list(vep_mt.vep.dtype),
+            ['most_severe_consequence', 'transcript_consequences'],
+        )
+        sorted_transcript_consequences = vep_mt.rows().aggregate(
+            hl.agg.take(
+                get_expr_for_vep_sorted_transcript_consequences_array(vep_mt.vep),
+                1,
+            ),
+        )[0]
+        self.assertEqual(sorted_transcript_consequences[0].gene_symbol, 'NOC2L')
+
+    def test_run_vep_balanced(self):
+        mt = hl.import_vcf(TEST_DATA_MT_1KG)
+        vep_mt = HailMatrixTableTask.run_vep(
+            mt,
+            '37',
+            'DUMMY',
+            vep_balance_partitions=True,
+        )
+        self.assertEqual(
+            vep_mt.aggregate_rows(hl.agg.count_where(hl.is_defined(vep_mt.vep))),
+            30,
+        )
+
+    def test_calibrate_block_size(self):
+        runner = HailVEPRunner(block_size=1000)
+        balanced_runner = HailVEPBalancedRunner(runner)
+        ht = hl.import_vcf(TEST_DATA_MT_1KG).rows().select()
+        vep_ht = ht.annotate(vep=hl.missing(hl.tstr))
+        # 2s start-up per block and 0.01s per variant, after a slow warm-up run.
+        timings = [
+            (60.0, vep_ht),
+            (6 * 2 + 30 * 0.01, vep_ht),
+            (2 * 2 + 30 * 0.01, vep_ht),
+        ]
+        with patch.object(
+            HailVEPBalancedRunner,
+            'CALIBRATION_BLOCK_SIZES',
+            (5, 15),
+        ), patch.object(
+            balanced_runner,
+            'time_vep',
+            side_effect=timings,
+        ) as mock_time_vep:
+            block_size, _ = balanced_runner.calibrate_block_size(ht, 30, '37', None)
+        self.assertEqual(
+            [call.args[3] for call in mock_time_vep.call_args_list],
+            [HailVEPBalancedRunner.WARMUP_ROWS, 5, 15],
+        )
+        # Start-up is at most 10% of a block: 2s * 0.9 / (0.1 * 0.01s) variants.
+        self.assertAlmostEqual(block_size, 1800, delta=1)
+        self.assertEqual(
+            balanced_runner.runner_with_block_size(block_size).block_size,
+            block_size,
+        )
+        self.assertEqual(runner.block_size, 1000)
+
+    def _fake_vep_config_path(self):
+        # Stands in for VEP with LOFTEE: one JSON line per input variant, echoing the VCF line.
+        fake_vep_path = os.path.join(self.test_dir, 'fake_vep.py')
+        with open(fake_vep_path, 'w') as f:
+            f.write(
+                'import gzip, json, sys\n'
+                'assert sys.argv[1] == "--json" and "--fork" in sys.argv\n'
+                'path = sys.argv[sys.argv.index("--input_file") + 1]\n'
+                'for line in gzip.open(path, "rt"):\n'
+                '    if not line.startswith("#"):\n'
+                '        pos = int(line.split("\\t")[1])\n'
+                '        print(json.dumps({\n'
+                '            "input": line.rstrip(),\n'
+                '            "most_severe_consequence": "stop_gained" if pos % 2 else "missense_variant",\n'
+                '            "lof": "HC" if "--plugin" in sys.argv else None,\n'
+                '        }))\n',
+            )
+        config_path = os.path.join(self.test_dir, 'vep_config.json')
+        with open(config_path, 'w') as f:
+            json.dump(
+                {
+                    'command': [
+                        sys.executable,
+                        fake_vep_path,
+                        '__OUTPUT_FORMAT_FLAG__',
+                        '--plugin',
+                        'LoF,human_ancestor_fa:human_ancestor.fa.gz',
+                    ],
+                    'env': {},
+                    'vep_json_schema': 'Struct{input:String,most_severe_consequence:String,lof:String}',
+                },
+                f,
+            )
+        return config_path
+
+    def test_run_vep_local_pool(self):
+        mt = hl.import_vcf(TEST_DATA_MT_1KG)
+        vep_mt = HailMatrixTableTask.run_vep(
+            mt,
+            '37',
+            'LOCAL_POOL',
+            vep_config_json_path=self._fake_vep_config_path(),
+        )
+        self.assertEqual(
+            vep_mt.aggregate_rows(hl.agg.count_where(hl.is_defined(vep_mt.vep.input))),
+            30,
+        )
+        self.assertEqual(
+            vep_mt.aggregate_rows(hl.agg.count_where(hl.is_defined(vep_mt.vep.lof))),
+            30,
+        )
+
+    def test_run_vep_two_tier(self):
+        self.assertEqual(
+            HailVEPTwoTierRunner.without_lof_plugin(
+                ['vep', '--plugin', 'LoF,a:b', '--plugin', 'CADD,c', '-o', 'STDOUT'],
+            ),
+            ['vep', '--plugin', 'CADD,c', '-o', 'STDOUT'],
+        )
+
+        mt = hl.import_vcf(TEST_DATA_MT_1KG)
+        vep_mt = HailMatrixTableTask.run_vep(
+            mt,
+            '37',
+            'LOCAL_POOL',
+            vep_config_json_path=self._fake_vep_config_path(),
+            vep_two_tier=True,
+        )
+        counts = vep_mt.aggregate_rows(
+            hl.struct(
+                rows=hl.agg.count_where(hl.is_defined(vep_mt.vep.input)),
+                lof_candidates=hl.agg.count_where(
+                    vep_mt.vep.most_severe_consequence == 'stop_gained',
+                ),
+                lof=hl.agg.count_where(hl.is_defined(vep_mt.vep.lof)),
+            ),
+        )
+        self.assertEqual(counts.rows, 30)
+        self.assertGreater(counts.lof_candidates, 0)
+        self.assertLess(counts.lof_candidates, 30)
+        self.assertEqual(counts.lof, counts.lof_candidates)
+
+    def test_run_vep_two_tier_lazy_runner(self):
+        class MarkedDummyRunner(HailVEPDummyRunner):
+            # Lazy like hl.vep: each pass is tagged with a literal, which is only in the plan if the pass is
+            # computed again rather than read from a checkpoint.
+            def __init__(self):
+                self.calls = 0
+
+            def run(self, mt, genome_version, vep_config_json_path=None):
+                marker = f'vep-pass-{self.calls}'
+                self.calls += 1
+                mt = super().run(mt, genome_version, vep_config_json_path)
+                return mt.annotate_rows(
+                    vep=mt.vep.annotate(
+                        most_severe_consequence=hl.if_else(
+                            mt.locus.position % 2 == 1,
+                            'stop_gained',
+                            'missense_variant',
+                        ),
+                        marker=marker,
+                    ),
+                )
+
+        runner = MarkedDummyRunner()
+        mt = hl.import_vcf(TEST_DATA_MT_1KG)
+        vep_mt = HailVEPTwoTierRunner(runner).run(
+            mt,
+            '37',
+            vep_config_json_path=self._fake_vep_config_path(),
+        )
+        self.assertEqual(runner.calls, 2)
+        plan = str(vep_mt.rows()._tir)
+        self.assertNotIn('vep-pass-0', plan)
+        self.assertNotIn('vep-pass-1', plan)
+        counts = vep_mt.aggregate_rows(
+            hl.struct(
+                lof_candidates=hl.agg.count_where(vep_mt.locus.position % 2 == 1),
+                lof_pass=hl.agg.count_where(vep_mt.vep.marker == 'vep-pass-1'),
+                plain_pass=hl.agg.count_where(vep_mt.vep.marker == 'vep-pass-0'),
+            ),
+        )
+        self.assertEqual(counts.lof_pass, counts.lof_candidates)
+        self.assertEqual(counts.plain_pass, 30 - counts.lof_candidates)
+
     def test_hail_matrix_table_and_elasticsearch_tasks(self):
         mt_task = self._hail_matrix_table_task()
 
@@ -168,6 +496,17 @@ class TestHailTasks(unittest.TestCase):
         )
         self.assertEqual(subset_mt.count(), (29, 14))
 
+    def test_generate_callstats_drop_monomorphic(self):
+        mt = hl.import_vcf(TEST_DATA_MT_1KG)
+        mt = mt.filter_cols(mt.s == mt.s.take(1)[0])
+        hmtt = HailMatrixTableTask(source_paths='a', dest_path='b', genome_version='38')
+        callstats_mt = hmtt.generate_callstats(mt, drop_monomorphic=True)
+        self.assertEqual(
+            callstats_mt.count_rows(),
+            mt.filter_rows(hl.agg.any(mt.GT.is_non_ref())).count_rows(),
+        )
+        self.assertEqual(hmtt.generate_callstats(mt).count_rows(), 30)
+
     def test_hail_matrix_table_subset_raise_e(self):
         # Tests if subsetting with an incorrect sample ID will raise the MatrixTableSampleSetError
         mt = hl.import_vcf(TEST_DATA_MT_1KG)
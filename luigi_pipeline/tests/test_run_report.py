@@ -0,0 +1,74 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import hail as hl
+
+from luigi_pipeline.lib.run_report import RunReport, report_stage, run_report_path
+
+TEST_DATA_MT_1KG = 'tests/data/1kg_30variants.vcf.bgz'
+
+
+class TestRunReport(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_run_report_path(self):
+        self.assertEqual(
+            run_report_path('gs://bucket/test.mt/'),
+            'gs://bucket/test.mt.run_report.json',
+        )
+        self.assertEqual(
+            run_report_path('test.mt', 'es_run_report'),
+            'test.mt.es_run_report.json',
+        )
+
+    def test_report_stage_without_report(self):
+        with report_stage(None, 'import') as stage:
+            stage['rows'] = 1
+
+    def test_write_report(self):
+        mt_path = os.path.join(self.test_dir, 'test.mt')
+        report = RunReport(
+            'task_id',
+            run_report_path(mt_path),
+            {'genome_version': '37'},
+        )
+        with report.stage('write') as stage:
+            hl.import_vcf(TEST_DATA_MT_1KG).write(mt_path)
+        stage.update(RunReport.mt_metrics(hl.read_matrix_table(mt_path), mt_path))
+        report.write()
+
+        with open(run_report_path(mt_path)) as f:
+            written = json.load(f)
+        self.assertEqual(written['task_id'], 'task_id')
+        self.assertEqual(written['parameters'], {'genome_version': '37'})
+        write_stage = written['stages'][0]
+        self.assertEqual(write_stage['name'], 'write')
+        self.assertEqual(write_stage['rows'], 30)
+        self.assertGreater(write_stage['bytes_written'], 0)
+        self.assertGreater(len(write_stage['spark_job_ids']), 0)
+        self.assertIn('seconds', write_stage)
+
+    def test_nested_stages(self):
+        report = RunReport(
+            'task_id',
+            run_report_path(os.path.join(self.test_dir, 'test.mt')),
+        )
+        sc = hl.current_backend().sc
+        with report.stage('annotate') as outer:
+            outer_job_group = sc.getLocalProperty('spark.jobGroup.id')
+            with report.stage('import') as inner:
+                hl.import_vcf(TEST_DATA_MT_1KG).count()
+            # The job group of the outer stage is restored when the inner one ends.
+            self.assertEqual(sc.getLocalProperty('spark.jobGroup.id'), outer_job_group)
+            hl.import_vcf(TEST_DATA_MT_1KG).count()
+        self.assertIsNone(sc.getLocalProperty('spark.jobGroup.id'))
+        self.assertGreater(len(inner['spark_job_ids']), 0)
+        self.assertGreater(len(outer['spark_job_ids']), 0)
+        self.assertFalse(set(inner['spark_job_ids']) & set(outer['spark_job_ids']))
@@ -3,7 +3,12 @@ from unittest.mock import patch
 
 import hail as hl
 
-from luigi_pipeline.seqr_loading import SeqrValidationError, SeqrVCFToMTTask
+from luigi_pipeline.seqr_loading import (
+    GRCh38_STANDARD_CONTIGS,
+    SeqrValidationError,
+    SeqrVCFToMTTask,
+    contig_groups,
+)
 
 TEST_DATA_MT_1KG = 'tests/data/1kg_30variants.vcf.bgz'
 
@@ -13,6 +18,12 @@ class TestSeqrLoadingTasks(unittest.TestCase):
     def setUp(self):
         # Create a temporary directory
         self.test_mt = hl.import_vcf(TEST_DATA_MT_1KG)
+        validation_stats_patcher = patch(
+            'luigi_pipeline.lib.hail_tasks.HailMatrixTableTask.validation_stats',
+            return_value={'contig_counts': {}, 'sampled': False},
+        )
+        self.mock_validation_stats = validation_stats_patcher.start()
+        self.addCleanup(validation_stats_patcher.stop)
 
     def _sample_type_stats_return_value(  # noqa: PLR0913
         self,
@@ -192,3 +203,136 @@ class TestSeqrLoadingTasks(unittest.TestCase):
             '37',
             'WES',
         )
+
+
+class TestContigFanOut(unittest.TestCase):
+    def _task(self, **kwargs):
+        return SeqrVCFToMTTask(
+            source_paths=TEST_DATA_MT_1KG,
+            dest_path='test.mt',
+            genome_version='38',
+            reference_ht_path='ref.ht',
+            clinvar_ht_path='clinvar.ht',
+            sample_type='WES',
+            **kwargs,
+        )
+
+    def test_contig_groups(self):
+        groups = contig_groups(GRCh38_STANDARD_CONTIGS, 10)
+        self.assertEqual(len(groups), 3)
+        self.assertEqual(groups[0][:3], ['chr1', 'chr2', 'chr3'])
+        self.assertEqual(groups[-1], ['chr21', 'chr22', 'chrX', 'chrY', 'chrM'])
+
+    def test_requires_contig_tasks(self):
+        self.assertEqual(len(self._task().requires()), 1)
+
+        contig_tasks = self._task(contig_group_size=5).requires()
+        self.assertEqual(len(contig_tasks), 5)
+        self.assertEqual(
+            contig_tasks[0].contigs,
+            ('chr1', 'chr2', 'chr3', 'chr4', 'chr5'),
+        )
+        self.assertEqual(contig_tasks[0].dest_path, 'test.mt_contigs/chr1-chr5.mt')
+        self.assertEqual(contig_tasks[0].source_paths, [TEST_DATA_MT_1KG])
+        self.assertFalse(contig_tasks[0].is_contig_fan_out())
+
+
+class TestContigCheck(unittest.TestCase):
+    def test_contig_check_sampled(self):
+        contig_counts = {'1': 1000, '2': 10}
+        standard_contigs = {'1', '2', '3'}
+        self.assertEqual(
+            SeqrVCFToMTTask.contig_check(None, standard_contigs, 100, contig_counts),
+            {
+                'Missing contig(s)': ['3'],
+                'Chromosome(s) whose variants count under threshold 100': ['2'],
+            },
+        )
+        self.assertEqual(
+            SeqrVCFToMTTask.contig_check(
+                None,
+                standard_contigs,
+                100,
+                contig_counts,
+                sampled=True,
+            ),
+            {},
+        )
+
+
+class TestSplitMultiHts(unittest.TestCase):
+    def test_split_multi_hts_matches_hail(self):
+        mt = hl.import_vcf(TEST_DATA_MT_1KG)
+        mt = mt.annotate_entries(PL=hl.missing(hl.tarray(hl.tint32)))
+        mt = mt.annotate_rows(ref=mt.alleles[0])
+        # Multiallelic rows with alt alleles out of lexical order, co-located with a biallelic row.
+        multi = mt.filter_rows(mt.locus.position % 2 == 0)
+        multi = multi.key_rows_by('locus')
+        multi = multi.annotate_rows(
+            alleles=[multi.ref, multi.ref + 'T', multi.ref + 'C'],
+        )
+        multi = multi.annotate_entries(AD=multi.AD.append(0))
+        colocated = mt.filter_rows(mt.locus.position % 2 == 0)
+        colocated = colocated.key_rows_by('locus')
+        colocated = colocated.annotate_rows(
+            alleles=[colocated.ref, colocated.ref + 'A'],
+        )
+        # Multiallelic rows with an allele whose minimal representation moves the locus.
+        moved = mt.filter_rows(mt.locus.position % 2 != 0)
+        moved = moved.key_rows_by('locus')
+        moved = moved.annotate_rows(
+            alleles=[moved.ref + 'C', moved.ref + 'G', moved.ref],
+        )
+        moved = moved.annotate_entries(AD=moved.AD.append(0))
+        mt = hl.MatrixTable.union_rows(
+            *[
+                m.key_rows_by('locus', 'alleles').drop('ref')
+                for m in (multi, colocated, moved)
+            ],
+        )
+
+        task = SeqrVCFToMTTask(
+            source_paths=TEST_DATA_MT_1KG,
+            dest_path='test.mt',
+            genome_version='37',
+            reference_ht_path='ref.ht',
+            clinvar_ht_path='clinvar.ht',
+            sample_type='WES',
+        )
+        split = task.split_multi_hts(mt)
+        expected = hl.split_multi_hts(mt, permit_shuffle=True)
+        self.assertEqual(list(split.row_key), ['locus', 'alleles'])
+        self.assertEqual(split.count_rows(), expected.count_rows())
+        self.assertTrue(split.rows()._same(expected.rows().select(*split.row_value)))
+        keys = [
+            (row.locus.position, row.alleles) for row in split.rows().select().collect()
+        ]
+        self.assertEqual(keys, sorted(keys))
+        self.assertIn(['C', 'G'], [alleles for _, alleles in keys])
+
+
+class TestPruneSourceFields(unittest.TestCase):
+    def _task(self, **kwargs):
+        return SeqrVCFToMTTask(
+            source_paths=TEST_DATA_MT_1KG,
+            dest_path='test.mt',
+            genome_version='37',
+            reference_ht_path='ref.ht',
+            clinvar_ht_path='clinvar.ht',
+            sample_type='WES',
+            **kwargs,
+        )
+
+    def test_prune_source_fields(self):
+        mt = hl.import_vcf(TEST_DATA_MT_1KG)
+        mt = mt.annotate_entries(VAF=hl.float64(0.5), PL=[0, 1, 2])
+        mt = self._task(downcast_entry_floats=True).prune_source_fields(mt)
+        self.assertEqual(list(mt.row_value), ['filters', 'rsid', 'info'])
+        self.assertEqual(list(mt.info), [])
+        self.assertEqual(list(mt.entry), ['AD', 'GQ', 'GT'])
+
+    def test_source_fields_include_info_fields(self):
+        row_fields, entry_fields = self._task().source_fields()
+        self.assertIn('info.AC_MCRI', row_fields)
+        self.assertNotIn('info', row_fields)
+        self.assertEqual(entry_fields, ['AD', 'GQ', 'GT'])
@@ -790,3 +790,17 @@ class SeqrSVLoadingTest(unittest.TestCase):
         row_ht = genotypes_mt.rows().join(variant_mt.rows()).flatten().drop(*key)
         data = row_ht.order_by(row_ht.start).tail(8).take(3)
         self.assertListEqual(data, EXPECTED_DATA_GENOTYPES)
+
+    def test_prune_source_fields(self):
+        task = SeqrSVVariantMTTask(
+            source_paths=self._vcf_file,
+            dest_path=self._variant_mt_file,
+            grch38_to_grch37_ref_chain=REFERENCE_CHAIN,
+        )
+        mt = task.prune_source_fields(task.import_dataset())
+        self.assertEqual(list(mt.row_key), ['rsid'])
+        self.assertTrue(
+            {'locus', 'alleles', 'info', 'filters'}.issubset(set(mt.row_value)),
+        )
+        mt = mt.filter_rows(hl.set(task.standard_contigs()).contains(mt.locus.contig))
+        self.assertEqual(mt.count_rows(), 11)
@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import hail as hl
+
+from hail_scripts.computed_fields.vep import CONSEQUENCE_TERMS
+
+from luigi_pipeline.lib.vep_table import (
+    annotate_vep_table,
+    decode_vep_table,
+    encode_vep_table,
+    vep_table_path,
+)
+
+VEP_TYPE = hl.tstruct(
+    most_severe_consequence=hl.tstr,
+    input=hl.tstr,
+    transcript_consequences=hl.tarray(
+        hl.tstruct(
+            consequence_terms=hl.tarray(hl.tstr),
+            gene_id=hl.tstr,
+            transcript_id=hl.tstr,
+            cdna_start=hl.tint32,
+        ),
+    ),
+)
+
+
+class TestVEPTable(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.ht = hl.Table.parallelize(
+            [
+                {
+                    'locus': hl.Locus('1', 100, 'GRCh37'),
+                    'alleles': ['A', 'C'],
+                    'vep': {
+                        'most_severe_consequence': 'missense_variant',
+                        'input': '1\t100\t.\tA\tC',
+                        'transcript_consequences': [
+                            {
+                                'consequence_terms': [
+                                    'missense_variant',
+                                    'splice_region_variant',
+                                ],
+                                'gene_id': 'ENSG1',
+                                'transcript_id': 'ENST1',
+                                'cdna_start': 10,
+                            },
+                            {
+                                'consequence_terms': ['new_variant'],
+                                'gene_id': 'ENSG1',
+                                'transcript_id': 'ENST2',
+                                'cdna_start': None,
+                            },
+                        ],
+                    },
+                },
+                {
+                    'locus': hl.Locus('1', 200, 'GRCh37'),
+                    'alleles': ['G', 'T'],
+                    'vep': None,
+                },
+            ],
+            hl.tstruct(
+                locus=hl.tlocus('GRCh37'),
+                alleles=hl.tarray(hl.tstr),
+                vep=VEP_TYPE,
+            ),
+            key=['locus', 'alleles'],
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_vep_table_path(self):
+        self.assertEqual(
+            vep_table_path('gs://bucket/test.mt/'),
+            'gs://bucket/test.mt.vep.ht',
+        )
+
+    def test_encode_vep_table(self):
+        encoded = encode_vep_table(self.ht)
+        self.assertEqual(
+            hl.eval(encoded.vep_consequence_terms),
+            [*CONSEQUENCE_TERMS, 'new_variant'],
+        )
+        self.assertNotIn('input', encoded.vep)
+        rows = encoded.collect()
+        self.assertEqual(
+            rows[0].vep.most_severe_consequence,
+            CONSEQUENCE_TERMS.index('missense_variant'),
+        )
+        self.assertEqual(
+            [c.consequence_terms for c in rows[0].vep.transcript_consequences],
+            [
+                [
+                    CONSEQUENCE_TERMS.index('missense_variant'),
+                    CONSEQUENCE_TERMS.index('splice_region_variant'),
+                ],
+                [len(CONSEQUENCE_TERMS)],
+            ],
+        )
+        self.assertIsNone(rows[1].vep)
+
+    def test_decode_vep_table(self):
+        path = vep_table_path(os.path.join(self.test_dir, 'test.mt'))
+        encode_vep_table(self.ht).write(path)
+        decoded = decode_vep_table(hl.read_table(path)).collect()
+        expected = self.ht.annotate(vep=self.ht.vep.drop('input')).collect()
+        self.assertEqual(decoded[0].vep, expected[0].vep)
+        self.assertIsNone(decoded[1].vep)
+
+    def test_annotate_vep_table(self):
+        mt = hl.utils.range_matrix_table(1, 1)
+        mt = mt.key_rows_by(locus=hl.locus('1', 100, 'GRCh37'), alleles=['A', 'C'])
+        mt = annotate_vep_table(mt, encode_vep_table(self.ht))
+        vep = mt.rows().collect()[0].vep
+        self.assertEqual(
+            vep.transcript_consequences[1].consequence_terms,
+            ['new_variant'],
+        )